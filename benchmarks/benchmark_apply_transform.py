@@ -0,0 +1,65 @@
+"""
+	Compares the chunked `affinetransform.apply_transform` against the original homogeneous-matrix implementation,
+	for in-memory float64/float32 inputs and for a memory-mapped input written into a memory-mapped output.
+
+	Usage: python benchmarks/benchmark_apply_transform.py
+"""
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy
+
+from coregistration import affinetransform
+
+SIZES = [10_000, 1_000_000, 10_000_000]
+MATRIX = numpy.array([[0.98, 0.05, 30], [-0.04, 1.02, -12], [0, 0, 1]])
+
+
+def apply_transform_homogeneous(matrix: numpy.ndarray, coordinates: numpy.ndarray) -> numpy.ndarray:
+	""" The original implementation, kept here as the baseline."""
+	z_axis = numpy.ones((coordinates.shape[0], 1))
+	homogeneous = numpy.concatenate((coordinates, z_axis), axis = 1).transpose()
+	return (matrix @ homogeneous).transpose()[:, :2]
+
+
+def measure(function, *args, **kwargs):
+	""" Returns the wall time (in seconds) and the peak traced allocation (in MB) of a single call."""
+	tracemalloc.start()
+	start = time.perf_counter()
+	function(*args, **kwargs)
+	elapsed = time.perf_counter() - start
+	_, peak = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+	return elapsed, peak / 1024 ** 2
+
+
+def main():
+	generator = numpy.random.default_rng(0)
+	print(f"{'points':>10} {'input':>8} {'original (ms)':>14} {'peak (MB)':>10} {'chunked (ms)':>13} {'peak (MB)':>10}")
+	for size in SIZES:
+		points = generator.uniform(0, 40_000, size = (size, 2))
+		expected = apply_transform_homogeneous(MATRIX, points)
+		assert numpy.allclose(affinetransform.apply_transform(MATRIX, points), expected)
+
+		for dtype in (numpy.float64, numpy.float32):
+			array = points.astype(dtype)
+			time_original, peak_original = measure(apply_transform_homogeneous, MATRIX, array)
+			time_chunked, peak_chunked = measure(affinetransform.apply_transform, MATRIX, array)
+			print(f"{size:>10} {numpy.dtype(dtype).name:>8} {time_original * 1E3:>14.1f} {peak_original:>10.1f} {time_chunked * 1E3:>13.1f} {peak_chunked:>10.1f}")
+
+		with tempfile.TemporaryDirectory() as folder:
+			source = numpy.lib.format.open_memmap(Path(folder) / "source.npy", mode = 'w+', dtype = numpy.float32, shape = points.shape)
+			source[:] = points
+			source.flush()
+			source = numpy.load(Path(folder) / "source.npy", mmap_mode = 'r')
+			output = numpy.lib.format.open_memmap(Path(folder) / "output.npy", mode = 'w+', dtype = numpy.float32, shape = points.shape)
+			time_original, peak_original = measure(apply_transform_homogeneous, MATRIX, source)
+			time_chunked, peak_chunked = measure(affinetransform.apply_transform, MATRIX, source, out = output)
+			print(f"{size:>10} {'memmap':>8} {time_original * 1E3:>14.1f} {peak_original:>10.1f} {time_chunked * 1E3:>13.1f} {peak_chunked:>10.1f}")
+			del source, output
+
+
+if __name__ == "__main__":
+	main()
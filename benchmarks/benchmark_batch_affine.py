@@ -0,0 +1,46 @@
+"""
+	Compares `affinetransform.solve_affine_batch` against calling `solve_affine` once per image pair.
+	The batched timing excludes packing the point sets with `concatenate_point_sets`.
+
+	Usage: python benchmarks/benchmark_batch_affine.py
+"""
+import time
+
+import numpy
+
+from coregistration import affinetransform
+
+PAIR_COUNTS = [10, 100, 1_000, 10_000]
+
+
+def generate_point_sets(number_of_pairs: int, generator: numpy.random.Generator):
+	counts = generator.integers(6, 40, size = number_of_pairs)
+	matrices = numpy.tile(numpy.eye(3), (number_of_pairs, 1, 1))
+	matrices[:, :2, :] += generator.normal(0, 0.05, size = (number_of_pairs, 2, 3))
+	points_left = [generator.uniform(0, 20_000, size = (count, 2)) for count in counts]
+	points_right = [points @ matrix[:2, :2].T + matrix[:2, 2] for points, matrix in zip(points_left, matrices)]
+	return points_left, points_right
+
+
+def main():
+	generator = numpy.random.default_rng(0)
+	print(f"{'pairs':>8} {'loop (ms)':>12} {'batched (ms)':>14} {'speedup':>9}")
+	for number_of_pairs in PAIR_COUNTS:
+		points_left, points_right = generate_point_sets(number_of_pairs, generator)
+
+		start = time.perf_counter()
+		expected = numpy.array([affinetransform.solve_affine(left, right) for left, right in zip(points_left, points_right)])
+		time_loop = time.perf_counter() - start
+
+		concatenated_left, offsets = affinetransform.concatenate_point_sets(points_left)
+		concatenated_right, _ = affinetransform.concatenate_point_sets(points_right)
+		start = time.perf_counter()
+		result = affinetransform.solve_affine_batch(concatenated_left, concatenated_right, offsets)
+		time_batch = time.perf_counter() - start
+
+		assert numpy.allclose(result.matrices, expected, atol = 1E-6)
+		print(f"{number_of_pairs:>8} {time_loop * 1E3:>12.2f} {time_batch * 1E3:>14.2f} {time_loop / time_batch:>8.1f}x")
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,36 @@
+"""
+	Times `cellmatching.match_cells` on synthetic slides: the query cells are the reference cells after a small
+	misregistration, with some cells missing from each section.
+
+	Usage: python benchmarks/benchmark_cell_matching.py [cells] [chunk_size]
+"""
+import sys
+import time
+
+import numpy
+
+from coregistration import cellmatching
+
+
+def main(cells: int = 1_000_000, chunk_size: int = cellmatching.DEFAULT_CHUNK_SIZE):
+	generator = numpy.random.default_rng(0)
+	# About one cell per 15x15 pixels.
+	side = 15 * numpy.sqrt(cells)
+	reference = generator.uniform(0, side, size = (cells, 2))
+	query = reference + generator.normal(scale = 1.5, size = reference.shape)
+	reference = reference[generator.random(cells) > 0.05]
+	query = query[generator.random(cells) > 0.05]
+
+	start = time.perf_counter()
+	index = cellmatching.CellIndex(reference, chunk_size = chunk_size)
+	built = time.perf_counter()
+	matches = cellmatching.match_cells(reference, query, max_distance = 6, index = index)
+	elapsed = time.perf_counter() - start
+	statistics = matches.statistics()
+	print(f"{len(reference):,} reference cells, {len(query):,} query cells")
+	print(f"index built in {built - start:.2f}s, matched in {elapsed - (built - start):.2f}s")
+	print(f"{statistics['matched']:,} matches ({statistics['fraction:query']:.1%} of query cells), median distance {statistics['distance:median']:.2f}px")
+
+
+if __name__ == "__main__":
+	main(*(int(i) for i in sys.argv[1:]))
@@ -0,0 +1,53 @@
+"""
+	Compares the vectorized design-matrix construction in `affinetransform` against the original per-point loop.
+
+	Usage: python benchmarks/benchmark_design_matrix.py
+"""
+import time
+from typing import *
+
+import numpy
+
+from coregistration import affinetransform
+
+SIZES = [3, 10, 100, 1_000, 10_000, 100_000, 1_000_000]
+
+
+def build_point_array_loop(coordinates: Iterable[Tuple[float, float]]) -> numpy.ndarray:
+	""" The original implementation, kept here as the baseline."""
+	sample_points = list()
+	for point in coordinates:
+		sample_points.append([point[0], point[1], 1, 0, 0, 0])
+		sample_points.append([0, 0, 0, point[0], point[1], 1])
+	return numpy.array(sample_points)
+
+
+def timeit(function: Callable, *args, repeat: int = 3) -> float:
+	""" Returns the best wall time (in seconds) over `repeat` runs."""
+	timings = list()
+	for _ in range(repeat):
+		start = time.perf_counter()
+		function(*args)
+		timings.append(time.perf_counter() - start)
+	return min(timings)
+
+
+def main():
+	generator = numpy.random.default_rng(0)
+	print(f"{'points':>10} {'dtype':>8} {'loop (ms)':>12} {'vectorized (ms)':>16} {'speedup':>9}")
+	for size in SIZES:
+		for dtype in (numpy.float64, numpy.float32):
+			points = generator.uniform(0, 40_000, size = (size, 2)).astype(dtype)
+
+			expected = build_point_array_loop(points)
+			result = affinetransform.build_point_array(points)
+			assert result.dtype == dtype
+			assert numpy.array_equal(result, expected.astype(dtype))
+
+			time_loop = timeit(build_point_array_loop, points, repeat = 1 if size >= 100_000 else 3)
+			time_vectorized = timeit(affinetransform.build_point_array, points)
+			print(f"{size:>10} {numpy.dtype(dtype).name:>8} {time_loop * 1E3:>12.3f} {time_vectorized * 1E3:>16.3f} {time_loop / time_vectorized:>8.1f}x")
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,51 @@
+"""
+	Times keypoint detection and descriptor matching of `features.estimate_transform` per megapixel, on a synthetic
+	Brightfield-like texture and a rotated, scaled copy of it.
+
+	Usage: python benchmarks/benchmark_features.py [size] [max_keypoints]
+"""
+import math
+import sys
+import time
+
+import numpy
+
+from coregistration import autoinit, features, robustestimation, warping
+
+
+def make_texture(size: int) -> numpy.ndarray:
+	generator = numpy.random.default_rng(0)
+	spectrum = numpy.fft.rfft2(generator.normal(size = (size, size)).astype(numpy.float32))
+	frequency = numpy.hypot(*numpy.meshgrid(numpy.fft.rfftfreq(size), numpy.fft.fftfreq(size)))
+	return numpy.fft.irfft2(spectrum * numpy.exp(-(frequency / 0.06) ** 2), s = (size, size)).astype(numpy.float32)
+
+
+def main(size: int = 4_000, max_keypoints: int = features.DEFAULT_MAX_KEYPOINTS):
+	reference = make_texture(size)
+	matrix = autoinit._similarity(math.radians(12), 1.03, (size / 2, size / 2))
+	query = warping.warp_array(reference, numpy.linalg.inv(matrix), reference.shape)
+	megapixels = reference.size / 1E6
+	print(f"images: {reference.shape} ({megapixels:.1f} MP each)")
+
+	start = time.perf_counter()
+	keypoints_reference = features.detect_keypoints(reference, max_keypoints = max_keypoints)
+	keypoints_query = features.detect_keypoints(query, max_keypoints = max_keypoints)
+	time_detect = time.perf_counter() - start
+
+	start = time.perf_counter()
+	matches = features.match_keypoints(keypoints_reference, keypoints_query)
+	time_match = time.perf_counter() - start
+
+	start = time.perf_counter()
+	result = robustestimation.ransac_affine(matches.points_reference, matches.points_query, threshold = 3.0)
+	time_fit = time.perf_counter() - start
+
+	corners = numpy.array([[0, 0, 1], [size, 0, 1], [0, size, 1], [size, size, 1]])
+	error = numpy.abs(corners @ result.matrix.T - corners @ matrix.T).max()
+	print(f"keypoints: {len(keypoints_reference)}/{len(keypoints_query)}, matches: {len(matches)}, inliers: {int(result.inliers.sum())}")
+	print(f"detection: {time_detect:.2f}s ({time_detect / (2 * megapixels):.3f} s/MP)")
+	print(f"matching: {time_match:.2f}s, fit: {time_fit:.2f}s, max corner error: {error:.3f}px")
+
+
+if __name__ == "__main__":
+	main(*(int(i) for i in sys.argv[1:]))
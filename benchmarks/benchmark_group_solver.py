@@ -0,0 +1,44 @@
+"""
+	Times `groupsolver.solve_group` on synthetic groups of serial sections, each registered to its neighbours and to a
+	few random other sections.
+
+	Usage: python benchmarks/benchmark_group_solver.py [images] [points_per_pair] [extra_links_per_image]
+"""
+import sys
+import time
+
+import numpy
+
+from coregistration import groupsolver
+
+
+def main(images: int = 2_000, points_per_pair: int = 20, extra_links: int = 2):
+	generator = numpy.random.default_rng(0)
+	matrices = [numpy.eye(3)]
+	for _ in range(images - 1):
+		step = numpy.eye(3)
+		angle = generator.normal(scale = 0.01)
+		step[:2, :2] = numpy.array([[numpy.cos(angle), -numpy.sin(angle)], [numpy.sin(angle), numpy.cos(angle)]]) * generator.normal(1, 0.002)
+		step[:2, 2] = generator.normal(scale = 20, size = 2)
+		matrices.append(step @ matrices[-1])
+
+	pairs = [(index, index + 1) for index in range(images - 1)]
+	pairs += [tuple(sorted(generator.choice(images, size = 2, replace = False))) for _ in range(extra_links * images)]
+	correspondences = list()
+	for left, right in pairs:
+		points = numpy.column_stack((generator.uniform(0, 40_000, size = (points_per_pair, 2)), numpy.ones(points_per_pair)))
+		correspondences.append(groupsolver.Correspondence(
+			f"S{left}", f"S{right}", (points @ matrices[left].T)[:, :2],
+			(points @ matrices[right].T)[:, :2] + generator.normal(scale = 1.0, size = (points_per_pair, 2))
+		))
+
+	start = time.perf_counter()
+	solution = groupsolver.solve_group(correspondences, 'S0')
+	elapsed = time.perf_counter() - start
+	errors = [numpy.abs(solution.matrices[f"S{index}"] - matrix)[:2, 2].max() for index, matrix in enumerate(matrices)]
+	print(f"{images} images, {len(correspondences)} correspondence sets, {len(correspondences) * points_per_pair:,} point pairs")
+	print(f"solved in {elapsed:.2f}s, median pair RMSE {numpy.median(list(solution.pair_rmse.values())):.3f}px, max translation error {max(errors):.2f}px")
+
+
+if __name__ == "__main__":
+	main(*(int(i) for i in sys.argv[1:]))
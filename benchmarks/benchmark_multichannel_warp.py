@@ -0,0 +1,36 @@
+"""
+	Compares warping every channel of a multichannel stack with one `warping.warp_array` call per channel against
+	`warping.warp_channels`, which computes the coordinate map and interpolation weights once per tile.
+
+	Usage: python benchmarks/benchmark_multichannel_warp.py [size] [channels]
+"""
+import sys
+import time
+
+import numpy
+
+from coregistration import warping
+
+MATRIX = numpy.array([[0.97, 0.06, 21.3], [-0.05, 1.02, -14.8], [0, 0, 1]])
+
+
+def main(size: int = 4_000, channels: int = 8):
+	source = numpy.random.default_rng(0).integers(0, 255, size = (channels, size, size), dtype = numpy.uint8)
+	print(f"source: {source.shape} {source.dtype}")
+	print(f"{'method':>9} {'per channel (s)':>16} {'shared, channels-first (s)':>27} {'shared, channels-last (s)':>26}")
+	for method in warping.INTERPOLATION_METHODS:
+		start = time.perf_counter()
+		expected = numpy.stack([warping.warp_array(channel, MATRIX, (size, size), method = method) for channel in source])
+		time_loop = time.perf_counter() - start
+
+		timings = list()
+		for gather in ('channels-first', 'channels-last'):
+			start = time.perf_counter()
+			result = warping.warp_channels(source, MATRIX, (size, size), method = method, gather = gather)
+			timings.append(time.perf_counter() - start)
+			assert numpy.array_equal(result, expected)
+		print(f"{method:>9} {time_loop:>16.2f} {timings[0]:>27.2f} {timings[1]:>26.2f}")
+
+
+if __name__ == "__main__":
+	main(*(int(i) for i in sys.argv[1:]))
@@ -0,0 +1,38 @@
+"""
+	Times locating and transforming millions of points with `piecewiseaffine.PiecewiseAffineTransform`, against the
+	global affine `affinetransform.apply_transform` of the same control points.
+
+	Usage: python benchmarks/benchmark_piecewise_affine.py [points] [control_points]
+"""
+import sys
+import time
+
+import numpy
+
+from coregistration import affinetransform, piecewiseaffine
+
+
+def main(count: int = 5_000_000, control_points: int = 500):
+	generator = numpy.random.default_rng(0)
+	left = generator.uniform(0, 40_000, size = (control_points, 2))
+	right = left + 50 * numpy.sin(left[:, ::-1] / 5_000)
+	points = generator.uniform(-1_000, 41_000, size = (count, 2))
+
+	start = time.perf_counter()
+	transform = piecewiseaffine.PiecewiseAffineTransform.fit(left, right)
+	time_build = time.perf_counter() - start
+
+	start = time.perf_counter()
+	transform.apply(points)
+	time_piecewise = time.perf_counter() - start
+
+	start = time.perf_counter()
+	affinetransform.apply_transform(transform.matrix, points)
+	time_affine = time.perf_counter() - start
+
+	print(f"{control_points} control points, {len(transform.simplices)} triangles, built in {time_build:.3f}s")
+	print(f"{count:,} points: piecewise-affine {time_piecewise:.2f}s ({1E9 * time_piecewise / count:.0f} ns/point), global affine {time_affine:.2f}s")
+
+
+if __name__ == "__main__":
+	main(*(int(i) for i in sys.argv[1:]))
@@ -0,0 +1,31 @@
+"""
+	Times `qualitycontrol.measure_quality` on a synthetic slide pair related by a small rotation.
+
+	Usage: python benchmarks/benchmark_quality_control.py [size] [tile_size]
+"""
+import sys
+import time
+
+import numpy
+
+from coregistration import intensityregistration, qualitycontrol, warping
+
+
+def main(size: int = 8192, tile_size: int = qualitycontrol.DEFAULT_TILE_SIZE):
+	generator = numpy.random.default_rng(0)
+	coarse = intensityregistration.gaussian_blur(generator.random((size // 8, size // 8)), 2.0)
+	reference = numpy.kron(coarse, numpy.ones((8, 8), dtype = numpy.float32))
+	reference = ((reference - reference.min()) / (reference.max() - reference.min()) * 60_000).astype(numpy.uint16)
+	angle = 0.02
+	matrix = numpy.array([[numpy.cos(angle), -numpy.sin(angle), 12.5], [numpy.sin(angle), numpy.cos(angle), -7.25], [0, 0, 1]])
+	query = warping.warp_array(reference, numpy.linalg.inv(matrix), reference.shape)
+
+	start = time.perf_counter()
+	report = qualitycontrol.measure_quality(reference, query, matrix, tile_size = tile_size)
+	elapsed = time.perf_counter() - start
+	print(f"{size}x{size} pair, {report.metrics['tiles']} tiles of {tile_size}px")
+	print(f"measured in {elapsed:.2f}s ({elapsed / (size * size / 1E6) * 1E3:.1f}ms/MP), NCC {report.metrics['ncc']:.3f}, Dice {report.metrics['dice']:.3f}")
+
+
+if __name__ == "__main__":
+	main(*(int(i) for i in sys.argv[1:]))
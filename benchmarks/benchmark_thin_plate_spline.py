@@ -0,0 +1,44 @@
+"""
+	Compares direct thin-plate-spline evaluation (float32 and float64 kernels) with the coarse-grid approximation from
+	`ThinPlateSplineTransform.to_grid`, on a slide-sized extent.
+
+	Usage: python benchmarks/benchmark_thin_plate_spline.py [points] [control_points] [spacing]
+"""
+import sys
+import time
+
+import numpy
+
+from coregistration import thinplatespline
+
+
+def main(count: int = 2_000_000, control_points: int = 300, spacing: int = thinplatespline.DEFAULT_GRID_SPACING):
+	generator = numpy.random.default_rng(0)
+	extent = 40_000
+	left = generator.uniform(0, extent, size = (control_points, 2))
+	right = left + 50 * numpy.sin(left[:, ::-1] / 5_000)
+	points = generator.uniform(0, extent, size = (count, 2))
+	spline = thinplatespline.ThinPlateSplineTransform.fit(left, right)
+
+	timings = dict()
+	results = dict()
+	for dtype in (numpy.float64, numpy.float32):
+		start = time.perf_counter()
+		results[dtype] = spline.apply(points, dtype = dtype)
+		timings[f"direct, {numpy.dtype(dtype).name} kernels"] = time.perf_counter() - start
+
+	start = time.perf_counter()
+	grid = spline.to_grid((extent, extent), spacing = spacing)
+	time_grid = time.perf_counter() - start
+	start = time.perf_counter()
+	results['grid'] = grid.apply(points)
+	timings[f"grid ({grid.displacement_x.shape[0]}x{grid.displacement_x.shape[1]}, built in {time_grid:.2f}s)"] = time.perf_counter() - start
+
+	print(f"{count:,} points, {control_points} control points")
+	for (label, elapsed), result in zip(timings.items(), results.values()):
+		error = numpy.abs(result - results[numpy.float64]).max()
+		print(f"{label:>40}: {elapsed:.2f}s ({1E9 * elapsed / count:.0f} ns/point), max error {error:.4f}px")
+
+
+if __name__ == "__main__":
+	main(*(int(i) for i in sys.argv[1:]))
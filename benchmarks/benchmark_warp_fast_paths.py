@@ -0,0 +1,46 @@
+"""
+	Compares the translation/orthogonal/axis-aligned fast paths of `warping.warp_array` against the general tiled path
+	(`fast_paths = False`) on a slide-size uint8 channel.
+
+	Usage: python benchmarks/benchmark_warp_fast_paths.py [size]
+"""
+import sys
+import time
+
+import numpy
+
+from coregistration import warping
+
+CASES = {
+	'integer translation': numpy.array([[1, 0, 37], [0, 1, -120], [0, 0, 1]], dtype = float),
+	'rotation by 90':      numpy.array([[0, -1, 0], [1, 0, 0], [0, 0, 1]], dtype = float),
+	'horizontal flip':     numpy.array([[-1, 0, 0], [0, 1, 0], [0, 0, 1]], dtype = float),
+	'axis-aligned scale':  numpy.array([[1.07, 0, 13.4], [0, 0.96, -8.2], [0, 0, 1]])
+}
+
+
+def main(size: int = 10_000):
+	source = numpy.random.default_rng(0).integers(0, 255, size = (size, size), dtype = numpy.uint8)
+	print(f"source: {source.shape} {source.dtype}")
+	print(f"{'case':>20} {'method':>9} {'general (s)':>12} {'fast (s)':>10} {'speedup':>9}")
+	for name, matrix in CASES.items():
+		matrix = matrix.copy()
+		if name in {'rotation by 90', 'horizontal flip'}:
+			# Offsets that keep the flipped/rotated image in frame.
+			matrix[:2, 2] = numpy.where(matrix[:2, :2].sum(axis = 1) < 0, size - 1, 0)
+		for method in ('nearest', 'bilinear') if name != 'axis-aligned scale' else warping.INTERPOLATION_METHODS:
+			output = numpy.empty_like(source)
+			start = time.perf_counter()
+			expected = warping.warp_array(source, matrix, source.shape, method = method, fast_paths = False)
+			time_general = time.perf_counter() - start
+
+			start = time.perf_counter()
+			warping.warp_array(source, matrix, source.shape, method = method, out = output)
+			time_fast = time.perf_counter() - start
+
+			assert numpy.abs(output.astype(int) - expected.astype(int)).max() <= 1
+			print(f"{name:>20} {method:>9} {time_general:>12.2f} {time_fast:>10.2f} {time_general / time_fast:>8.1f}x")
+
+
+if __name__ == "__main__":
+	main(*(int(i) for i in sys.argv[1:]))
@@ -1,4 +1,4 @@
-import itertools
+import json
 from dataclasses import dataclass
 from pathlib import Path
 from typing import *
@@ -11,14 +11,34 @@ from loguru import logger
 PointType = Tuple[Union[int, float], Union[int, float]]
 TransformTupleType = Tuple[float, float, float, float, float, float]
 
-def _coerce_to_array(item) -> numpy.ndarray:
-	if isinstance(item, pandas.DataFrame):
-		result = item.values
-	elif isinstance(item, list):
-		result = numpy.array(item)
-	else:
-		result = item
+def coerce_to_array(item, dtype: Optional[numpy.dtype] = None) -> numpy.ndarray:
+	"""
+		Converts any array-like collection of points (DataFrame, list of tuples, ndarray, ...) into an [n, 2] array.
+		Parameters
+		----------
+		item: array-like
+			The points to convert. Only the first two columns (x, y) are used.
+		dtype: numpy.dtype = None
+			The floating-point type of the result. If `None`, float32 inputs stay float32 and everything else becomes float64.
+	"""
+	if isinstance(item, (pandas.DataFrame, pandas.Series)):
+		item = item.to_numpy()
+	result = numpy.asarray(item)
+
+	if dtype is None:
+		dtype = result.dtype if result.dtype in (numpy.float32, numpy.float64) else numpy.float64
+	result = result.astype(dtype, copy = False)
+
+	if result.size == 0:
+		result = result.reshape((0, 2))
+	if result.ndim != 2 or result.shape[1] < 2:
+		message = f"Expected an array of points with shape [n, 2], got {result.shape}"
+		raise ValueError(message)
+	if result.shape[1] > 2:
+		result = result[:, :2]
 	return result
+
+
 def matrix_multiplication(left: numpy.ndarray, right: numpy.ndarray) -> numpy.ndarray:
 	"""
 		Multiplies the input matrices together
@@ -37,75 +57,674 @@ def format_coordinates(coordinates: List[PointType] | numpy.ndarray) -> numpy.nd
 
 	return result.transpose()
 
-def build_point_array(coordinates: Iterable[PointType]) -> numpy.ndarray:
-	""" Creates the matrix containing the mapped points (x -> x'). The result is a [2*n, 6] matrix."""
-	sample_points = list()
-
-	for point in coordinates:
-		top = [point[0], point[1], 1, 0, 0, 0]
-		bottom = [0, 0, 0, point[0], point[1], 1]
+def build_point_array(coordinates: Iterable[PointType] | numpy.ndarray) -> numpy.ndarray:
+	"""
+		Creates the matrix containing the mapped points (x -> x'). The result is a [2*n, 6] matrix where
+		the even rows are [x, y, 1, 0, 0, 0] and the odd rows are [0, 0, 0, x, y, 1].
+	"""
+	coordinates = coerce_to_array(coordinates)
+	sample_points = numpy.zeros((2 * len(coordinates), 6), dtype = coordinates.dtype)
 
-		sample_points.append(top)
-		sample_points.append(bottom)
+	# Interleave the rows with strided assignment rather than building them point by point.
+	sample_points[0::2, 0:2] = coordinates
+	sample_points[0::2, 2] = 1
+	sample_points[1::2, 3:5] = coordinates
+	sample_points[1::2, 5] = 1
 
-	sample_points = numpy.array(sample_points)
 	return sample_points
 
 
-def build_prime_array(coordinates: numpy.ndarray) -> numpy.ndarray:
+def build_prime_array(coordinates: Iterable[PointType] | numpy.ndarray) -> numpy.ndarray:
+	""" Creates the [2*n, 1] vector of transformed points, interleaved as [x0', y0', x1', y1', ...]."""
+	coordinates = coerce_to_array(coordinates)
 	prime = coordinates.reshape(2 * len(coordinates), 1)
 	return prime
 
 
-def solve_affine(coordinates_left: numpy.ndarray, coordinates_right: numpy.ndarray) -> numpy.ndarray:
-	coordinates_left = _coerce_to_array(coordinates_left)
-	coordinates_right = _coerce_to_array(coordinates_right)
+@dataclass
+class TransformParameters:
+	"""
+		The six parameters of a 2D affine transform, laid out as
+			x' = a * x + b * y + xoff
+			y' = c * x + d * y + yoff
+	"""
+	a: float
+	b: float
+	c: float
+	d: float
+	xoff: float
+	yoff: float
+
+	@classmethod
+	def from_matrix(cls, matrix: Union[List[List[float]], numpy.ndarray]) -> 'TransformParameters':
+		""" Accepts either the 2x3 or the full 3x3 affine matrix."""
+		matrix = numpy.asarray(matrix, dtype = numpy.float64)
+		if matrix.shape not in {(2, 3), (3, 3)}:
+			message = f"Expected a 2x3 or 3x3 affine matrix, got {matrix.shape}"
+			raise ValueError(message)
+		(a, b, xoff), (c, d, yoff) = matrix[:2].tolist()
+		return cls(a = a, b = b, c = c, d = d, xoff = xoff, yoff = yoff)
+
+	def to_list(self) -> List[float]:
+		return [self.a, self.b, self.xoff, self.c, self.d, self.yoff]
+
+	def to_matrix(self, full: bool = False) -> numpy.ndarray:
+		""" Returns the 2x3 matrix, or the 3x3 homogeneous matrix when `full` is True."""
+		rows = [[self.a, self.b, self.xoff], [self.c, self.d, self.yoff]]
+		if full:
+			rows.append([0.0, 0.0, 1.0])
+		return numpy.array(rows)
 
-	sample_points = build_point_array(coordinates_left)
-	prime = build_prime_array(coordinates_right)
-	try:
-		A = numpy.dot(numpy.linalg.pinv(sample_points), prime)
-	except ValueError as exception:
+	def to_parameters(self) -> Dict[str, float]:
+		return {'a': self.a, 'b': self.b, 'c': self.c, 'd': self.d, 'xoff': self.xoff, 'yoff': self.yoff}
+
+	def transform_point(self, point: PointType) -> Tuple[float, float]:
+		x, y = point
+		return self.a * x + self.b * y + self.xoff, self.c * x + self.d * y + self.yoff
+
+
+@dataclass
+class AffineSolution:
+	"""
+		The result of a least-squares affine fit.
+		Parameters
+		----------
+		matrix: numpy.ndarray
+			The 3x3 affine matrix mapping the left coordinates onto the right coordinates.
+		rank: int
+			The rank of the 3x3 normal system (3 when the points are not collinear).
+		condition_number: float
+			The condition number of the centered 2x2 scatter matrix of the (weighted) left coordinates.
+		weight: float
+			The total weight of the points (the number of points when unweighted).
+	"""
+	matrix: numpy.ndarray
+	rank: int
+	condition_number: float
+	weight: float
+
+
+CONDITION_LIMIT = 1E12
+DEFAULT_CHUNK_SIZE = 2 ** 16
+
+
+def validate_correspondences(coordinates_left, coordinates_right, weights = None) -> Tuple[numpy.ndarray, numpy.ndarray, Optional[numpy.ndarray]]:
+	""" Coerces matching point sets (and optional weights) into arrays, checking that their lengths agree and the weights are non-negative."""
+	coordinates_left = coerce_to_array(coordinates_left)
+	coordinates_right = coerce_to_array(coordinates_right)
+
+	if len(coordinates_left) != len(coordinates_right):
 		message1 = f"Could not calculate transform due to mismatched dimensions."
-		message2 = f"Shape of Sample Points: {sample_points.shape}"
-		message3 = f"Shape of Prime Array: {prime.shape}"
+		message2 = f"Shape of Left Points: {coordinates_left.shape}"
+		message3 = f"Shape of Right Points: {coordinates_right.shape}"
 
 		logger.error(message1)
 		logger.error(message2)
 		logger.error(message3)
 
-		raise exception
+		raise ValueError(f"{message1} {message2}, {message3}")
+
+	if weights is not None:
+		weights = numpy.asarray(weights, dtype = numpy.float64).ravel()
+		if len(weights) != len(coordinates_left):
+			message = f"Expected one weight per point ({len(coordinates_left)}), got {len(weights)}"
+			raise ValueError(message)
+		if (weights < 0).any():
+			message = f"The point weights must be non-negative."
+			raise ValueError(message)
+
+	return coordinates_left, coordinates_right, weights
+
+
+def iterate_chunks(length: int, chunk_size: int) -> Iterator[slice]:
+	""" Yields the slices that split `length` items into consecutive chunks of at most `chunk_size`."""
+	for start in range(0, length, chunk_size):
+		yield slice(start, min(start + chunk_size, length))
+
+
+def solve_affine_least_squares(
+		coordinates_left: numpy.ndarray, coordinates_right: numpy.ndarray, weights: numpy.ndarray = None,
+		chunk_size: int = DEFAULT_CHUNK_SIZE) -> AffineSolution:
+	"""
+		Fits the affine transform mapping `coordinates_left` onto `coordinates_right` by (weighted) least squares.
+
+		The 6-parameter problem decouples into two 3-parameter fits (one for x', one for y') that share the same
+		[x, y, 1] design matrix, so only a 3x3 normal system is ever formed. The points are centered on their
+		weighted mean first, which reduces the system to a 2x2 scatter matrix whose conditioning is checked
+		before solving. The points are consumed in chunks, so the extra memory does not grow with the number of points.
+		Parameters
+		----------
+		coordinates_left, coordinates_right: numpy.ndarray
+			[n, 2] arrays of matching points.
+		weights: numpy.ndarray = None
+			Optional non-negative weight for each point.
+		chunk_size: int
+			The number of points processed at a time.
+	"""
+	coordinates_left, coordinates_right, weights = validate_correspondences(coordinates_left, coordinates_right, weights)
+
+	# First pass: the weighted centroids.
+	total_weight = 0.0
+	sum_left = numpy.zeros(2)
+	sum_right = numpy.zeros(2)
+	for chunk in iterate_chunks(len(coordinates_left), chunk_size):
+		left = coordinates_left[chunk].astype(numpy.float64, copy = False)
+		right = coordinates_right[chunk].astype(numpy.float64, copy = False)
+		if weights is None:
+			total_weight += len(left)
+			sum_left += left.sum(axis = 0)
+			sum_right += right.sum(axis = 0)
+		else:
+			w = weights[chunk]
+			total_weight += w.sum()
+			sum_left += w @ left
+			sum_right += w @ right
+
+	if total_weight <= 0:
+		message = f"Cannot solve an affine transform without any (weighted) points."
+		raise ValueError(message)
+
+	center_left = sum_left / total_weight
+	center_right = sum_right / total_weight
+
+	# Second pass: the centered scatter (left x left) and cross-covariance (left x right) matrices.
+	scatter = numpy.zeros((2, 2))
+	covariance = numpy.zeros((2, 2))
+	for chunk in iterate_chunks(len(coordinates_left), chunk_size):
+		left = coordinates_left[chunk] - center_left
+		right = coordinates_right[chunk] - center_right
+		if weights is not None:
+			left_weighted = left * weights[chunk, None]
+		else:
+			left_weighted = left
+		scatter += left_weighted.T @ left
+		covariance += left_weighted.T @ right
+
+	singular_values = numpy.linalg.svd(scatter, compute_uv = False)
+	tolerance = singular_values[0] * 2 * numpy.finfo(numpy.float64).eps if singular_values[0] > 0 else 0
+	rank = int((singular_values > tolerance).sum())
+	condition_number = float(singular_values[0] / singular_values[-1]) if singular_values[-1] > 0 else numpy.inf
+
+	if rank == 2 and condition_number < CONDITION_LIMIT:
+		linear = numpy.linalg.solve(scatter, covariance).T
+	else:
+		message = f"The points are (nearly) collinear ({rank=}, {condition_number=:.3g}). Using the minimum-norm solution."
+		logger.warning(message)
+		linear = numpy.linalg.lstsq(scatter, covariance, rcond = None)[0].T
+
+	matrix = numpy.eye(3)
+	matrix[:2, :2] = linear
+	matrix[:2, 2] = center_right - linear @ center_left
+
+	return AffineSolution(matrix = matrix, rank = rank + 1, condition_number = condition_number, weight = float(total_weight))
+
+
+def solve_affine(coordinates_left: numpy.ndarray, coordinates_right: numpy.ndarray, weights: numpy.ndarray = None) -> numpy.ndarray:
+	"""
+		Calculates the 3x3 affine matrix mapping `coordinates_left` onto `coordinates_right`.
+		See `solve_affine_least_squares` for the solver details and diagnostics.
+	"""
+	solution = solve_affine_least_squares(coordinates_left, coordinates_right, weights = weights)
+	return solution.matrix
+
+
+@dataclass
+class FitDiagnostics:
+	"""
+		Per-point quality measures of a least-squares affine fit.
+		Parameters
+		----------
+		matrix: numpy.ndarray
+			The fitted 3x3 matrix mapping the left coordinates onto the right coordinates.
+		residuals: numpy.ndarray
+			[n, 2] array of `right - matrix(left)`.
+		errors: numpy.ndarray
+			The length of each residual.
+		leverage: numpy.ndarray
+			The diagonal of the hat matrix. Points with a leverage near 1 determine the fit on their own.
+		loo_errors: numpy.ndarray
+			The error of each point when predicted by a fit to all *other* points. NaN where that fit is undetermined.
+		rmse: float
+		max_error: float
+		loo_rmse: float
+			The root mean square of the finite leave-one-out errors.
+	"""
+	matrix: numpy.ndarray
+	residuals: numpy.ndarray
+	errors: numpy.ndarray
+	leverage: numpy.ndarray
+	loo_errors: numpy.ndarray
+	rmse: float
+	max_error: float
+	loo_rmse: float
+
+	@property
+	def worst_point(self) -> int:
+		""" The index of the point with the largest leave-one-out error (or residual, if none are defined)."""
+		if numpy.isfinite(self.loo_errors).any():
+			return int(numpy.nanargmax(self.loo_errors))
+		return int(numpy.argmax(self.errors))
+
+	def to_dict(self) -> Dict[str, Any]:
+		""" A JSON-compatible summary. Undefined values are written as null."""
+
+		def _clean(values: numpy.ndarray) -> List:
+			return [None if not numpy.isfinite(value) else float(value) for value in numpy.ravel(values)]
+
+		return {
+			'rmse':       self.rmse,
+			'max_error':  self.max_error,
+			'loo_rmse':   self.loo_rmse if numpy.isfinite(self.loo_rmse) else None,
+			'residuals':  self.residuals.tolist(),
+			'errors':     _clean(self.errors),
+			'leverage':   _clean(self.leverage),
+			'loo_errors': _clean(self.loo_errors)
+		}
+
+
+def calculate_fit_diagnostics(coordinates_left: numpy.ndarray, coordinates_right: numpy.ndarray, weights: numpy.ndarray = None) -> FitDiagnostics:
+	"""
+		Fits the affine transform mapping `coordinates_left` onto `coordinates_right` and measures how well each point agrees with it.
+
+		Leave-one-out errors use the hat-matrix identity e_loo = e / (1 - h) instead of n refits. For the centered
+		[x, y, 1] design, the leverage of point i is h_i = w_i * (1 / sum(w) + d_i' S^-1 d_i), where d_i is the point minus
+		the weighted centroid and S the 2x2 weighted scatter matrix, so the whole computation is O(n).
+	"""
+	coordinates_left, coordinates_right, weights = validate_correspondences(coordinates_left, coordinates_right, weights)
+	coordinates_left = coordinates_left.astype(numpy.float64, copy = False)
+	coordinates_right = coordinates_right.astype(numpy.float64, copy = False)
+	point_weights = numpy.ones(len(coordinates_left)) if weights is None else weights
+
+	solution = solve_affine_least_squares(coordinates_left, coordinates_right, weights = weights)
+	residuals = coordinates_right - apply_transform(solution.matrix, coordinates_left)
+
+	total_weight = point_weights.sum()
+	centered = coordinates_left - (point_weights @ coordinates_left) / total_weight
+	scatter = (centered * point_weights[:, None]).T @ centered
+	scatter_inverse = numpy.linalg.pinv(scatter) if solution.rank < 3 else numpy.linalg.inv(scatter)
+	leverage = point_weights * (1 / total_weight + numpy.einsum('ij,jk,ik->i', centered, scatter_inverse, centered))
+	return _build_diagnostics(solution.matrix, residuals, leverage)
 
-	values = list(itertools.chain.from_iterable(A))
-	values = [(float(value) if abs(value) > 1E-3 else 0) for value in values]
 
-	matrix = numpy.array([values[:3], values[3:6], [0, 0, 1]])
+def _build_diagnostics(matrix: numpy.ndarray, residuals: numpy.ndarray, leverage: numpy.ndarray) -> FitDiagnostics:
+	errors = numpy.hypot(residuals[:, 0], residuals[:, 1])
+	remaining = 1 - leverage
+	with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+		loo_errors = numpy.where(remaining > 1E-9, errors / remaining, numpy.nan)
+	finite = numpy.isfinite(loo_errors)
 
-	#result = TransformParameters.from_matrix(matrix)
+	return FitDiagnostics(
+		matrix = matrix,
+		residuals = residuals,
+		errors = errors,
+		leverage = leverage,
+		loo_errors = loo_errors,
+		rmse = float(numpy.sqrt(numpy.mean(errors ** 2))),
+		max_error = float(errors.max()),
+		loo_rmse = float(numpy.sqrt(numpy.mean(loo_errors[finite] ** 2))) if finite.any() else numpy.nan
+	)
+
+
+class IncrementalAffineEstimator:
+	"""
+		Maintains a least-squares affine fit while point pairs are added, undone or moved one at a time.
+
+		Only the sufficient statistics are kept up to date: the 3x3 normal matrix sum(w * x x') of the [x, y, 1] left
+		points, the 3x2 right-hand sides sum(w * x r') and the weighted sum of squared right points. Every update is a
+		rank-one change to them, so adding, removing or moving a pair costs O(1) regardless of how many pairs exist, and
+		the matrix and RMSE are recovered from a 3x3 solve. Coordinates are stored relative to the first pair to keep
+		the sums well conditioned for whole-slide coordinates.
+		Parameters
+		----------
+		pairs: Iterable[Tuple[PointType, PointType]] = None
+			Optional initial (left, right) pairs.
+	"""
+
+	def __init__(self, pairs: Iterable[Tuple[PointType, PointType]] = None):
+		self.clear()
+		for left, right in (pairs or []):
+			self.add(left, right)
+
+	def clear(self):
+		self.left: List[Tuple[float, float]] = list()
+		self.right: List[Tuple[float, float]] = list()
+		self.weights: List[float] = list()
+		self.origin_left = numpy.zeros(2)
+		self.origin_right = numpy.zeros(2)
+		self.normal = numpy.zeros((3, 3))
+		self.rhs = numpy.zeros((3, 2))
+		self.sum_squares = 0.0
+		self._solution = None
+
+	def __len__(self) -> int:
+		return len(self.left)
+
+	def _update(self, left: Tuple[float, float], right: Tuple[float, float], weight: float):
+		""" Adds (positive `weight`) or removes (negative `weight`) one pair from the sufficient statistics."""
+		x = numpy.array([left[0] - self.origin_left[0], left[1] - self.origin_left[1], 1.0])
+		r = numpy.array([right[0] - self.origin_right[0], right[1] - self.origin_right[1]])
+		self.normal += weight * numpy.outer(x, x)
+		self.rhs += weight * numpy.outer(x, r)
+		self.sum_squares += weight * float(r @ r)
+		self._solution = None
+
+	def add(self, left: PointType, right: PointType, weight: float = 1.0):
+		left = (float(left[0]), float(left[1]))
+		right = (float(right[0]), float(right[1]))
+		if not self.left:
+			self.origin_left = numpy.array(left)
+			self.origin_right = numpy.array(right)
+		self.left.append(left)
+		self.right.append(right)
+		self.weights.append(float(weight))
+		self._update(left, right, float(weight))
+
+	def remove_last(self) -> Optional[Tuple[PointType, PointType]]:
+		""" Removes the most recent pair (undo) and returns it."""
+		if not self.left:
+			return None
+		left, right, weight = self.left.pop(), self.right.pop(), self.weights.pop()
+		if self.left:
+			self._update(left, right, -weight)
+		else:
+			self.clear()
+		return left, right
+
+	def move(self, index: int, left: PointType = None, right: PointType = None):
+		""" Replaces one or both points of the pair at `index`."""
+		weight = self.weights[index]
+		self._update(self.left[index], self.right[index], -weight)
+		if left is not None:
+			self.left[index] = (float(left[0]), float(left[1]))
+		if right is not None:
+			self.right[index] = (float(right[0]), float(right[1]))
+		self._update(self.left[index], self.right[index], weight)
+
+	def _solve(self) -> Optional[Tuple[numpy.ndarray, numpy.ndarray]]:
+		if self._solution is None and len(self) >= 3:
+			singular_values = numpy.linalg.svd(self.normal, compute_uv = False)
+			if singular_values[-1] > 0 and singular_values[0] / singular_values[-1] < CONDITION_LIMIT:
+				normal_inverse = numpy.linalg.inv(self.normal)
+				self._solution = (normal_inverse @ self.rhs, normal_inverse)
+		return self._solution
+
+	@property
+	def matrix(self) -> Optional[numpy.ndarray]:
+		""" The current 3x3 matrix mapping left onto right, or None until three non-collinear pairs exist."""
+		solution = self._solve()
+		if solution is None:
+			return None
+		parameters = solution[0]
+		linear = parameters[:2].T
+		matrix = numpy.eye(3)
+		matrix[:2, :2] = linear
+		matrix[:2, 2] = parameters[2] + self.origin_right - linear @ self.origin_left
+		return matrix
+
+	@property
+	def rmse(self) -> Optional[float]:
+		""" The weighted RMSE of the current fit, from the sufficient statistics alone."""
+		solution = self._solve()
+		if solution is None:
+			return None
+		residual_sum_squares = self.sum_squares - float(numpy.sum(solution[0] * self.rhs))
+		return float(numpy.sqrt(max(residual_sum_squares, 0.0) / sum(self.weights)))
+
+	def diagnostics(self) -> Optional[FitDiagnostics]:
+		""" The per-point residuals and leave-one-out errors of the current fit, reusing the inverted normal matrix."""
+		solution = self._solve()
+		if solution is None:
+			return None
+		left = numpy.asarray(self.left) - self.origin_left
+		design = numpy.column_stack((left, numpy.ones(len(left))))
+		residuals = (numpy.asarray(self.right) - self.origin_right) - design @ solution[0]
+		leverage = numpy.asarray(self.weights) * numpy.einsum('ij,jk,ik->i', design, solution[1], design)
+		return _build_diagnostics(self.matrix, residuals, leverage)
+
+
+def format_diagnostics(diagnostics: FitDiagnostics) -> str:
+	""" A one-line summary for display, e.g. 'RMSE 1.23px | max 3.40px | LOO RMSE 1.61px | worst #4'."""
+	text = f"RMSE {diagnostics.rmse:.2f}px | max {diagnostics.max_error:.2f}px"
+	if numpy.isfinite(diagnostics.loo_rmse):
+		text += f" | LOO RMSE {diagnostics.loo_rmse:.2f}px | worst #{diagnostics.worst_point + 1}"
+	return text
+
+
+@dataclass
+class BatchAffineSolution:
+	"""
+		The result of fitting many independent affine transforms at once.
+		Parameters
+		----------
+		matrices: numpy.ndarray
+			[N, 3, 3] stack of affine matrices, one per point set.
+		rmse: numpy.ndarray
+			[N] root-mean-square (weighted) distance between the transformed left points and the right points.
+		counts: numpy.ndarray
+			[N] number of points in each point set.
+		condition_numbers: numpy.ndarray
+			[N] condition number of each centered 2x2 scatter matrix.
+	"""
+	matrices: numpy.ndarray
+	rmse: numpy.ndarray
+	counts: numpy.ndarray
+	condition_numbers: numpy.ndarray
+
+
+def concatenate_point_sets(point_sets: Sequence[numpy.ndarray]) -> Tuple[numpy.ndarray, numpy.ndarray]:
+	"""
+		Packs a ragged collection of [n_i, 2] point arrays into one [sum(n_i), 2] array and an [N + 1] offset array,
+		so that point set `i` is `array[offsets[i]:offsets[i + 1]]`.
+	"""
+	arrays = [coerce_to_array(points) for points in point_sets]
+	counts = numpy.array([len(array) for array in arrays], dtype = numpy.int64)
+	offsets = numpy.concatenate(([0], numpy.cumsum(counts)))
+	if arrays:
+		array = numpy.concatenate(arrays, axis = 0)
+	else:
+		array = numpy.empty((0, 2))
+	return array, offsets
+
+
+def solve_affine_batch(
+		coordinates_left: numpy.ndarray, coordinates_right: numpy.ndarray, offsets: numpy.ndarray,
+		weights: numpy.ndarray = None) -> BatchAffineSolution:
+	"""
+		Fits one affine transform per point set for a ragged collection of point sets in a single vectorized pass.
+		Uses the same centered block formulation as `solve_affine_least_squares`, with the per-set sums accumulated
+		via `numpy.bincount` and the stacked 2x2 systems solved together.
+		Parameters
+		----------
+		coordinates_left, coordinates_right: numpy.ndarray
+			Concatenated [n, 2] arrays of matching points for all point sets (see `concatenate_point_sets`).
+		offsets: numpy.ndarray
+			[N + 1] monotonic array of the start of each point set within the concatenated arrays.
+		weights: numpy.ndarray = None
+			Optional non-negative weight for each point.
+	"""
+	coordinates_left, coordinates_right, weights = validate_correspondences(coordinates_left, coordinates_right, weights)
+	coordinates_left = coordinates_left.astype(numpy.float64, copy = False)
+	coordinates_right = coordinates_right.astype(numpy.float64, copy = False)
+
+	offsets = numpy.asarray(offsets, dtype = numpy.int64)
+	counts = numpy.diff(offsets)
+	if offsets[0] != 0 or offsets[-1] != len(coordinates_left) or (counts < 0).any():
+		message = f"The offsets must increase from 0 to the number of points ({len(coordinates_left)})."
+		raise ValueError(message)
+	number_of_sets = len(counts)
+	labels = numpy.repeat(numpy.arange(number_of_sets), counts)
+
+	def _segment_sum(values: numpy.ndarray) -> numpy.ndarray:
+		if weights is not None:
+			values = values * weights
+		return numpy.bincount(labels, weights = values, minlength = number_of_sets)
+
+	total_weight = _segment_sum(numpy.ones(len(labels)))
+	empty = total_weight <= 0
+	safe_weight = numpy.where(empty, 1, total_weight)
+
+	center_left = numpy.stack([_segment_sum(coordinates_left[:, i]) for i in range(2)], axis = -1) / safe_weight[:, None]
+	center_right = numpy.stack([_segment_sum(coordinates_right[:, i]) for i in range(2)], axis = -1) / safe_weight[:, None]
+
+	left = coordinates_left - center_left[labels]
+	right = coordinates_right - center_right[labels]
+
+	scatter = numpy.empty((number_of_sets, 2, 2))
+	covariance = numpy.empty((number_of_sets, 2, 2))
+	for i in range(2):
+		for j in range(2):
+			scatter[:, i, j] = _segment_sum(left[:, i] * left[:, j])
+			covariance[:, i, j] = _segment_sum(left[:, i] * right[:, j])
+
+	singular_values = numpy.linalg.svd(scatter, compute_uv = False)
+	with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+		condition_numbers = singular_values[:, 0] / singular_values[:, -1]
+	condition_numbers = numpy.where(numpy.isnan(condition_numbers), numpy.inf, condition_numbers)
+	well_posed = (condition_numbers < CONDITION_LIMIT) & ~empty
+
+	linear = numpy.empty((number_of_sets, 2, 2))
+	linear[well_posed] = numpy.linalg.solve(scatter[well_posed], covariance[well_posed])
+	if not well_posed.all():
+		logger.warning(f"{int((~well_posed).sum())} point sets are degenerate; using the minimum-norm solution for them.")
+		linear[~well_posed] = numpy.linalg.pinv(scatter[~well_posed]) @ covariance[~well_posed]
+	linear = linear.transpose(0, 2, 1)
+
+	matrices = numpy.zeros((number_of_sets, 3, 3))
+	matrices[:, :2, :2] = linear
+	matrices[:, :2, 2] = center_right - numpy.einsum('nij,nj->ni', linear, center_left)
+	matrices[:, 2, 2] = 1
+	matrices[empty] = numpy.nan
+
+	# The residuals of the centered problem equal the residuals of the full problem.
+	error = numpy.einsum('nij,nj->ni', linear[labels], left) - right
+	rmse = numpy.sqrt(_segment_sum((error ** 2).sum(axis = 1)) / safe_weight)
+	rmse[empty] = numpy.nan
+
+	return BatchAffineSolution(matrices = matrices, rmse = rmse, counts = counts, condition_numbers = condition_numbers)
+
+
+EXPORT_SUFFIX = '.transform.calculated.json'
+
+
+def get_export_path(folder: Union[str, Path], barcode_reference: str, barcode_query: str) -> Path:
+	""" '{folder}/{reference}-{query}.transform.calculated.json', the file `MainGui.export_data` writes for a pair."""
+	return Path(folder) / f"{barcode_reference}-{barcode_query}{EXPORT_SUFFIX}"
+
+
+def read_transform(path: Union[str, Path], invert: bool = False) -> numpy.ndarray:
+	"""
+		Reads the 3x3 matrix from a `*.transform.calculated.json` file written by `MainGui.export_data`.
+		Files in the original export format (point pairs only) are solved on the fly.
+
+		The saved matrix maps reference coordinates onto query coordinates, since it is solved as
+		`solve_affine(coordinates_reference, coordinates_query)`.
+		Parameters
+		----------
+		path: str | Path
+			The exported json file.
+		invert: bool = False
+			Return the inverse matrix, which maps query coordinates into the reference frame.
+	"""
+	data = json.loads(Path(path).read_text())
+	if 'matrix' in data:
+		matrix = numpy.array(data['matrix'], dtype = numpy.float64)
+	elif 'transform:coordinates' in data:
+		table = pandas.DataFrame(data['transform:coordinates'])
+		matrix = solve_affine(table[['left:x', 'left:y']].values, table[['right:x', 'right:y']].values)
+	else:
+		message = f"The file '{path}' does not contain a transform matrix or point pairs."
+		raise ValueError(message)
+
+	if matrix.shape == (2, 3):
+		matrix = numpy.vstack((matrix, [0, 0, 1]))
+	if invert:
+		matrix = numpy.linalg.inv(matrix)
 	return matrix
 
-def apply_transform(matrix: numpy.ndarray, coordinates: numpy.ndarray, dropz: bool = True) -> numpy.ndarray:
+
+def is_affine(matrix: numpy.ndarray) -> bool:
+	""" Checks whether a 3x3 matrix has the affine bottom row [0, 0, 1]."""
+	matrix = numpy.asarray(matrix)
+	return matrix.shape == (2, 3) or (matrix.shape == (3, 3) and numpy.array_equal(matrix[2], [0, 0, 1]))
+
+
+def apply_transform(
+		matrix: numpy.ndarray, coordinates: numpy.ndarray, dropz: bool = True, out: numpy.ndarray = None,
+		dtype: numpy.dtype = None, chunk_size: int = DEFAULT_CHUNK_SIZE) -> numpy.ndarray:
 	"""
-		Transforms a coordinate array using the given affine transform
+		Transforms a coordinate array using the given affine transform.
+
+		The points are processed in chunks and written straight into the output as x' = a*x + b*y + c and
+		y' = d*x + e*y + f, so no homogeneous copy of the input is ever made and the input may be a memory-mapped array.
 		Parameters
 		----------
 		matrix: numpy.ndarray
-			The affine transformation matrix
+			The 3x3 (or 2x3) transformation matrix. Projective matrices are divided through by the homogeneous coordinate.
 		coordinates: numpy.ndarray
-			The coordinates to transform
+			[n, 2] array of the coordinates to transform.
 		dropz:bool = True
 			When True, the z axis of the transformed array will be dropped.
+		out: numpy.ndarray = None
+			Optional preallocated [n, 2] (or [n, 3] when `dropz` is False) array, which may be a memmap, to write the result into.
+		dtype: numpy.dtype = None
+			The dtype of the result when `out` is not given. Defaults to float32 for float32 input and float64 otherwise.
+		chunk_size: int
+			The number of points transformed at a time.
 	"""
-	# Check if the input coordinate array already includes the third (z) column.
+	if not isinstance(coordinates, numpy.ndarray):
+		coordinates = coerce_to_array(coordinates)
+	if coordinates.ndim != 2 or coordinates.shape[1] < 2:
+		message = f"Expected an array of points with shape [n, 2], got {coordinates.shape}"
+		raise ValueError(message)
+	matrix = numpy.asarray(matrix, dtype = numpy.float64)
+	if matrix.shape == (2, 3):
+		matrix = numpy.vstack((matrix, [0, 0, 1]))
+	if matrix.shape != (3, 3):
+		message = f"Invalid matrix dimentions for the transform: {matrix.shape=}"
+		raise ValueError(message)
+	affine = is_affine(matrix)
 
-	coordinates_other = format_coordinates(coordinates)
-	result = matrix_multiplication(matrix, coordinates_other)
+	if out is None:
+		if dtype is None:
+			dtype = numpy.float32 if coordinates.dtype == numpy.float32 else numpy.float64
+		out = numpy.empty((len(coordinates), 2 if dropz else 3), dtype = dtype)
+	elif out.shape != (len(coordinates), 2 if dropz else 3):
+		message = f"The output array has shape {out.shape}, expected {(len(coordinates), 2 if dropz else 3)}"
+		raise ValueError(message)
 
-	# Convert back to an mxn array, where each row representats a single point.
-	result = result.transpose()
+	compute_dtype = out.dtype if out.dtype in (numpy.float32, numpy.float64) else numpy.float64
+	coefficients = matrix.astype(compute_dtype)
+	scratch = numpy.empty(min(chunk_size, len(coordinates)), dtype = compute_dtype)
+	denominator = numpy.empty_like(scratch) if not affine else None
 
-	# Remove the z column
-	if dropz:
-		result = result[:, :2]
+	for chunk in iterate_chunks(len(coordinates), chunk_size):
+		x = numpy.asarray(coordinates[chunk, 0], dtype = compute_dtype)
+		y = numpy.asarray(coordinates[chunk, 1], dtype = compute_dtype)
+		temporary = scratch[:len(x)]
+		if not affine:
+			w = denominator[:len(x)]
+			numpy.multiply(x, coefficients[2, 0], out = w)
+			numpy.multiply(y, coefficients[2, 1], out = temporary)
+			w += temporary
+			w += coefficients[2, 2]
+			if not dropz:
+				out[chunk, 2] = w
+
+		for row in range(2):
+			if out.dtype == compute_dtype:
+				target = out[chunk, row]
+			else:
+				target = numpy.empty_like(temporary)
+			numpy.multiply(x, coefficients[row, 0], out = target)
+			numpy.multiply(y, coefficients[row, 1], out = temporary)
+			target += temporary
+			target += coefficients[row, 2]
+			if not affine and dropz:
+				target /= w
+			if out.dtype != compute_dtype:
+				out[chunk, row] = target
+
+		if affine and not dropz:
+			out[chunk, 2] = 1
 
-	return result
\ No newline at end of file
+	return out
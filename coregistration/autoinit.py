@@ -0,0 +1,166 @@
+"""
+	Estimates a coarse reference -> query similarity transform (rotation, scale and translation) without any clicked
+	points, by Fourier-Mellin phase correlation of downsampled channels.
+
+	The magnitude of an image's Fourier transform ignores translation, and in log-polar coordinates a rotation or a
+	scaling of the image becomes a shift. Phase correlating the log-polar magnitude spectra therefore recovers the
+	rotation and scale, after which a second phase correlation of the rotated/scaled image recovers the translation.
+"""
+import math
+from dataclasses import dataclass
+from typing import *
+
+import numpy
+from loguru import logger
+
+from coregistration import pointrefinement, warping
+
+DEFAULT_RESOLUTION = 256
+DEFAULT_ANGLES = 360
+
+
+@dataclass
+class InitialTransform:
+	"""
+		Parameters
+		----------
+		matrix: numpy.ndarray
+			The 3x3 similarity transform mapping reference pixel coordinates onto query pixel coordinates, the same
+			direction as the matrices the GUI exports.
+		rotation: float
+			The rotation in degrees.
+		scale: float
+		translation: Tuple[float, float]
+			The (x, y) translation of `matrix`, in full-resolution query pixels.
+		score: float
+			The translation correlation peak (0 to 1). Values below ~0.1 usually mean the estimate failed.
+	"""
+	matrix: numpy.ndarray
+	rotation: float
+	scale: float
+	translation: Tuple[float, float]
+	score: float
+
+
+def downsample(image: numpy.ndarray, factor: int) -> numpy.ndarray:
+	""" Block-averages a [height, width] array by an integer factor, dropping the incomplete last blocks."""
+	image = numpy.asarray(image)
+	if factor <= 1:
+		return image.astype(numpy.float32)
+	height, width = (image.shape[0] // factor) * factor, (image.shape[1] // factor) * factor
+	blocks = image[:height, :width].reshape(height // factor, factor, width // factor, factor)
+	return blocks.mean(axis = (1, 3), dtype = numpy.float32)
+
+
+def _to_canvas(image: numpy.ndarray, size: int) -> numpy.ndarray:
+	""" Mean-subtracts and Hann-windows `image`, then places it in the top-left corner of a zero [size, size] canvas."""
+	window = numpy.outer(numpy.hanning(image.shape[0]), numpy.hanning(image.shape[1])).astype(numpy.float32)
+	canvas = numpy.zeros((size, size), dtype = numpy.float32)
+	canvas[:image.shape[0], :image.shape[1]] = (image - image.mean()) * window
+	return canvas
+
+
+def _highpass(size: int) -> numpy.ndarray:
+	""" The (1 - X)(2 - X) filter of Reddy & Chatterji, which suppresses the low frequencies dominating every spectrum."""
+	frequencies = numpy.fft.fftshift(numpy.fft.fftfreq(size))
+	x = numpy.outer(numpy.cos(numpy.pi * frequencies), numpy.cos(numpy.pi * frequencies))
+	return (1 - x) * (2 - x)
+
+
+def log_polar_magnitude(canvas: numpy.ndarray, angles: int = DEFAULT_ANGLES) -> Tuple[numpy.ndarray, float]:
+	"""
+		Resamples the high-pass filtered Fourier magnitude of a square canvas onto a log-polar grid.
+		Returns
+		-------
+		Tuple[numpy.ndarray, float]
+			The [angles, radii] map covering angles [0, pi) (the magnitude is symmetric), and the log-radius step.
+	"""
+	size = canvas.shape[0]
+	magnitude = numpy.abs(numpy.fft.fftshift(numpy.fft.fft2(canvas))) * _highpass(size)
+	radii = size // 2
+	log_step = math.log(radii) / radii
+	radius = numpy.exp(numpy.arange(radii) * log_step)
+	theta = numpy.arange(angles) * numpy.pi / angles
+	x = size / 2 + radius[None, :] * numpy.cos(theta[:, None])
+	y = size / 2 + radius[None, :] * numpy.sin(theta[:, None])
+	return pointrefinement.sample_bilinear(magnitude, x, y), log_step
+
+
+def _similarity(rotation: float, scale: float, center: Tuple[float, float]) -> numpy.ndarray:
+	""" A rotation (radians) and scaling about `center`."""
+	cosine, sine = scale * math.cos(rotation), scale * math.sin(rotation)
+	linear = numpy.array([[cosine, -sine], [sine, cosine]])
+	matrix = numpy.eye(3)
+	matrix[:2, :2] = linear
+	matrix[:2, 2] = numpy.asarray(center) - linear @ numpy.asarray(center)
+	return matrix
+
+
+def estimate_similarity(
+		image_reference: numpy.ndarray, image_query: numpy.ndarray, resolution: int = DEFAULT_RESOLUTION,
+		angles: int = DEFAULT_ANGLES) -> InitialTransform:
+	"""
+		Estimates the similarity transform between two single-channel images, such as the Brightfield channels read by
+		`MainGui.load_group`.
+		Parameters
+		----------
+		image_reference, image_query: numpy.ndarray
+			[height, width] arrays.
+		resolution: int = 256
+			Both images are block-averaged by the same factor until their larger side is at most this many pixels.
+		angles: int = 360
+			The number of angular samples over 180 degrees, i.e. the rotation resolution is 180 / angles degrees.
+	"""
+	factor = max(1, math.ceil(max(*image_reference.shape, *image_query.shape) / resolution))
+	reference = downsample(image_reference, factor)
+	query = downsample(image_query, factor)
+	# Twice the image size, so translations of up to a full image do not wrap around.
+	size = 2 * max(*reference.shape, *query.shape)
+	size += size % 2
+
+	canvas_reference = _to_canvas(reference, size)
+	canvas_query = _to_canvas(query, size)
+	polar_reference, log_step = log_polar_magnitude(canvas_reference, angles = angles)
+	polar_query, _ = log_polar_magnitude(canvas_query, angles = angles)
+	# The angle axis is periodic, the log-radius axis is not, so only the latter is tapered.
+	taper = numpy.hanning(polar_reference.shape[1])[None, :]
+	shifts, _ = pointrefinement.phase_correlate(
+		((polar_reference - polar_reference.mean()) * taper)[None], ((polar_query - polar_query.mean()) * taper)[None]
+	)
+	shift_radius, shift_angle = shifts[0]
+
+	# A rotation of the image rotates its spectrum the same way, while scaling the image by s shrinks the spectrum by s.
+	scale = math.exp(-float(shift_radius) * log_step)
+	rotation = float(shift_angle) * math.pi / angles
+
+	# The magnitude spectrum cannot tell theta from theta + 180 degrees; keep whichever gives the better translation peak.
+	center = (reference.shape[1] / 2, reference.shape[0] / 2)
+	candidates = list()
+	for candidate_rotation in (rotation, rotation + math.pi):
+		matrix = _similarity(candidate_rotation, scale, center)
+		rotated = warping.warp_array(reference, numpy.linalg.inv(matrix), reference.shape, threads = 1, fill_value = float(reference.mean()))
+		shifts, scores = pointrefinement.phase_correlate(_to_canvas(rotated, size)[None], canvas_query[None])
+		translated = numpy.eye(3)
+		translated[:2, 2] = shifts[0]
+		candidates.append((float(scores[0]), candidate_rotation, translated @ matrix))
+	score, rotation, matrix = max(candidates, key = lambda candidate: candidate[0])
+
+	# Back to full-resolution pixels. Block i covers the full-resolution pixels [i * factor, (i + 1) * factor), so its
+	# center lies at factor * i + (factor - 1) / 2.
+	rotation = (rotation + math.pi) % (2 * math.pi) - math.pi
+	to_full = numpy.diag([factor, factor, 1.0])
+	to_full[:2, 2] = (factor - 1) / 2
+	matrix = to_full @ matrix @ numpy.linalg.inv(to_full)
+	result = InitialTransform(
+		matrix = matrix, rotation = math.degrees(rotation), scale = scale,
+		translation = (float(matrix[0, 2]), float(matrix[1, 2])), score = score
+	)
+	logger.debug(f"Initial transform: rotation {result.rotation:.1f} degrees, scale {result.scale:.3f}, translation ({result.translation[0]:.0f}, {result.translation[1]:.0f}), score {result.score:.2f}")
+	return result
+
+
+def predict_view(matrix: numpy.ndarray, x_range: Tuple[float, float], y_range: Tuple[float, float]) -> Tuple[Tuple[float, float], Tuple[float, float]]:
+	""" The axis-aligned query-image region covering a reference-image view, for pre-positioning the query view."""
+	corners = numpy.array([[x, y, 1] for x in x_range for y in y_range], dtype = numpy.float64) @ numpy.asarray(matrix).T
+	corners = corners[:, :2] / corners[:, 2:]
+	return (float(corners[:, 0].min()), float(corners[:, 0].max())), (float(corners[:, 1].min()), float(corners[:, 1].max()))
@@ -0,0 +1,238 @@
+"""
+	Matches cells across registered sections: after the query cell centroids have been transformed into the reference
+	frame, every query cell is paired with the reference cell at the same position.
+
+	The reference centroids are indexed once with a KD-tree, and the query centroids are looked up in chunks, so memory
+	stays proportional to the number of cells rather than to the product of both counts. One-to-one assignment resolves
+	conflicts (two query cells claiming the same reference cell) by giving each reference cell to its closest claimant,
+	which is the same as greedily accepting the shortest candidate pairs first.
+"""
+from dataclasses import dataclass
+from typing import *
+
+import numpy
+import pandas
+from loguru import logger
+
+from coregistration import affinetransform, transformmodels
+
+DEFAULT_CHUNK_SIZE = 2 ** 18
+DEFAULT_CANDIDATES = 4
+
+
+def _import_scipy_spatial():
+	try:
+		import scipy.spatial
+	except ImportError as exception:
+		message = f"Indexing cell centroids requires the `scipy` package."
+		raise ImportError(message) from exception
+	return scipy.spatial
+
+
+@dataclass
+class CellMatches:
+	"""
+		Parameters
+		----------
+		indices_reference, indices_query: numpy.ndarray
+			The row indices of each matched pair of cells.
+		distances: numpy.ndarray
+			The distance between the (transformed) centroids of each pair.
+		offsets: numpy.ndarray
+			[m, 2] reference minus query centroid of each pair. A mean offset away from zero means the transform is biased.
+		count_reference, count_query: int
+			The number of cells in each input.
+	"""
+	indices_reference: numpy.ndarray
+	indices_query: numpy.ndarray
+	distances: numpy.ndarray
+	offsets: numpy.ndarray
+	count_reference: int
+	count_query: int
+
+	def __len__(self) -> int:
+		return len(self.distances)
+
+	def statistics(self) -> Dict[str, Any]:
+		""" A JSON-compatible summary of the matching."""
+		matched = len(self)
+		summary = {
+			'cells:reference':    self.count_reference,
+			'cells:query':        self.count_query,
+			'matched':            matched,
+			'fraction:reference': matched / self.count_reference if self.count_reference else None,
+			'fraction:query':     matched / self.count_query if self.count_query else None
+		}
+		if matched:
+			summary.update({
+				'distance:mean':   float(self.distances.mean()),
+				'distance:median': float(numpy.median(self.distances)),
+				'distance:p90':    float(numpy.percentile(self.distances, 90)),
+				'offset:x':        float(self.offsets[:, 0].mean()),
+				'offset:y':        float(self.offsets[:, 1].mean())
+			})
+		return summary
+
+	def to_dataframe(self) -> pandas.DataFrame:
+		return pandas.DataFrame({
+			'index:reference': self.indices_reference,
+			'index:query':     self.indices_query,
+			'distance':        self.distances
+		})
+
+
+class CellIndex:
+	"""
+		A KD-tree over reference cell centroids, queried in chunks.
+		Parameters
+		----------
+		points: numpy.ndarray
+			[n, 2] reference centroids.
+		chunk_size: int = 262144
+			The number of query points looked up at a time.
+	"""
+
+	def __init__(self, points: numpy.ndarray, chunk_size: int = DEFAULT_CHUNK_SIZE):
+		spatial = _import_scipy_spatial()
+		self.points = affinetransform.coerce_to_array(points, dtype = numpy.float64)
+		self.chunk_size = chunk_size
+		self.tree = spatial.cKDTree(self.points, balanced_tree = False, compact_nodes = False)
+
+	def __len__(self) -> int:
+		return len(self.points)
+
+	def nearest(self, points: numpy.ndarray, k: int = 1, max_distance: float = numpy.inf) -> Tuple[numpy.ndarray, numpy.ndarray]:
+		"""
+			The `k` nearest reference cells of each point.
+			Returns
+			-------
+			Tuple[numpy.ndarray, numpy.ndarray]
+				[n, k] distances (inf where fewer than k cells lie within `max_distance`) and [n, k] reference indices
+				(`len(self)` where missing).
+		"""
+		points = affinetransform.coerce_to_array(points, dtype = numpy.float64)
+		distances = numpy.empty((len(points), k))
+		indices = numpy.empty((len(points), k), dtype = numpy.intp)
+		for chunk in affinetransform.iterate_chunks(len(points), self.chunk_size):
+			chunk_distances, chunk_indices = self.tree.query(points[chunk], k = k, distance_upper_bound = max_distance, workers = -1)
+			distances[chunk] = numpy.reshape(chunk_distances, (-1, k))
+			indices[chunk] = numpy.reshape(chunk_indices, (-1, k))
+		return distances, indices
+
+	def within(self, points: numpy.ndarray, radius: float) -> Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+		"""
+			Every (point, reference cell) pair closer than `radius`.
+			Returns
+			-------
+			Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]
+				The point indices, reference indices and distances of the pairs, sorted by point.
+		"""
+		points = affinetransform.coerce_to_array(points, dtype = numpy.float64)
+		sources, targets = list(), list()
+		for chunk in affinetransform.iterate_chunks(len(points), self.chunk_size):
+			neighbours = self.tree.query_ball_point(points[chunk], r = radius, workers = -1)
+			counts = numpy.fromiter((len(item) for item in neighbours), dtype = numpy.intp, count = len(neighbours))
+			sources.append(numpy.repeat(numpy.arange(chunk.start, chunk.start + len(neighbours)), counts))
+			targets.append(numpy.fromiter((index for item in neighbours for index in item), dtype = numpy.intp, count = int(counts.sum())))
+		sources = numpy.concatenate(sources) if sources else numpy.empty(0, dtype = numpy.intp)
+		targets = numpy.concatenate(targets) if targets else numpy.empty(0, dtype = numpy.intp)
+		distances = numpy.hypot(*(points[sources] - self.points[targets]).T)
+		return sources, targets, distances
+
+	def count_within(self, points: numpy.ndarray, radius: float) -> numpy.ndarray:
+		""" The number of reference cells within `radius` of each point, without building the pair lists."""
+		points = affinetransform.coerce_to_array(points, dtype = numpy.float64)
+		counts = numpy.empty(len(points), dtype = numpy.intp)
+		for chunk in affinetransform.iterate_chunks(len(points), self.chunk_size):
+			counts[chunk] = self.tree.query_ball_point(points[chunk], r = radius, workers = -1, return_length = True)
+		return counts
+
+
+def assign_one_to_one(sources: numpy.ndarray, targets: numpy.ndarray, distances: numpy.ndarray) -> numpy.ndarray:
+	"""
+		Selects candidate pairs so that every source and every target is used at most once, preferring short pairs. Each
+		round accepts the pairs that are the closest remaining candidate of both their source and their target, which
+		reproduces the greedy shortest-first assignment in a few vectorized passes.
+		Returns
+		-------
+		numpy.ndarray
+			The indices of the selected candidate pairs.
+	"""
+	order = numpy.lexsort((targets, sources, distances))
+	sources, targets = sources[order], targets[order]
+	remaining = numpy.arange(len(order))
+	selected = list()
+	while len(remaining):
+		# The candidates are sorted by distance, so the first occurrence of a source or target is its best candidate.
+		best_source = numpy.zeros(len(remaining), dtype = bool)
+		best_source[numpy.unique(sources[remaining], return_index = True)[1]] = True
+		best_target = numpy.zeros(len(remaining), dtype = bool)
+		best_target[numpy.unique(targets[remaining], return_index = True)[1]] = True
+		accepted = remaining[best_source & best_target]
+		selected.append(accepted)
+		used_sources = numpy.isin(sources[remaining], sources[accepted])
+		used_targets = numpy.isin(targets[remaining], targets[accepted])
+		remaining = remaining[~(used_sources | used_targets)]
+	selected = numpy.concatenate(selected) if selected else numpy.empty(0, dtype = numpy.intp)
+	return numpy.sort(order[selected])
+
+
+def match_cells(
+		points_reference: numpy.ndarray, points_query: numpy.ndarray, max_distance: float,
+		candidates: int = DEFAULT_CANDIDATES, one_to_one: bool = True, index: CellIndex = None) -> CellMatches:
+	"""
+		Pairs query cells with reference cells.
+		Parameters
+		----------
+		points_reference: numpy.ndarray
+			[n, 2] reference centroids.
+		points_query: numpy.ndarray
+			[m, 2] query centroids, already transformed into the reference frame.
+		max_distance: float
+			Pairs further apart than this are never matched, in reference pixels (roughly a cell radius).
+		candidates: int = 4
+			The number of nearest reference cells considered per query cell when resolving conflicts.
+		one_to_one: bool = True
+			If False, every query cell simply takes its nearest reference cell, so reference cells may be matched twice.
+		index: CellIndex = None
+			A prebuilt index of `points_reference`, to reuse it across several queries.
+	"""
+	index = index if index is not None else CellIndex(points_reference)
+	points_query = affinetransform.coerce_to_array(points_query, dtype = numpy.float64)
+	distances, indices = index.nearest(points_query, k = candidates if one_to_one else 1, max_distance = max_distance)
+	valid = numpy.isfinite(distances)
+	sources = numpy.broadcast_to(numpy.arange(len(points_query))[:, None], distances.shape)[valid]
+	targets, distances = indices[valid], distances[valid]
+	if one_to_one:
+		selected = assign_one_to_one(sources, targets, distances)
+		sources, targets, distances = sources[selected], targets[selected], distances[selected]
+
+	result = CellMatches(
+		indices_reference = targets, indices_query = sources, distances = distances,
+		offsets = index.points[targets] - points_query[sources], count_reference = len(index), count_query = len(points_query)
+	)
+	logger.debug(f"Matched {len(result)} of {len(points_query)} query cells to {len(index)} reference cells within {max_distance}px")
+	return result
+
+
+def match_tables(
+		table_reference: pandas.DataFrame, table_query: pandas.DataFrame, max_distance: float,
+		transform: Union[numpy.ndarray, transformmodels.TransformModel] = None, columns: Tuple[str, str] = ('x', 'y'),
+		**kwargs) -> CellMatches:
+	"""
+		Matches the cells of two cell tables. See `match_cells` for the other parameters.
+		Parameters
+		----------
+		transform: numpy.ndarray | TransformModel = None
+			Maps query coordinates into the reference frame, e.g. `affinetransform.read_transform(path, invert = True)` or
+			`TransformGraph.get(query, reference)`. Without it the query coordinates are assumed to be registered already.
+	"""
+	for table in (table_reference, table_query):
+		missing = [column for column in columns if column not in table.columns]
+		if missing:
+			message = f"The table does not contain the coordinate columns {missing}. Available columns: {list(table.columns)}"
+			raise ValueError(message)
+	points_query = table_query[list(columns)].to_numpy(dtype = numpy.float64)
+	if transform is not None:
+		points_query = transformmodels.coerce_transform(transform).apply(points_query)
+	return match_cells(table_reference[list(columns)].to_numpy(dtype = numpy.float64), points_query, max_distance, **kwargs)
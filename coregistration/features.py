@@ -0,0 +1,289 @@
+"""
+	Automatic point correspondences between two single-channel images: multi-scale Harris corners, oriented binary
+	(steered BRIEF) descriptors, and vectorized Hamming-distance matching with a ratio test and a mutual-consistency check.
+
+	The matches can be passed straight to `affinetransform.solve_affine` or, better, to `robustestimation.ransac_affine`
+	(see `estimate_transform`).
+"""
+import math
+from dataclasses import dataclass
+from typing import *
+
+import numpy
+from loguru import logger
+
+from coregistration import intensityregistration, pointrefinement, robustestimation
+
+PATCH_RADIUS = 15
+DESCRIPTOR_BITS = 256
+HARRIS_K = 0.04
+DEFAULT_MAX_KEYPOINTS = 2000
+MATCH_CHUNK_SIZE = 512
+# The number of set bits of every byte, for numpy < 2.0 which has no `numpy.bitwise_count`.
+BYTE_POPCOUNT = numpy.array([bin(value).count('1') for value in range(256)], dtype = numpy.uint8)
+
+
+@dataclass
+class Keypoints:
+	"""
+		Parameters
+		----------
+		points: numpy.ndarray
+			[n, 2] (x, y) positions in full-resolution pixels.
+		levels: numpy.ndarray
+			The pyramid level each keypoint was detected on (its scale is 2 ** level).
+		responses: numpy.ndarray
+			The Harris response.
+		angles: numpy.ndarray
+			The orientation in radians, from the intensity centroid of the surrounding patch.
+		descriptors: numpy.ndarray
+			[n, DESCRIPTOR_BITS // 8] packed binary descriptors.
+	"""
+	points: numpy.ndarray
+	levels: numpy.ndarray
+	responses: numpy.ndarray
+	angles: numpy.ndarray
+	descriptors: numpy.ndarray
+
+	def __len__(self) -> int:
+		return len(self.points)
+
+
+@dataclass
+class Matches:
+	"""
+		Parameters
+		----------
+		points_reference, points_query: numpy.ndarray
+			[m, 2] matched (x, y) positions.
+		distances: numpy.ndarray
+			The Hamming distance of each match.
+		indices_reference, indices_query: numpy.ndarray
+			The indices of the matched keypoints.
+	"""
+	points_reference: numpy.ndarray
+	points_query: numpy.ndarray
+	distances: numpy.ndarray
+	indices_reference: numpy.ndarray
+	indices_query: numpy.ndarray
+
+	def __len__(self) -> int:
+		return len(self.distances)
+
+
+def _sampling_pattern(bits: int = DESCRIPTOR_BITS, radius: int = PATCH_RADIUS, seed: int = 0) -> numpy.ndarray:
+	""" The fixed [bits, 2, 2] test-pair offsets of the descriptor, drawn from an isotropic Gaussian inside the patch."""
+	generator = numpy.random.default_rng(seed)
+	pattern = numpy.clip(numpy.rint(generator.normal(scale = radius / 2.5, size = (bits, 2, 2))), -radius, radius)
+	return pattern.astype(numpy.float32)
+
+
+SAMPLING_PATTERN = _sampling_pattern()
+
+
+def maximum_filter(image: numpy.ndarray, radius: int) -> numpy.ndarray:
+	""" The maximum over a (2 * radius + 1) square window, as two separable passes of shifted maxima."""
+	result = image
+	for axis in (0, 1):
+		padding = [(0, 0), (0, 0)]
+		padding[axis] = (radius, radius)
+		padded = numpy.pad(result, padding, mode = 'constant', constant_values = -numpy.inf)
+		length = result.shape[axis]
+		index = [slice(None), slice(None)]
+		index[axis] = slice(0, length)
+		maximum = padded[tuple(index)].copy()
+		for offset in range(1, 2 * radius + 1):
+			index[axis] = slice(offset, offset + length)
+			numpy.maximum(maximum, padded[tuple(index)], out = maximum)
+		result = maximum
+	return result
+
+
+def harris_response(image: numpy.ndarray, sigma: float = 1.5) -> numpy.ndarray:
+	gradient_y, gradient_x = numpy.gradient(image)
+	xx = intensityregistration.gaussian_blur(gradient_x * gradient_x, sigma)
+	yy = intensityregistration.gaussian_blur(gradient_y * gradient_y, sigma)
+	xy = intensityregistration.gaussian_blur(gradient_x * gradient_y, sigma)
+	return xx * yy - xy * xy - HARRIS_K * (xx + yy) ** 2
+
+
+def _select_spread(points: numpy.ndarray, responses: numpy.ndarray, count: int, cell_size: int) -> numpy.ndarray:
+	""" Indices of up to `count` strongest points, taking at most an equal share from each grid cell so that keypoints cover the whole image."""
+	if len(points) <= count:
+		return numpy.argsort(-responses)
+	cells = (points[:, 1] // cell_size) * 100_003 + points[:, 0] // cell_size
+	order = numpy.lexsort((-responses, cells))
+	sorted_cells = cells[order]
+	starts = numpy.flatnonzero(numpy.r_[True, sorted_cells[1:] != sorted_cells[:-1]])
+	rank = numpy.arange(len(order)) - numpy.repeat(starts, numpy.diff(numpy.r_[starts, len(order)]))
+	per_cell = max(1, math.ceil(count / len(starts)))
+	keep = order[rank < per_cell]
+	return keep[numpy.argsort(-responses[keep])][:count]
+
+
+def detect_keypoints(
+		image: numpy.ndarray, max_keypoints: int = DEFAULT_MAX_KEYPOINTS, levels: int = 4,
+		threshold: float = 1E-4, nms_radius: int = 3) -> Keypoints:
+	"""
+		Detects oriented multi-scale corners and computes their descriptors.
+		Parameters
+		----------
+		image: numpy.ndarray
+			A [height, width] channel, e.g. Brightfield.
+		max_keypoints: int = 2000
+			The number of keypoints kept over all levels, spread over the image.
+		levels: int = 4
+			The number of pyramid levels (scales 1, 2, 4, ...) searched.
+		threshold: float = 1E-4
+			The minimum Harris response, relative to the strongest response of the level.
+		nms_radius: int = 3
+			The radius of the non-maximum suppression window.
+	"""
+	image = numpy.asarray(image, dtype = numpy.float32)
+	levels = max(1, min(levels, intensityregistration.get_level_count(image.shape, min_size = 4 * PATCH_RADIUS)))
+	pyramid = intensityregistration.build_pyramid(image, levels)
+	margin = int(math.ceil(PATCH_RADIUS * math.sqrt(2))) + 2
+
+	results = list()
+	for level, layer in enumerate(pyramid):
+		response = harris_response(layer)
+		peak = response.max()
+		if peak <= 0:
+			continue
+		is_peak = (response == maximum_filter(response, nms_radius)) & (response > threshold * peak)
+		is_peak[:margin] = is_peak[-margin:] = False
+		is_peak[:, :margin] = is_peak[:, -margin:] = False
+		rows, columns = numpy.nonzero(is_peak)
+		if not len(rows):
+			continue
+		positions = numpy.column_stack((columns, rows))
+		share = max(1, math.ceil(max_keypoints / (2 ** level)))
+		keep = _select_spread(positions, response[rows, columns], share, cell_size = 8 * PATCH_RADIUS)
+		positions = positions[keep]
+		smoothed = intensityregistration.gaussian_blur(layer, 2.0)
+		angles = _orientation(smoothed, positions)
+		descriptors = _describe(smoothed, positions, angles)
+		results.append((positions * 2 ** level, numpy.full(len(positions), level), response[rows[keep], columns[keep]] / peak, angles, descriptors))
+
+	if not results:
+		empty = numpy.empty((0, 2))
+		return Keypoints(empty, numpy.empty(0, dtype = int), numpy.empty(0), numpy.empty(0), numpy.empty((0, DESCRIPTOR_BITS // 8), dtype = numpy.uint8))
+	points, point_levels, responses, angles, descriptors = (numpy.concatenate(items) for items in zip(*results))
+	keep = _select_spread(points, responses, max_keypoints, cell_size = 8 * PATCH_RADIUS)
+	return Keypoints(
+		points = points[keep].astype(numpy.float64), levels = point_levels[keep], responses = responses[keep],
+		angles = angles[keep], descriptors = descriptors[keep]
+	)
+
+
+def _orientation(image: numpy.ndarray, positions: numpy.ndarray) -> numpy.ndarray:
+	""" The angle of the intensity centroid of the circular patch around each (integer) position."""
+	offsets_y, offsets_x = numpy.mgrid[-PATCH_RADIUS:PATCH_RADIUS + 1, -PATCH_RADIUS:PATCH_RADIUS + 1]
+	inside = offsets_x ** 2 + offsets_y ** 2 <= PATCH_RADIUS ** 2
+	offsets_x, offsets_y = offsets_x[inside], offsets_y[inside]
+	values = image[positions[:, 1, None] + offsets_y[None, :], positions[:, 0, None] + offsets_x[None, :]]
+	values = values - values.mean(axis = 1, keepdims = True)
+	return numpy.arctan2(values @ offsets_y, values @ offsets_x)
+
+
+def _describe(image: numpy.ndarray, positions: numpy.ndarray, angles: numpy.ndarray) -> numpy.ndarray:
+	""" Steered BRIEF: the binary intensity comparisons of the fixed test pairs, rotated to each keypoint's orientation."""
+	cosine, sine = numpy.cos(angles)[:, None, None], numpy.sin(angles)[:, None, None]
+	pattern_x, pattern_y = SAMPLING_PATTERN[None, :, :, 0], SAMPLING_PATTERN[None, :, :, 1]
+	x = positions[:, 0, None, None] + cosine * pattern_x - sine * pattern_y
+	y = positions[:, 1, None, None] + sine * pattern_x + cosine * pattern_y
+	values = pointrefinement.sample_bilinear(image, x, y)
+	return numpy.packbits(values[:, :, 0] < values[:, :, 1], axis = 1)
+
+
+def hamming_distances(descriptors_left: numpy.ndarray, descriptors_right: numpy.ndarray) -> numpy.ndarray:
+	"""
+		The [n, m] Hamming distances between two sets of packed descriptors. Uses `numpy.bitwise_count` (numpy >= 2.0) on
+		64-bit words, or a per-byte lookup table on older numpy versions.
+	"""
+	if not hasattr(numpy, 'bitwise_count'):
+		left, right = numpy.asarray(descriptors_left, dtype = numpy.uint8), numpy.asarray(descriptors_right, dtype = numpy.uint8)
+		return BYTE_POPCOUNT[left[:, None, :] ^ right[None, :, :]].sum(axis = 2, dtype = numpy.int32)
+	left = numpy.ascontiguousarray(descriptors_left).view(numpy.uint64)
+	right = numpy.ascontiguousarray(descriptors_right).view(numpy.uint64)
+	return numpy.bitwise_count(left[:, None, :] ^ right[None, :, :]).sum(axis = 2, dtype = numpy.int32)
+
+
+def _nearest_two(descriptors_left: numpy.ndarray, descriptors_right: numpy.ndarray) -> Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+	""" For every left descriptor: the index of and distance to its nearest right descriptor, and the second-nearest distance."""
+	count = len(descriptors_left)
+	best_index = numpy.empty(count, dtype = numpy.intp)
+	best = numpy.empty(count, dtype = numpy.int32)
+	second = numpy.full(count, numpy.iinfo(numpy.int32).max, dtype = numpy.int32)
+	for start in range(0, count, MATCH_CHUNK_SIZE):
+		chunk = slice(start, start + MATCH_CHUNK_SIZE)
+		distances = hamming_distances(descriptors_left[chunk], descriptors_right)
+		if distances.shape[1] >= 2:
+			nearest = numpy.argpartition(distances, 1, axis = 1)[:, :2]
+			pair = numpy.take_along_axis(distances, nearest, axis = 1)
+			order = numpy.argsort(pair, axis = 1)
+			nearest = numpy.take_along_axis(nearest, order, axis = 1)
+			pair = numpy.take_along_axis(pair, order, axis = 1)
+			best_index[chunk], best[chunk], second[chunk] = nearest[:, 0], pair[:, 0], pair[:, 1]
+		else:
+			best_index[chunk], best[chunk] = 0, distances[:, 0]
+	return best_index, best, second
+
+
+def match_keypoints(
+		keypoints_reference: Keypoints, keypoints_query: Keypoints, ratio: float = 0.8,
+		max_distance: int = 64, mutual: bool = True) -> Matches:
+	"""
+		Matches descriptors by Hamming distance.
+		Parameters
+		----------
+		ratio: float = 0.8
+			Lowe's ratio test: keep a match only if it is clearly closer than the second-best candidate.
+		max_distance: int = 64
+			The largest Hamming distance (of 256 bits) accepted.
+		mutual: bool = True
+			Keep a match only if each keypoint is the other's nearest neighbour.
+	"""
+	if not len(keypoints_reference) or not len(keypoints_query):
+		empty = numpy.empty((0, 2))
+		return Matches(empty, empty, numpy.empty(0, dtype = numpy.int32), numpy.empty(0, dtype = int), numpy.empty(0, dtype = int))
+
+	forward, best, second = _nearest_two(keypoints_reference.descriptors, keypoints_query.descriptors)
+	keep = (best <= max_distance) & (best < ratio * second)
+	if mutual:
+		backward, _, _ = _nearest_two(keypoints_query.descriptors, keypoints_reference.descriptors)
+		keep &= backward[forward] == numpy.arange(len(forward))
+
+	indices_reference = numpy.flatnonzero(keep)
+	indices_query = forward[keep]
+	return Matches(
+		points_reference = keypoints_reference.points[indices_reference],
+		points_query = keypoints_query.points[indices_query],
+		distances = best[keep],
+		indices_reference = indices_reference,
+		indices_query = indices_query
+	)
+
+
+def match_images(image_reference: numpy.ndarray, image_query: numpy.ndarray, max_keypoints: int = DEFAULT_MAX_KEYPOINTS, **kwargs) -> Matches:
+	""" Detects keypoints on both images and matches them. Extra keyword arguments go to `match_keypoints`."""
+	keypoints_reference = detect_keypoints(image_reference, max_keypoints = max_keypoints)
+	keypoints_query = detect_keypoints(image_query, max_keypoints = max_keypoints)
+	matches = match_keypoints(keypoints_reference, keypoints_query, **kwargs)
+	logger.debug(f"Matched {len(matches)} of {len(keypoints_reference)}/{len(keypoints_query)} keypoints")
+	return matches
+
+
+def estimate_transform(
+		image_reference: numpy.ndarray, image_query: numpy.ndarray, threshold: float = 3.0,
+		seed: int = 0, **kwargs) -> Tuple[robustestimation.RansacResult, Matches]:
+	"""
+		Matches keypoints and fits the reference -> query affine transform to the matches with `robustestimation.ransac_affine`.
+		Extra keyword arguments go to `match_images`.
+	"""
+	matches = match_images(image_reference, image_query, **kwargs)
+	if len(matches) < robustestimation.SAMPLE_SIZE:
+		message = f"Only {len(matches)} keypoint matches were found; at least {robustestimation.SAMPLE_SIZE} are needed."
+		raise ValueError(message)
+	result = robustestimation.ransac_affine(matches.points_reference, matches.points_query, threshold = threshold, seed = seed)
+	return result, matches
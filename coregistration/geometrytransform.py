@@ -0,0 +1,259 @@
+"""
+	Transforms GeoJSON annotations (points, lines, polygons and their multi-part/collection variants) with a 3x3 matrix.
+	All vertices of a document (or of a batch of features, in streaming mode) are flattened into one contiguous
+	array, transformed in a single `affinetransform.apply_transform` call, and written back into the geometries.
+
+	Usage:
+		python -m coregistration.geometrytransform --transform A-B.transform.calculated.json --output-folder out/ annotations.geojson
+"""
+import argparse
+import contextlib
+import gc
+import itertools
+import json
+from pathlib import Path
+from typing import *
+
+import numpy
+from loguru import logger
+
+from coregistration import affinetransform, transformmodels
+
+# The nesting depth of the position lists in the `coordinates` member of each geometry type.
+GEOMETRY_DEPTH = {
+	'Point':           0,
+	'MultiPoint':      1,
+	'LineString':      1,
+	'MultiLineString': 2,
+	'Polygon':         2,
+	'MultiPolygon':    3
+}
+LINE_DELIMITED_SUFFIXES = {'.geojsonl', '.geojsons', '.geojsonseq', '.ndjson', '.jsonl'}
+DEFAULT_BATCH_SIZE = 10_000
+
+PositionSlot = Tuple[Union[list, dict], Union[int, str], bool]  # (container, key, is_single_position)
+
+
+def _collect_geometry(geometry: Optional[Dict[str, Any]], slots: List[PositionSlot]):
+	if geometry is None:
+		return
+	kind = geometry['type']
+	if kind == 'GeometryCollection':
+		for member in geometry['geometries']:
+			_collect_geometry(member, slots)
+		return
+	try:
+		depth = GEOMETRY_DEPTH[kind]
+	except KeyError:
+		message = f"Unsupported geometry type: {kind}"
+		raise ValueError(message)
+
+	if depth == 0:
+		slots.append((geometry, 'coordinates', True))
+		return
+	containers = [(geometry, 'coordinates')]
+	for _ in range(depth - 1):
+		containers = [(parent[key], index) for parent, key in containers for index in range(len(parent[key]))]
+	slots.extend((parent, key, False) for parent, key in containers)
+
+
+def collect_positions(data: Union[Dict[str, Any], List[Dict[str, Any]]]) -> List[PositionSlot]:
+	"""
+		Finds every list of positions (ring, line string, multipoint) and every single point position in a GeoJSON
+		object, a Feature, a FeatureCollection or a plain list of features.
+	"""
+	slots = list()
+	if isinstance(data, list):
+		for item in data:
+			slots.extend(collect_positions(item))
+	elif data.get('type') == 'FeatureCollection':
+		for feature in data['features']:
+			_collect_geometry(feature.get('geometry'), slots)
+	elif data.get('type') == 'Feature':
+		_collect_geometry(data.get('geometry'), slots)
+	else:
+		_collect_geometry(data, slots)
+	return slots
+
+
+@contextlib.contextmanager
+def _garbage_collection_paused():
+	""" Building millions of small coordinate lists otherwise triggers repeated (and pointless) cyclic garbage collection."""
+	enabled = gc.isenabled()
+	gc.disable()
+	try:
+		yield
+	finally:
+		if enabled:
+			gc.enable()
+
+
+def transform_positions(slots: List[PositionSlot], matrix: numpy.ndarray):
+	"""
+		Transforms all positions referenced by `slots` in one vectorized pass, replacing them in place. `matrix` may also be
+		a `transformmodels.TransformModel`, e.g. a piecewise-affine transform.
+	"""
+	if not slots:
+		return
+	with _garbage_collection_paused():
+		_transform_positions(slots, matrix)
+
+
+def _transform_positions(slots: List[PositionSlot], matrix: numpy.ndarray):
+	sequences = [[container[key]] if single else container[key] for container, key, single in slots]
+	counts = numpy.fromiter((len(sequence) for sequence in sequences), dtype = numpy.int64, count = len(sequences))
+	offsets = numpy.concatenate(([0], numpy.cumsum(counts))).tolist()
+	positions = list(itertools.chain.from_iterable(sequences))
+	if not positions:
+		# Only empty coordinate lists, which are valid GeoJSON and stay as they are.
+		return
+
+	try:
+		array = numpy.array(positions, dtype = numpy.float64)
+		extra = None
+	except ValueError:
+		# Mixed 2D/3D positions: transform x/y and carry any extra ordinates over unchanged.
+		array = numpy.array([position[:2] for position in positions], dtype = numpy.float64)
+		extra = [position[2:] for position in positions]
+
+	transformed = array.copy()
+	if isinstance(matrix, transformmodels.TransformModel):
+		transformed[:, :2] = matrix.apply(array[:, :2])
+	else:
+		affinetransform.apply_transform(matrix, array[:, :2], out = transformed[:, :2])
+	values = transformed.tolist()
+	if extra is not None:
+		values = [value + rest for value, rest in zip(values, extra)]
+
+	for (container, key, single), start, end in zip(slots, offsets[:-1], offsets[1:]):
+		container[key] = values[start] if single else values[start:end]
+
+
+def transform_geojson(data: Union[Dict[str, Any], List[Dict[str, Any]]], matrix: numpy.ndarray) -> Union[Dict[str, Any], List[Dict[str, Any]]]:
+	""" Transforms every vertex of a GeoJSON object in place and returns it. Any `bbox` members are dropped since they are no longer valid."""
+	transform_positions(collect_positions(data), matrix)
+	_drop_bbox(data)
+	return data
+
+
+def _drop_bbox(data: Union[Dict[str, Any], List[Dict[str, Any]]]):
+	items = data if isinstance(data, list) else [data]
+	for item in items:
+		item.pop('bbox', None)
+		if item.get('type') == 'FeatureCollection':
+			_drop_bbox(item['features'])
+		geometry = item.get('geometry')
+		if isinstance(geometry, dict):
+			geometry.pop('bbox', None)
+
+
+def iter_features(path: Path) -> Iterator[Dict[str, Any]]:
+	"""
+		Yields the features of a GeoJSON file one at a time without loading the whole document.
+		Line-delimited files (one feature per line) are read natively. FeatureCollections and plain feature arrays
+		require the optional `ijson` package.
+	"""
+	path = Path(path)
+	if path.suffix.lower() in LINE_DELIMITED_SUFFIXES:
+		with path.open() as file:
+			for line in file:
+				line = line.strip().lstrip("\x1e")  # RFC 8142 record separators
+				if line:
+					yield json.loads(line)
+		return
+
+	try:
+		import ijson
+	except ImportError as exception:
+		message = f"Streaming a GeoJSON FeatureCollection requires the `ijson` package. Line-delimited GeoJSON can be streamed without it."
+		raise ImportError(message) from exception
+
+	with path.open('rb') as file:
+		first = file.read(1)
+		while first and first.isspace():
+			first = file.read(1)
+		prefix = 'item' if first == b'[' else 'features.item'
+		file.seek(0)
+		yield from ijson.items(file, prefix, use_float = True)
+
+
+def _batched(iterable: Iterable, size: int) -> Iterator[list]:
+	iterator = iter(iterable)
+	while batch := list(itertools.islice(iterator, size)):
+		yield batch
+
+
+def transform_geojson_file(
+		path_input: Path, path_output: Path, matrix: numpy.ndarray, streaming: bool = False,
+		batch_size: int = DEFAULT_BATCH_SIZE) -> int:
+	"""
+		Transforms a GeoJSON file.
+		Parameters
+		----------
+		path_input, path_output: Path
+			The input and output files. Line-delimited files ('.geojsonl', '.ndjson', ...) are written back line-delimited.
+		matrix: numpy.ndarray
+			The 3x3 transform.
+		streaming: bool = False
+			Process the features in batches of `batch_size` so only one batch is held in memory. Only the features of a
+			FeatureCollection are carried over; other top-level members are dropped.
+		Returns
+		-------
+		int
+			The number of features written.
+	"""
+	path_input = Path(path_input)
+	path_output = Path(path_output)
+	line_delimited = path_output.suffix.lower() in LINE_DELIMITED_SUFFIXES
+
+	if not streaming and path_input.suffix.lower() not in LINE_DELIMITED_SUFFIXES:
+		data = transform_geojson(json.loads(path_input.read_text()), matrix)
+		if isinstance(data, list):
+			features = data
+		else:
+			features = data.get('features', [data])
+		if line_delimited:
+			path_output.write_text("".join(json.dumps(feature) + "\n" for feature in features))
+		else:
+			path_output.write_text(json.dumps(data))
+		return len(features)
+
+	count = 0
+	with path_output.open('w') as file:
+		if not line_delimited:
+			file.write('{"type": "FeatureCollection", "features": [')
+		for batch in _batched(iter_features(path_input), batch_size):
+			transform_geojson(batch, matrix)
+			if line_delimited:
+				file.writelines(json.dumps(feature) + "\n" for feature in batch)
+			else:
+				file.write(("," if count else "") + ",".join(json.dumps(feature) for feature in batch))
+			count += len(batch)
+		if not line_delimited:
+			file.write(']}')
+	logger.debug(f"Transformed {count} features from {path_input.name} into {path_output}")
+	return count
+
+
+def main(arguments: List[str] = None):
+	parser = argparse.ArgumentParser(description = "Transform GeoJSON annotations with an exported transform.")
+	parser.add_argument('files', nargs = '+', type = Path)
+	parser.add_argument('--transform', required = True, type = Path, help = "A '*.transform.calculated.json' file written by the GUI.")
+	parser.add_argument('--output-folder', required = True, type = Path)
+	parser.add_argument(
+		'--direction', choices = ['query-to-reference', 'reference-to-query'], default = 'query-to-reference',
+		help = "The exported matrix maps reference to query coordinates; the default applies its inverse."
+	)
+	parser.add_argument('--streaming', action = 'store_true', help = "Process the features in batches instead of loading each file at once.")
+	parser.add_argument('--batch-size', type = int, default = DEFAULT_BATCH_SIZE)
+	args = parser.parse_args(arguments)
+
+	matrix = affinetransform.read_transform(args.transform, invert = args.direction == 'query-to-reference')
+	args.output_folder.mkdir(parents = True, exist_ok = True)
+	for path in args.files:
+		path_output = args.output_folder / f"{path.stem}.reference{path.suffix}"
+		transform_geojson_file(path, path_output, matrix, streaming = args.streaming, batch_size = args.batch_size)
+
+
+if __name__ == "__main__":
+	main()
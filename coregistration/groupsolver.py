@@ -0,0 +1,243 @@
+"""
+	Solves the affine transforms of every image in a group jointly, from point correspondences between any pairs of
+	images, instead of registering each query to the reference on its own.
+
+	Each image i gets the affine H_i mapping its pixels into the reference frame, with H_reference = identity. A
+	correspondence between p in image i and p' in image j asks for H_i p = H_j p', which is linear in the parameters of
+	both transforms, so all transforms are the solution of one sparse linear least-squares problem. The x and y rows
+	share the same design matrix, so the normal matrix has only 3 unknowns per image and is solved once for both
+	coordinates. Sections far from the reference are thereby constrained by their neighbours, and every cycle of
+	pairwise registrations has to agree.
+"""
+import json
+import warnings
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import *
+
+import numpy
+import pandas
+from loguru import logger
+
+from coregistration import affinetransform
+
+def _import_scipy_sparse():
+	try:
+		import scipy.sparse
+		import scipy.sparse.linalg
+	except ImportError as exception:
+		message = f"Solving transforms jointly requires the `scipy` package."
+		raise ImportError(message) from exception
+	return scipy.sparse
+
+
+@dataclass
+class Correspondence:
+	"""
+		Matching points between two images of a group.
+		Parameters
+		----------
+		barcode_left, barcode_right: str
+		points_left, points_right: numpy.ndarray
+			[n, 2] matching pixel coordinates in each image.
+		weights: numpy.ndarray = None
+			Optional non-negative weight per pair.
+	"""
+	barcode_left: str
+	barcode_right: str
+	points_left: numpy.ndarray
+	points_right: numpy.ndarray
+	weights: Optional[numpy.ndarray] = None
+
+
+@dataclass
+class GroupSolution:
+	"""
+		Parameters
+		----------
+		reference: str
+			The barcode whose frame every transform maps into.
+		matrices: Dict[str, numpy.ndarray]
+			The 3x3 matrix of each image, mapping reference coordinates onto that image's coordinates: the same direction
+			as the matrices `MainGui.export_data` writes. The reference's own matrix is the identity.
+		rmse: Dict[str, float]
+			The root-mean-square disagreement, in reference pixels, of the correspondences involving each image.
+		max_error: Dict[str, float]
+		pair_rmse: Dict[Tuple[str, str], float]
+			The root-mean-square disagreement of each correspondence set.
+	"""
+	reference: str
+	matrices: Dict[str, numpy.ndarray]
+	rmse: Dict[str, float] = field(default_factory = dict)
+	max_error: Dict[str, float] = field(default_factory = dict)
+	pair_rmse: Dict[Tuple[str, str], float] = field(default_factory = dict)
+
+	def to_exports(self) -> List[Dict[str, Any]]:
+		""" One record per query image, with the keys `MainGui.export_data` writes."""
+		return [
+			{
+				'barcode:reference': self.reference,
+				'barcode:query':     barcode,
+				'matrix':            matrix.tolist(),
+				'diagnostics':       {'rmse': self.rmse.get(barcode), 'max_error': self.max_error.get(barcode), 'solver': 'group'}
+			}
+			for barcode, matrix in self.matrices.items() if barcode != self.reference
+		]
+
+	def write_exports(self, folder: Union[str, Path]) -> List[Path]:
+		""" Writes `{reference}-{query}.transform.calculated.json` for every query image."""
+		paths = list()
+		for record in self.to_exports():
+			path = affinetransform.get_export_path(folder, record['barcode:reference'], record['barcode:query'])
+			path.write_text(json.dumps(record))
+			paths.append(path)
+		return paths
+
+
+def read_correspondences(paths: Iterable[Union[str, Path]]) -> List[Correspondence]:
+	""" Reads the clicked point pairs of `*.transform.calculated.json` files, in either export format."""
+	correspondences = list()
+	for path in paths:
+		data = json.loads(Path(path).read_text())
+		if 'coordinates:reference' in data:
+			left, right = data['coordinates:reference'], data['coordinates:query']
+		elif 'transform:coordinates' in data:
+			table = pandas.DataFrame(data['transform:coordinates'])
+			left, right = table[['left:x', 'left:y']].values, table[['right:x', 'right:y']].values
+		else:
+			message = f"The file '{path}' does not contain point pairs."
+			raise ValueError(message)
+		correspondences.append(Correspondence(
+			data['barcode:reference'], data['barcode:query'],
+			affinetransform.coerce_to_array(left, dtype = numpy.float64), affinetransform.coerce_to_array(right, dtype = numpy.float64)
+		))
+	return correspondences
+
+
+def _check_connected(correspondences: Sequence[Correspondence], barcodes: List[str], reference: str):
+	neighbours = {barcode: set() for barcode in barcodes}
+	for correspondence in correspondences:
+		neighbours[correspondence.barcode_left].add(correspondence.barcode_right)
+		neighbours[correspondence.barcode_right].add(correspondence.barcode_left)
+	reached = {reference}
+	stack = [reference]
+	while stack:
+		for barcode in neighbours[stack.pop()] - reached:
+			reached.add(barcode)
+			stack.append(barcode)
+	missing = [barcode for barcode in barcodes if barcode not in reached]
+	if missing:
+		message = f"The images {missing} are not connected to the reference '{reference}' by any correspondences."
+		raise ValueError(message)
+
+
+def solve_group(correspondences: Sequence[Correspondence], reference: str) -> GroupSolution:
+	"""
+		Solves the affine transforms of all images named in `correspondences` jointly, keeping `reference` fixed.
+		Parameters
+		----------
+		correspondences: Sequence[Correspondence]
+			Point pairs between any two images. Every image needs at least 3 non-collinear points in total, and must be
+			connected to the reference through the correspondences.
+		reference: str
+			The barcode of the fixed image.
+	"""
+	sparse = _import_scipy_sparse()
+	correspondences = [item for item in correspondences if len(item.points_left)]
+	if not correspondences:
+		message = f"Cannot solve a group without any point correspondences."
+		raise ValueError(message)
+	looped = sorted({item.barcode_left for item in correspondences if item.barcode_left == item.barcode_right}, key = str)
+	if looped:
+		message = f"Correspondences must relate two different images, but {looped} are matched with themselves."
+		raise ValueError(message)
+	barcodes = sorted({item.barcode_left for item in correspondences} | {item.barcode_right for item in correspondences} | {reference}, key = str)
+	_check_connected(correspondences, barcodes, reference)
+	unknowns = [barcode for barcode in barcodes if barcode != reference]
+	column = {barcode: index for index, barcode in enumerate(unknowns)}
+	column[reference] = -1
+
+	points_left, points_right, weights, image_left, image_right, sets = list(), list(), list(), list(), list(), list()
+	for index, item in enumerate(correspondences):
+		left, right, weight = affinetransform.validate_correspondences(item.points_left, item.points_right, item.weights)
+		points_left.append(left.astype(numpy.float64))
+		points_right.append(right.astype(numpy.float64))
+		weights.append(numpy.ones(len(left)) if weight is None else weight.astype(numpy.float64))
+		image_left.append(numpy.full(len(left), column[item.barcode_left]))
+		image_right.append(numpy.full(len(left), column[item.barcode_right]))
+		sets.append(numpy.full(len(left), index))
+	points_left, points_right = numpy.concatenate(points_left), numpy.concatenate(points_right)
+	weights, sets = numpy.concatenate(weights), numpy.concatenate(sets)
+	image_left, image_right = numpy.concatenate(image_left), numpy.concatenate(image_right)
+
+	# Shared normalization of every image's coordinates keeps the normal matrix well conditioned for slide-sized pixels.
+	center = numpy.concatenate((points_left, points_right)).mean(axis = 0)
+	scale = float(numpy.abs(numpy.concatenate((points_left, points_right)) - center).max()) or 1.0
+	normalization = numpy.array([[1 / scale, 0, -center[0] / scale], [0, 1 / scale, -center[1] / scale], [0, 0, 1]])
+	homogeneous_left = numpy.column_stack(((points_left - center) / scale, numpy.ones(len(points_left))))
+	homogeneous_right = numpy.column_stack(((points_right - center) / scale, numpy.ones(len(points_right))))
+
+	# Each pair gives the row [p_left at image_left's columns, -p_right at image_right's columns]; the reference's known
+	# identity transform moves its term to the right-hand side.
+	rows = numpy.arange(len(points_left))
+	blocks = list()
+	for images, values in ((image_left, homogeneous_left), (image_right, -homogeneous_right)):
+		unknown = images >= 0
+		for offset in range(3):
+			blocks.append((rows[unknown], 3 * images[unknown] + offset, values[unknown, offset]))
+	design = sparse.csr_matrix(
+		(numpy.concatenate([block[2] for block in blocks]), (numpy.concatenate([block[0] for block in blocks]), numpy.concatenate([block[1] for block in blocks]))),
+		shape = (len(points_left), 3 * len(unknowns))
+	)
+	rhs = numpy.zeros((len(points_left), 2))
+	rhs -= numpy.where((image_left < 0)[:, None], homogeneous_left[:, :2], 0)
+	rhs += numpy.where((image_right < 0)[:, None], homogeneous_right[:, :2], 0)
+
+	weighted = sparse.diags(weights) @ design
+	normal = (design.T @ weighted).tocsc()
+	# The normal matrix is symmetric, and a symmetric fill-reducing ordering keeps its factorization several times sparser.
+	# A singular matrix makes scipy warn and return NaN; both are turned into the ValueError below.
+	message = f"The transforms are not determined by the correspondences; every image needs at least 3 non-collinear points."
+	with numpy.errstate(all = 'ignore'), warnings.catch_warnings():
+		warnings.simplefilter('error', sparse.linalg.MatrixRankWarning)
+		try:
+			solution = sparse.linalg.spsolve(normal, weighted.T @ rhs, permc_spec = 'MMD_AT_PLUS_A')
+		except sparse.linalg.MatrixRankWarning as exception:
+			raise ValueError(message) from exception
+	solution = numpy.asarray(solution).reshape(3 * len(unknowns), 2)
+	if not numpy.isfinite(solution).all():
+		raise ValueError(message)
+
+	to_reference = {reference: numpy.eye(3)}
+	for barcode, index in column.items():
+		if index >= 0:
+			normalized = numpy.eye(3)
+			normalized[:2] = solution[3 * index:3 * index + 3].T
+			to_reference[barcode] = numpy.linalg.inv(normalization) @ normalized @ normalization
+
+	# The disagreement of each pair in reference pixels. Index -1 (the reference) picks the identity appended last.
+	stacked = numpy.stack([to_reference[barcode] for barcode in unknowns + [reference]])
+	mapped_left = numpy.einsum('nij,nj->ni', stacked[image_left], numpy.column_stack((points_left, numpy.ones(len(points_left)))))[:, :2]
+	mapped_right = numpy.einsum('nij,nj->ni', stacked[image_right], numpy.column_stack((points_right, numpy.ones(len(points_right)))))[:, :2]
+	errors = numpy.hypot(*(mapped_left - mapped_right).T)
+
+	result = GroupSolution(reference = reference, matrices = {barcode: numpy.linalg.inv(matrix) for barcode, matrix in to_reference.items()})
+	pair_squares = numpy.bincount(sets, weights = errors ** 2, minlength = len(correspondences))
+	pair_counts = numpy.bincount(sets, minlength = len(correspondences))
+	for index, item in enumerate(correspondences):
+		result.pair_rmse[(item.barcode_left, item.barcode_right)] = float(numpy.sqrt(pair_squares[index] / pair_counts[index]))
+
+	# Every pair involves two different images; the reference (-1) is shifted onto slot 0 and ignored.
+	image_squares = numpy.zeros(len(unknowns) + 1)
+	image_counts = numpy.zeros(len(unknowns) + 1)
+	image_maximum = numpy.zeros(len(unknowns) + 1)
+	for images in (image_left + 1, image_right + 1):
+		image_squares += numpy.bincount(images, weights = errors ** 2, minlength = len(unknowns) + 1)
+		image_counts += numpy.bincount(images, minlength = len(unknowns) + 1)
+		numpy.maximum.at(image_maximum, images, errors)
+	for barcode in unknowns:
+		slot = column[barcode] + 1
+		result.rmse[barcode] = float(numpy.sqrt(image_squares[slot] / image_counts[slot]))
+		result.max_error[barcode] = float(image_maximum[slot])
+	logger.debug(f"Solved {len(unknowns)} transforms from {len(points_left)} point pairs in {len(correspondences)} sets (RMSE {numpy.sqrt(numpy.mean(errors ** 2)):.3f}px)")
+	return result
@@ -0,0 +1,226 @@
+"""
+	Intensity-based affine registration of two single-channel images without any clicked points.
+
+	Both images are reduced to Gaussian pyramids and the six affine parameters are optimized coarse-to-fine by
+	maximizing the normalized cross-correlation (NCC) between the reference and the warped query. The NCC and its
+	analytic gradient are evaluated on a fixed, seeded subset of reference pixels per level, so every run is
+	deterministic and the work per iteration does not depend on the image size.
+"""
+import math
+from dataclasses import dataclass, field
+from typing import *
+
+import numpy
+from loguru import logger
+
+from coregistration import autoinit, pointrefinement
+
+DEFAULT_MAX_SIZE = 2048
+DEFAULT_MIN_SIZE = 48
+DEFAULT_SAMPLES = 20_000
+
+
+@dataclass
+class RegistrationResult:
+	"""
+		Parameters
+		----------
+		matrix: numpy.ndarray
+			The 3x3 affine matrix mapping reference pixel coordinates onto query pixel coordinates, the same format
+			and direction as `affinetransform.solve_affine(coordinates_reference, coordinates_query)`.
+		metric: float
+			The NCC at the finest level, from -1 to 1.
+		iterations: List[int]
+			The number of iterations run at each level, coarsest first.
+	"""
+	matrix: numpy.ndarray
+	metric: float
+	iterations: List[int] = field(default_factory = list)
+
+
+def gaussian_kernel(sigma: float) -> numpy.ndarray:
+	radius = max(1, int(math.ceil(3 * sigma)))
+	kernel = numpy.exp(-0.5 * (numpy.arange(-radius, radius + 1) / sigma) ** 2)
+	return (kernel / kernel.sum()).astype(numpy.float32)
+
+
+def gaussian_blur(image: numpy.ndarray, sigma: float) -> numpy.ndarray:
+	""" Separable Gaussian blur with edge replication, as a sum of shifted views (no scipy needed)."""
+	kernel = gaussian_kernel(sigma)
+	radius = len(kernel) // 2
+	result = numpy.asarray(image, dtype = numpy.float32)
+	for axis in (0, 1):
+		padding = [(0, 0), (0, 0)]
+		padding[axis] = (radius, radius)
+		padded = numpy.pad(result, padding, mode = 'edge')
+		length = result.shape[axis]
+
+		def shifted(offset: int) -> numpy.ndarray:
+			index = [slice(None), slice(None)]
+			index[axis] = slice(offset, offset + length)
+			return padded[tuple(index)]
+
+		# The kernel is symmetric, so mirrored taps are summed before weighting.
+		blurred = kernel[radius] * shifted(radius)
+		scratch = numpy.empty_like(blurred)
+		for offset in range(radius):
+			numpy.add(shifted(offset), shifted(2 * radius - offset), out = scratch)
+			scratch *= kernel[offset]
+			blurred += scratch
+		result = blurred
+	return result
+
+
+def build_pyramid(image: numpy.ndarray, levels: int) -> List[numpy.ndarray]:
+	""" Returns `levels` images, finest first. Each level is blurred and decimated by 2, so its pixel i lies on pixel 2i of the level above."""
+	pyramid = [numpy.asarray(image, dtype = numpy.float32)]
+	for _ in range(levels - 1):
+		pyramid.append(gaussian_blur(pyramid[-1], 1.0)[::2, ::2])
+	return pyramid
+
+
+def get_level_count(shape: Tuple[int, int], min_size: int = DEFAULT_MIN_SIZE) -> int:
+	return max(1, int(math.floor(math.log2(max(min(shape) / min_size, 1)))) + 1)
+
+
+class _NormalizedCrossCorrelation:
+	"""
+		The NCC between fixed reference samples and the query sampled through an affine matrix, with its gradient.
+		The matrix is parametrized in normalized coordinates (reference pixels centered and divided by `length`), so
+		that its linear and translation parameters have comparable scales.
+	"""
+
+	def __init__(self, reference: numpy.ndarray, query: numpy.ndarray, samples: int, generator: numpy.random.Generator):
+		height, width = reference.shape
+		count = min(samples, height * width)
+		flat = generator.choice(height * width, size = count, replace = False) if count < height * width else numpy.arange(height * width)
+		rows, columns = numpy.divmod(numpy.sort(flat), width)
+		self.center = numpy.array([(width - 1) / 2, (height - 1) / 2])
+		self.length = max(height, width) / 2
+		self.u = (columns - self.center[0]) / self.length
+		self.v = (rows - self.center[1]) / self.length
+		self.fixed = reference[rows, columns].astype(numpy.float64)
+		self.query = query
+		gradient_y, gradient_x = numpy.gradient(query)
+		self.gradient_x = gradient_x.astype(numpy.float32)
+		self.gradient_y = gradient_y.astype(numpy.float32)
+
+	def to_parameters(self, matrix: numpy.ndarray) -> numpy.ndarray:
+		""" Reference pixel -> query pixel matrix to normalized parameters [a, b, tx, c, d, ty] (normalized u -> normalized q)."""
+		normalize = numpy.array([[1 / self.length, 0, -self.center[0] / self.length], [0, 1 / self.length, -self.center[1] / self.length], [0, 0, 1]])
+		return (normalize @ matrix @ numpy.linalg.inv(normalize))[:2].ravel()
+
+	def to_matrix(self, parameters: numpy.ndarray) -> numpy.ndarray:
+		normalize = numpy.array([[1 / self.length, 0, -self.center[0] / self.length], [0, 1 / self.length, -self.center[1] / self.length], [0, 0, 1]])
+		matrix = numpy.vstack((parameters.reshape(2, 3), [0, 0, 1]))
+		return numpy.linalg.inv(normalize) @ matrix @ normalize
+
+	def evaluate(self, parameters: numpy.ndarray) -> Tuple[float, numpy.ndarray]:
+		a, b, tx, c, d, ty = parameters
+		x = (a * self.u + b * self.v + tx) * self.length + self.center[0]
+		y = (c * self.u + d * self.v + ty) * self.length + self.center[1]
+		height, width = self.query.shape
+		inside = (x >= 0) & (x <= width - 1) & (y >= 0) & (y <= height - 1)
+		if inside.sum() < 16:
+			return -1.0, numpy.zeros(6)
+		x, y = x[inside], y[inside]
+		fixed = self.fixed[inside]
+		moving = pointrefinement.sample_bilinear(self.query, x, y, dtype = numpy.float64)
+
+		fixed = fixed - fixed.mean()
+		moving = moving - moving.mean()
+		norm_fixed = numpy.sqrt(fixed @ fixed)
+		norm_moving = numpy.sqrt(moving @ moving)
+		if norm_fixed == 0 or norm_moving == 0:
+			return 0.0, numpy.zeros(6)
+		fixed /= norm_fixed
+		moving_normalized = moving / norm_moving
+		ncc = float(fixed @ moving_normalized)
+
+		# dNCC/dg_i, chained through the query gradient at q_i and dq_i/dp (q is linear in the parameters).
+		sensitivity = (fixed - ncc * moving_normalized) / norm_moving
+		weighted_x = sensitivity * pointrefinement.sample_bilinear(self.gradient_x, x, y, dtype = numpy.float64) * self.length
+		weighted_y = sensitivity * pointrefinement.sample_bilinear(self.gradient_y, x, y, dtype = numpy.float64) * self.length
+		u, v = self.u[inside], self.v[inside]
+		gradient = numpy.array([
+			weighted_x @ u, weighted_x @ v, weighted_x.sum(),
+			weighted_y @ u, weighted_y @ v, weighted_y.sum()
+		])
+		return ncc, gradient
+
+
+def _optimize(
+		metric: _NormalizedCrossCorrelation, parameters: numpy.ndarray, step: float, min_step: float,
+		max_iterations: int) -> Tuple[numpy.ndarray, float, int]:
+	"""
+		Regular-step gradient ascent: move a fixed distance along the normalized gradient, and halve the distance
+		whenever a step fails to improve the metric.
+	"""
+	value, gradient = metric.evaluate(parameters)
+	iteration = 0
+	for iteration in range(1, max_iterations + 1):
+		norm = numpy.linalg.norm(gradient)
+		if norm == 0 or step < min_step:
+			break
+		candidate = parameters + step * gradient / norm
+		candidate_value, candidate_gradient = metric.evaluate(candidate)
+		if candidate_value > value:
+			parameters, value, gradient = candidate, candidate_value, candidate_gradient
+		else:
+			step *= 0.5
+	return parameters, value, iteration
+
+
+def register_affine(
+		image_reference: numpy.ndarray, image_query: numpy.ndarray, initial: numpy.ndarray = None,
+		levels: int = None, samples: int = DEFAULT_SAMPLES, max_iterations: int = 200,
+		max_size: int = DEFAULT_MAX_SIZE, seed: int = 0) -> RegistrationResult:
+	"""
+		Registers two single-channel images (e.g. the Brightfield channels) with an affine transform.
+		Parameters
+		----------
+		image_reference, image_query: numpy.ndarray
+			[height, width] arrays.
+		initial: numpy.ndarray = None
+			An initial reference -> query matrix, e.g. `autoinit.estimate_similarity(...).matrix` or a clicked-point fit.
+			Defaults to the identity.
+		levels: int = None
+			The number of pyramid levels. Defaults to halving until the smaller side of the reference is ~48 pixels.
+		samples: int = 20000
+			The number of reference pixels the metric is evaluated on at each level.
+		max_iterations: int = 200
+			The iteration limit per level.
+		max_size: int = 2048
+			Images larger than this are block-averaged first, which bounds the memory of the pyramids. The returned
+			matrix is still in full-resolution pixels.
+		seed: int = 0
+			Seeds the pixel sampling; the same inputs and seed always give the same matrix.
+	"""
+	factor = max(1, math.ceil(max(*image_reference.shape, *image_query.shape) / max_size))
+	to_full = numpy.diag([factor, factor, 1.0])
+	to_full[:2, 2] = (factor - 1) / 2
+	matrix = numpy.eye(3) if initial is None else numpy.asarray(initial, dtype = numpy.float64)
+	matrix = numpy.linalg.inv(to_full) @ matrix @ to_full
+
+	reference = autoinit.downsample(image_reference, factor)
+	query = autoinit.downsample(image_query, factor)
+	levels = levels if levels is not None else get_level_count(reference.shape)
+	pyramid_reference = build_pyramid(reference, levels)
+	pyramid_query = build_pyramid(query, levels)
+	generator = numpy.random.default_rng(seed)
+
+	value = numpy.nan
+	iterations = list()
+	for level in reversed(range(levels)):
+		scale = numpy.diag([0.5 ** level, 0.5 ** level, 1.0])
+		metric = _NormalizedCrossCorrelation(pyramid_reference[level], pyramid_query[level], samples, generator)
+		parameters = metric.to_parameters(scale @ matrix @ numpy.linalg.inv(scale))
+		# Steps start at a few percent of the image and stop below a twentieth of a pixel at this level.
+		parameters, value, count = _optimize(metric, parameters, step = 0.05, min_step = 0.05 / metric.length, max_iterations = max_iterations)
+		matrix = numpy.linalg.inv(scale) @ metric.to_matrix(parameters) @ scale
+		iterations.append(count)
+		logger.debug(f"Level {level}: NCC {value:.4f} after {count} iterations")
+
+	matrix = to_full @ matrix @ numpy.linalg.inv(to_full)
+	matrix[2] = (0, 0, 1)
+	return RegistrationResult(matrix = matrix, metric = float(value), iterations = iterations)
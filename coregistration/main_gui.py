@@ -3,7 +3,7 @@ from pathlib import Path
 from typing import *
 from PySide6 import QtWidgets
 from coregistration.imagemanager import ImageManager
-from coregistration import resources, qtimage, affinetransform
+from coregistration import resources, qtimage, affinetransform, pointrefinement, autoinit
 from loguru import logger
 import pyqtgraph as pg
 import json
@@ -24,6 +24,8 @@ class MainGui(QtWidgets.QWidget):
 		# self.resize(self.application_size[0], self.application_size[1])
 
 		self.manager = ImageManager(path)
+		# Kept in sync with the clicked point pairs so the live fit never has to be re-solved from scratch.
+		self.estimator = affinetransform.IncrementalAffineEstimator()
 
 		self.button_undo_reference = QtWidgets.QPushButton(parent = self.centralwidget)
 		self.button_undo_reference.setText("Undo Top")
@@ -32,7 +34,12 @@ class MainGui(QtWidgets.QWidget):
 		self.button_next = QtWidgets.QPushButton("Next", parent = self.centralwidget)
 		self.button_export = QtWidgets.QPushButton("Export", parent = self.centralwidget)
 		self.button_import = QtWidgets.QPushButton("Import", parent = self.centralwidget)
+		self.button_refine = QtWidgets.QPushButton("Refine points", parent = self.centralwidget)
+		self.button_autoinit = QtWidgets.QPushButton("Auto-align", parent = self.centralwidget)
+		# The coarse reference -> query transform from `autoinit`, used until enough points are clicked.
+		self.initial_transform: Optional[autoinit.InitialTransform] = None
 		self.label_index = QtWidgets.QLabel("", parent = self.centralwidget)
+		self.label_fit = QtWidgets.QLabel("", parent = self.centralwidget)
 
 		plot_size = (self.application_size[0], (self.application_size[1] - 100) // 2)
 		self.image_widget_reference = qtimage.QtImage(plot_size, parent = self.centralwidget)
@@ -50,6 +57,15 @@ class MainGui(QtWidgets.QWidget):
 		self.button_export.clicked.connect(self.export_data)
 		self.button_import.clicked.connect(self.import_data)
 		self.button_next.clicked.connect(self.load_next_group)
+		self.button_refine.clicked.connect(self.refine_points)
+		self.button_autoinit.clicked.connect(self.auto_initialize)
+
+		# Single clicks, undos and moves update the estimator in O(1); replacing all points resynchronizes it.
+		for widget in (self.image_widget_reference, self.image_widget_query):
+			widget.sigPointAdded.connect(lambda index, point, widget = widget: self.on_point_added(widget, index))
+			widget.sigPointRemoved.connect(lambda index, widget = widget: self.on_point_removed(widget, index))
+			widget.sigPointMoved.connect(lambda index, point, widget = widget: self.on_point_moved(widget, index))
+			widget.sigPointsChanged.connect(self.update_fit)
 
 	def _setup_geometry(self):
 		self.button_undo_reference.setGeometry(0, 0, 150, 25)
@@ -57,7 +73,10 @@ class MainGui(QtWidgets.QWidget):
 		self.button_next.setGeometry(310, 0, 150, 25)
 		self.button_export.setGeometry(465, 0, 150, 25)
 		self.button_import.setGeometry(620, 0, 150, 25)
-		self.label_index.setGeometry(775, 0, 250, 25)
+		self.button_refine.setGeometry(775, 0, 150, 25)
+		self.button_autoinit.setGeometry(930, 0, 150, 25)
+		self.label_index.setGeometry(1085, 0, 250, 25)
+		self.label_fit.setGeometry(1340, 0, 600, 25)
 
 		self.image_widget_reference.setGeometry(0, 50, self.application_size[0], (self.application_size[1] // 2) - 50)
 		self.image_widget_query.setGeometry(0, (self.application_size[1] // 2) + 10, self.application_size[0], self.application_size[1] // 2 - 10)
@@ -69,12 +88,12 @@ class MainGui(QtWidgets.QWidget):
 		coordinates_reference = self.image_widget_reference.points
 		coordinates_query = self.image_widget_query.points
 
-		matrix = affinetransform.solve_affine(coordinates_reference, coordinates_query).tolist()
-
 		if len(coordinates_reference) != len(coordinates_query):
 			message = f"The images do not contain the same number of points! ({len(coordinates_reference)} != {len(coordinates_query)}). Exporting is cancelled."
 			logger.error(message)
 		else:
+			diagnostics = affinetransform.calculate_fit_diagnostics(coordinates_reference, coordinates_query)
+			matrix = diagnostics.matrix.tolist()
 			if export_format == 'original':
 				result = format_export(
 					pair.barcode_reference,
@@ -90,10 +109,89 @@ class MainGui(QtWidgets.QWidget):
 					'coordinates:query':     coordinates_query,
 					'matrix':                matrix
 				}
-			path_output = self.folder_output / f"{pair.barcode_reference}-{pair.barcode_query}.transform.calculated.json"
+			result['diagnostics'] = diagnostics.to_dict()
+			logger.info(f"Fit quality: {affinetransform.format_diagnostics(diagnostics)}")
+			path_output = affinetransform.get_export_path(self.folder_output, pair.barcode_reference, pair.barcode_query)
 			path_output.write_text(json.dumps(result))
 			logger.debug(f"Saved as {path_output.name}")
 
+	def get_point_pairs(self) -> Tuple[List[PointType], List[PointType]]:
+		""" The points placed on both images so far, paired by the order they were clicked in."""
+		count = min(len(self.image_widget_reference.points), len(self.image_widget_query.points))
+		return self.image_widget_reference.points[:count], self.image_widget_query.points[:count]
+
+	def _other_widget(self, widget: qtimage.QtImage) -> qtimage.QtImage:
+		return self.image_widget_query if widget is self.image_widget_reference else self.image_widget_reference
+
+	def _get_pair(self, index: int) -> Tuple[PointType, PointType]:
+		return tuple(self.image_widget_reference.points[index]), tuple(self.image_widget_query.points[index])
+
+	def on_point_added(self, widget: qtimage.QtImage, index: int):
+		""" A click completes the pair at `index` once the other image already has a point there."""
+		if index < len(self._other_widget(widget).points):
+			self.estimator.add(*self._get_pair(index))
+		self.show_fit()
+
+	def on_point_removed(self, widget: qtimage.QtImage, index: int):
+		""" Undoing the last point of one image breaks the last pair if the other image still has its point."""
+		if index < len(self._other_widget(widget).points):
+			self.estimator.remove_last()
+		self.show_fit()
+
+	def on_point_moved(self, widget: qtimage.QtImage, index: int):
+		if index < len(self.estimator):
+			self.estimator.move(index, *self._get_pair(index))
+		self.show_fit()
+
+	def update_fit(self):
+		""" Rebuilds the estimator from all point pairs, after the points were replaced (a new image, an import, refinement)."""
+		self.estimator.clear()
+		for point_reference, point_query in zip(*self.get_point_pairs()):
+			self.estimator.add(point_reference, point_query)
+		self.show_fit()
+
+	def show_fit(self):
+		""" Shows the live transform's residuals."""
+		diagnostics = self.estimator.diagnostics()
+		if diagnostics is None:
+			self.label_fit.setText(f"{len(self.estimator)} point pairs (at least 3 non-collinear pairs are needed for a fit)")
+			return
+		self.label_fit.setText(f"{len(self.estimator)} pairs | {affinetransform.format_diagnostics(diagnostics)}")
+
+	def refine_points(self):
+		""" Snaps the query point of every pair onto the reference point's neighbourhood with subpixel phase correlation."""
+		coordinates_reference, coordinates_query = self.get_point_pairs()
+		if not coordinates_reference:
+			return
+		options = dict()
+		if len(coordinates_reference) < 3 and self.initial_transform is not None:
+			options['matrix'] = self.initial_transform.matrix
+		matrix, result = pointrefinement.refine_and_solve(
+			self.channel_reference, self.channel_query, coordinates_reference, coordinates_query, **options
+		)
+		logger.info(f"Refined {result.accepted.sum()} of {len(result.accepted)} query points.")
+		unpaired = self.image_widget_query.points[len(coordinates_query):]
+		self.image_widget_query.points = [tuple(point) for point in result.points.tolist()] + unpaired
+		self.image_widget_query.set_points()
+
+	def auto_initialize(self):
+		""" Estimates the rough rotation, scale and translation between the images and moves the query view to match the reference view."""
+		self.initial_transform = autoinit.estimate_similarity(self.channel_reference, self.channel_query)
+		if self.initial_transform.score < 0.1:
+			logger.warning(f"The automatic alignment is unreliable (score {self.initial_transform.score:.2f}).")
+		self.sync_query_view()
+
+	def sync_query_view(self):
+		""" Pans/zooms the query view onto the region the reference view shows, according to the current transform."""
+		matrix = self.estimator.matrix
+		if matrix is None and self.initial_transform is not None:
+			matrix = self.initial_transform.matrix
+		if matrix is None:
+			return
+		x_range, y_range = self.image_widget_reference.plot.viewRange()
+		x_range, y_range = autoinit.predict_view(matrix, x_range, y_range)
+		self.image_widget_query.plot.setRange(xRange = x_range, yRange = y_range, padding = 0)
+
 	def import_data(self):
 		path = Path(
 			"/media/proginoskes/storage/proginoskes/Documents/projects/HCC-CBS-231-Hillman-JLuke-PDO-immune/data/PilotExpt-100125/debug/d03sA1t00-d03sA1t17.transform.calculated.json")
@@ -123,6 +221,9 @@ class MainGui(QtWidgets.QWidget):
 
 		channel_reference = image_reference.get_channel("Brightfield")
 		channel_query = image_query.get_channel("Brightfield")
+		self.channel_reference = channel_reference
+		self.channel_query = channel_query
+		self.initial_transform = None
 
 		ratio = image_reference.shape[-1] / image_reference.shape[-2]
 
@@ -0,0 +1,249 @@
+"""
+	Piecewise-affine (triangulated) transforms for deformations a single global affine cannot follow, such as the folding
+	and stretching of serial sections.
+
+	The control points are Delaunay-triangulated and every triangle maps onto its counterpart with its own affine
+	transform, so the transform is exact at the control points and continuous inside their convex hull. Points outside the
+	hull fall back to the global least-squares affine. Triangles are found with a uniform grid built once per transform:
+	every grid cell lists the triangles overlapping it, so locating millions of points only tests a handful of triangles
+	per point.
+"""
+import math
+from typing import *
+
+import numpy
+from loguru import logger
+
+from coregistration import affinetransform, transformmodels
+from coregistration.transformmodels import TransformModel
+
+BARYCENTRIC_TOLERANCE = 1E-9
+
+
+def _import_scipy_spatial():
+	try:
+		import scipy.spatial
+	except ImportError as exception:
+		message = f"Triangulating control points requires the `scipy` package."
+		raise ImportError(message) from exception
+	return scipy.spatial
+
+
+def triangulate(points: numpy.ndarray) -> numpy.ndarray:
+	""" The [t, 3] vertex indices of the Delaunay triangulation of [n, 2] points."""
+	spatial = _import_scipy_spatial()
+	points = affinetransform.coerce_to_array(points, dtype = numpy.float64)
+	if len(points) < 3:
+		message = f"A triangulation requires at least 3 points, got {len(points)}."
+		raise ValueError(message)
+	try:
+		triangulation = spatial.Delaunay(points)
+	except spatial.QhullError as exception:
+		message = f"Cannot triangulate the control points (are they collinear or duplicated?): {exception}"
+		raise ValueError(message) from exception
+	return triangulation.simplices.astype(numpy.intp)
+
+
+class TriangleLocator:
+	"""
+		Finds the triangle containing each of many points.
+		Parameters
+		----------
+		vertices: numpy.ndarray
+			[v, 2] triangle vertices.
+		simplices: numpy.ndarray
+			[t, 3] vertex indices of each triangle. Degenerate (zero-area) triangles are never returned.
+		cell_size: float = None
+			The edge length of the grid cells. Defaults to about four cells per triangle, which keeps the candidate lists short.
+	"""
+
+	def __init__(self, vertices: numpy.ndarray, simplices: numpy.ndarray, cell_size: float = None):
+		self.vertices = numpy.asarray(vertices, dtype = numpy.float64)
+		self.simplices = numpy.asarray(simplices, dtype = numpy.intp).reshape(-1, 3)
+		self.barycentric = self._barycentric_matrices()
+
+		corners = self.vertices[self.simplices]
+		lower = corners.min(axis = 1)
+		upper = corners.max(axis = 1)
+		self.origin = lower.min(axis = 0) if len(lower) else numpy.zeros(2)
+		extent = numpy.maximum((upper.max(axis = 0) if len(upper) else numpy.ones(2)) - self.origin, 1E-9)
+		if cell_size is None:
+			cell_size = math.sqrt(extent[0] * extent[1] / (4 * max(len(self.simplices), 1)))
+		self.cell_size = max(float(cell_size), 1E-9)
+		self.grid_shape = tuple(int(value) for value in numpy.floor(extent / self.cell_size).astype(int)[::-1] + 1)
+
+		# The cells overlapped by each triangle's bounding box, stored as a CSR list per cell.
+		valid = numpy.flatnonzero(numpy.isfinite(self.barycentric).all(axis = (1, 2)))
+		first = numpy.floor((lower[valid] - self.origin) / self.cell_size).astype(numpy.intp)
+		last = numpy.floor((upper[valid] - self.origin) / self.cell_size).astype(numpy.intp)
+		spans = last - first + 1
+		counts = spans[:, 0] * spans[:, 1]
+		triangles = numpy.repeat(valid, counts)
+		position = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+		spans_x = numpy.repeat(spans[:, 0], counts)
+		columns = numpy.repeat(first[:, 0], counts) + position % spans_x
+		rows = numpy.repeat(first[:, 1], counts) + position // spans_x
+		cells = rows * self.grid_shape[1] + columns
+		# Within a cell, larger triangles are tested first since they are the most likely to contain a point.
+		areas = 0.5 / numpy.abs(numpy.linalg.det(self.barycentric[triangles]))
+		order = numpy.lexsort((-areas, cells))
+		self.cell_triangles = triangles[order]
+		self.cell_starts = numpy.concatenate(([0], numpy.cumsum(numpy.bincount(cells, minlength = self.grid_shape[0] * self.grid_shape[1]))))
+		logger.debug(f"Triangle locator: {len(self.simplices)} triangles on a {self.grid_shape} grid, {len(self.cell_triangles) / max(len(valid), 1):.1f} cells per triangle")
+
+	def _barycentric_matrices(self) -> numpy.ndarray:
+		""" [t, 3, 3] matrices mapping (x, y, 1) onto the barycentric coordinates of each triangle. NaN for degenerate triangles."""
+		corners = numpy.ones((len(self.simplices), 3, 3))
+		corners[:, :2, :] = self.vertices[self.simplices].transpose(0, 2, 1)
+		determinants = numpy.linalg.det(corners)
+		scale = numpy.abs(corners[:, :2, :] - corners[:, :2, :1]).max(axis = (1, 2)) ** 2
+		degenerate = numpy.abs(determinants) <= 1E-12 * numpy.maximum(scale, 1E-300)
+		corners[degenerate] = numpy.eye(3)
+		result = numpy.linalg.inv(corners)
+		result[degenerate] = numpy.nan
+		return result
+
+	def locate(self, points: numpy.ndarray) -> Tuple[numpy.ndarray, numpy.ndarray]:
+		"""
+			Returns
+			-------
+			Tuple[numpy.ndarray, numpy.ndarray]
+				The [n] index of the triangle containing each point (-1 outside every triangle), and the [n, 3] barycentric
+				coordinates of each point in that triangle (undefined where the index is -1).
+		"""
+		points = numpy.asarray(points, dtype = numpy.float64)
+		count = len(points)
+		result = numpy.full(count, -1, dtype = numpy.intp)
+		weights = numpy.zeros((count, 3))
+		cell_xy = numpy.floor((points - self.origin) / self.cell_size).astype(numpy.intp)
+		inside_grid = (cell_xy[:, 0] >= 0) & (cell_xy[:, 0] < self.grid_shape[1]) & (cell_xy[:, 1] >= 0) & (cell_xy[:, 1] < self.grid_shape[0])
+		indices = numpy.flatnonzero(inside_grid)
+		cells = cell_xy[indices, 1] * self.grid_shape[1] + cell_xy[indices, 0]
+		starts = self.cell_starts[cells]
+		candidates = self.cell_starts[cells + 1] - starts
+
+		# Test the k-th candidate of every point still unassigned, dropping points as they are found or run out of candidates.
+		k = 0
+		keep = candidates > 0
+		while keep.any():
+			indices, starts, candidates = indices[keep], starts[keep], candidates[keep]
+			triangles = self.cell_triangles[starts + k]
+			matrices = self.barycentric[triangles]
+			x, y = points[indices, 0, None], points[indices, 1, None]
+			coordinates = matrices[:, :, 0] * x + matrices[:, :, 1] * y + matrices[:, :, 2]
+			hit = coordinates.min(axis = 1) >= -BARYCENTRIC_TOLERANCE
+			result[indices[hit]] = triangles[hit]
+			weights[indices[hit]] = coordinates[hit]
+			k += 1
+			keep = ~hit & (candidates > k)
+		return result, weights
+
+
+class PiecewiseAffineTransform(TransformModel):
+	"""
+		One affine transform per triangle of a Delaunay triangulation of the left control points, and the global affine
+		`matrix` outside their convex hull.
+		Parameters
+		----------
+		vertices_left, vertices_right: numpy.ndarray
+			[n, 2] matching control points.
+		simplices: numpy.ndarray = None
+			[t, 3] triangles as indices into the control points. Defaults to the Delaunay triangulation of `vertices_left`.
+		matrix: numpy.ndarray = None
+			The 3x3 fallback transform outside the triangulation. Defaults to the least-squares affine of the control points.
+		cell_size: float = None
+			See `TriangleLocator`.
+	"""
+	name = 'piecewise-affine'
+	degrees_of_freedom = None
+	minimum_points = 3
+	rank = 6
+	has_matrix = False
+
+	def __init__(
+			self, vertices_left: numpy.ndarray, vertices_right: numpy.ndarray, simplices: numpy.ndarray = None,
+			matrix: numpy.ndarray = None, cell_size: float = None):
+		vertices_left, vertices_right = affinetransform.validate_correspondences(vertices_left, vertices_right)[:2]
+		self.vertices_left = vertices_left.astype(numpy.float64)
+		self.vertices_right = vertices_right.astype(numpy.float64)
+		if matrix is None:
+			matrix = affinetransform.solve_affine(self.vertices_left, self.vertices_right)
+		super().__init__(matrix)
+		self.simplices = triangulate(self.vertices_left) if simplices is None else numpy.asarray(simplices, dtype = numpy.intp)
+		self.locator = TriangleLocator(self.vertices_left, self.simplices, cell_size = cell_size)
+
+	def __repr__(self) -> str:
+		return f"{self.__class__.__name__}(points={len(self.vertices_left)}, triangles={len(self.simplices)})"
+
+	@classmethod
+	def from_matrix(cls, matrix: numpy.ndarray) -> Self:
+		message = f"A {cls.__name__} cannot be built from a matrix alone; use `fit` with control points."
+		raise ValueError(message)
+
+	@classmethod
+	def fit(cls, coordinates_left: numpy.ndarray, coordinates_right: numpy.ndarray, weights: numpy.ndarray = None) -> Self:
+		"""
+			Triangulates the left control points. The transform interpolates the control points exactly, so `weights` only
+			affect the global fallback affine.
+		"""
+		coordinates_left, coordinates_right, weights = affinetransform.validate_correspondences(coordinates_left, coordinates_right, weights)
+		if len(coordinates_left) < cls.minimum_points:
+			message = f"{cls.__name__} requires at least {cls.minimum_points} points, got {len(coordinates_left)}."
+			raise ValueError(message)
+		matrix = affinetransform.solve_affine(coordinates_left, coordinates_right, weights = weights)
+		return cls(coordinates_left, coordinates_right, matrix = matrix)
+
+	def apply(self, coordinates: numpy.ndarray, chunk_size: int = affinetransform.DEFAULT_CHUNK_SIZE) -> numpy.ndarray:
+		""" Transforms an [n, 2] array of points, `chunk_size` points at a time."""
+		coordinates = affinetransform.coerce_to_array(coordinates)
+		result = numpy.empty(coordinates.shape, dtype = coordinates.dtype)
+		for chunk in affinetransform.iterate_chunks(len(coordinates), chunk_size):
+			points = coordinates[chunk].astype(numpy.float64, copy = False)
+			triangles, weights = self.locator.locate(points)
+			inside = triangles >= 0
+			mapped = affinetransform.apply_transform(self.matrix, points)
+			corners = self.vertices_right[self.simplices[triangles[inside]]]
+			mapped[inside] = numpy.einsum('nk,nkc->nc', weights[inside], corners)
+			result[chunk] = mapped
+		return result
+
+	def inverse(self) -> 'PiecewiseAffineTransform':
+		""" The same triangles mapped backwards. Exact wherever the triangles do not fold over each other."""
+		return PiecewiseAffineTransform(self.vertices_right, self.vertices_left, simplices = self.simplices, matrix = numpy.linalg.inv(self.matrix))
+
+	def compose(self, other: TransformModel) -> 'PiecewiseAffineTransform':
+		""" Returns the transform that applies `self` first and then the affine `other`."""
+		matrix = self._affine_matrix(other)
+		return PiecewiseAffineTransform(
+			self.vertices_left, affinetransform.apply_transform(matrix, self.vertices_right), simplices = self.simplices, matrix = matrix @ self.matrix
+		)
+
+	def can_compose(self, other: TransformModel) -> bool:
+		return transformmodels.is_affine_model(other)
+
+	def _can_precompose(self, other: TransformModel) -> bool:
+		return transformmodels.is_affine_model(other)
+
+	def _precompose(self, other: TransformModel) -> TransformModel:
+		""" Returns the transform that applies `other` first and then `self`, absorbing `other` if it is affine."""
+		if not transformmodels.is_affine_model(other):
+			return super()._precompose(other)
+		matrix = other.to_matrix()
+		return PiecewiseAffineTransform(
+			affinetransform.apply_transform(numpy.linalg.inv(matrix), self.vertices_left), self.vertices_right,
+			simplices = self.simplices, matrix = self.matrix @ matrix
+		)
+
+	@staticmethod
+	def _affine_matrix(other: TransformModel) -> numpy.ndarray:
+		if not transformmodels.is_affine_model(other):
+			message = f"A piecewise-affine transform can only be composed with affine transforms, got {other!r}."
+			raise ValueError(message)
+		return other.to_matrix()
+
+	def to_matrix(self) -> numpy.ndarray:
+		""" The global affine fallback, i.e. the least-squares approximation of the whole transform."""
+		return self.matrix.copy()
+
+	def to_parameters(self) -> Dict[str, float]:
+		return {'points': len(self.vertices_left), 'triangles': len(self.simplices)}
@@ -0,0 +1,222 @@
+"""
+	Refines clicked point pairs to subpixel accuracy with phase correlation of small patches around each pair.
+
+	The patches of every pair are sampled in one batched gather and correlated with one batched FFT, so refining a few
+	hundred pairs costs about as much as a single large FFT. The query point of each pair is moved by the subpixel
+	peak of the correlation between its query patch and the matching reference patch.
+"""
+from dataclasses import dataclass
+from typing import *
+
+import numpy
+from loguru import logger
+
+from coregistration import affinetransform
+
+DEFAULT_PATCH_SIZE = 64
+DEFAULT_BATCH_SIZE = 256
+
+
+@dataclass
+class RefinementResult:
+	"""
+		Parameters
+		----------
+		points: numpy.ndarray
+			[n, 2] refined query points. Pairs that were not accepted keep their original position.
+		shifts: numpy.ndarray
+			[n, 2] (x, y) shift found for each query point.
+		scores: numpy.ndarray
+			The phase correlation peak height of each pair, from 0 (no match) to 1 (identical patches).
+		accepted: numpy.ndarray
+			Whether each shift was applied (the peak was strong enough and within `max_shift`).
+	"""
+	points: numpy.ndarray
+	shifts: numpy.ndarray
+	scores: numpy.ndarray
+	accepted: numpy.ndarray
+
+
+def sample_bilinear(image: numpy.ndarray, x: numpy.ndarray, y: numpy.ndarray, dtype: numpy.dtype = numpy.float32) -> numpy.ndarray:
+	""" Samples `image` at arbitrary (x, y) pixel coordinates with bilinear interpolation. Coordinates are clamped to the image."""
+	height, width = image.shape
+	x = numpy.clip(x, 0, width - 1)
+	y = numpy.clip(y, 0, height - 1)
+	column = numpy.clip(numpy.floor(x).astype(numpy.intp), 0, max(width - 2, 0))
+	row = numpy.clip(numpy.floor(y).astype(numpy.intp), 0, max(height - 2, 0))
+	fraction_x = (x - column).astype(dtype)
+	fraction_y = (y - row).astype(dtype)
+	column_next = numpy.minimum(column + 1, width - 1)
+	row_next = numpy.minimum(row + 1, height - 1)
+
+	top = image[row, column] * (1 - fraction_x) + image[row, column_next] * fraction_x
+	bottom = image[row_next, column] * (1 - fraction_x) + image[row_next, column_next] * fraction_x
+	return (top * (1 - fraction_y) + bottom * fraction_y).astype(dtype, copy = False)
+
+
+def sample_patches(
+		image: numpy.ndarray, centers: numpy.ndarray, size: int, linear: numpy.ndarray = None,
+		dtype: numpy.dtype = numpy.float32) -> numpy.ndarray:
+	"""
+		Samples square patches centered on subpixel points with bilinear interpolation, for all points at once.
+		Parameters
+		----------
+		image: numpy.ndarray
+			The [height, width] image. Samples outside it are clamped to the edge.
+		centers: numpy.ndarray
+			[n, 2] (x, y) patch centers.
+		size: int
+			The patch edge length.
+		linear: numpy.ndarray = None
+			Optional 2x2 matrix applied to the patch offsets, so the patch follows a locally rotated/scaled frame.
+		Returns
+		-------
+		numpy.ndarray
+			[n, size, size] patches.
+	"""
+	centers = numpy.asarray(centers, dtype = numpy.float64).reshape(-1, 2)
+	offsets = numpy.arange(size) - (size - 1) / 2
+	offset_x, offset_y = numpy.meshgrid(offsets, offsets)
+	offset_x, offset_y = offset_x.ravel(), offset_y.ravel()
+	if linear is not None:
+		offset_x, offset_y = linear[0, 0] * offset_x + linear[0, 1] * offset_y, linear[1, 0] * offset_x + linear[1, 1] * offset_y
+
+	patches = sample_bilinear(image, centers[:, 0, None] + offset_x[None, :], centers[:, 1, None] + offset_y[None, :], dtype = dtype)
+	return patches.reshape(len(centers), size, size)
+
+
+def _prepare(patches: numpy.ndarray, window: numpy.ndarray) -> numpy.ndarray:
+	""" Removes each patch's mean and tapers its edges so the FFT does not see the patch border as an edge."""
+	patches = patches - patches.mean(axis = (1, 2), keepdims = True)
+	return patches * window
+
+
+def _subpixel_offset(before: numpy.ndarray, peak: numpy.ndarray, after: numpy.ndarray) -> numpy.ndarray:
+	""" The vertex of the parabola through three samples, relative to the middle one."""
+	denominator = before - 2 * peak + after
+	with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+		offset = numpy.where(numpy.abs(denominator) > 1E-12, 0.5 * (before - after) / denominator, 0.0)
+	return numpy.clip(offset, -0.5, 0.5)
+
+
+def phase_correlate(reference: numpy.ndarray, query: numpy.ndarray, regularization: float = 1E-3) -> Tuple[numpy.ndarray, numpy.ndarray]:
+	"""
+		Finds the shift of each query patch relative to its reference patch.
+		Parameters
+		----------
+		reference, query: numpy.ndarray
+			[n, size, size] stacks of patches, already mean-subtracted and windowed.
+		regularization: float = 1E-3
+			Frequencies weaker than this fraction of the strongest one are damped rather than whitened.
+		Returns
+		-------
+		Tuple[numpy.ndarray, numpy.ndarray]
+			[n, 2] (x, y) shifts such that query(u) ~ reference(u - shift), and the [n] correlation peak heights relative
+			to the height identical patches would reach.
+	"""
+	count, height, width = reference.shape
+	cross_power = numpy.fft.rfft2(query) * numpy.conj(numpy.fft.rfft2(reference))
+	# Whitening is regularized relative to each pair's strongest frequency, otherwise the numerically empty
+	# frequencies of smooth patches are amplified as much as the real signal and pin the peak at zero.
+	magnitude = numpy.abs(cross_power)
+	denominator = magnitude + regularization * magnitude.max(axis = (1, 2), keepdims = True) + 1E-20
+	cross_power /= denominator
+	surface = numpy.fft.irfft2(cross_power, s = (height, width))
+
+	# The height a perfect match would reach: the mean of the weights over the full (Hermitian) spectrum.
+	weights = magnitude / denominator
+	doubled = weights[:, :, 1:-1] if width % 2 == 0 else weights[:, :, 1:]
+	total = weights[:, :, 0].sum(axis = 1) + 2 * doubled.sum(axis = (1, 2))
+	if width % 2 == 0:
+		total += weights[:, :, -1].sum(axis = 1)
+	ideal = numpy.maximum(total / (height * width), 1E-20)
+
+	flat_peaks = surface.reshape(count, -1).argmax(axis = 1)
+	peak_rows, peak_columns = numpy.unravel_index(flat_peaks, (height, width))
+	points = numpy.arange(count)
+	peaks = surface[points, peak_rows, peak_columns]
+
+	offset_row = _subpixel_offset(
+		surface[points, (peak_rows - 1) % height, peak_columns], peaks, surface[points, (peak_rows + 1) % height, peak_columns]
+	)
+	offset_column = _subpixel_offset(
+		surface[points, peak_rows, (peak_columns - 1) % width], peaks, surface[points, peak_rows, (peak_columns + 1) % width]
+	)
+	# The correlation surface wraps around, so peaks past the middle are negative shifts.
+	shift_row = (peak_rows + height // 2) % height - height // 2 + offset_row
+	shift_column = (peak_columns + width // 2) % width - width // 2 + offset_column
+	return numpy.column_stack((shift_column, shift_row)), numpy.clip(peaks / ideal, 0, 1)
+
+
+def refine_points(
+		image_reference: numpy.ndarray, image_query: numpy.ndarray, points_reference: numpy.ndarray,
+		points_query: numpy.ndarray, patch_size: int = DEFAULT_PATCH_SIZE, matrix: numpy.ndarray = None,
+		max_shift: float = None, min_score: float = 0.05, iterations: int = 3,
+		batch_size: int = DEFAULT_BATCH_SIZE) -> RefinementResult:
+	"""
+		Snaps each query point onto the position that best matches the neighbourhood of its reference point.
+		Parameters
+		----------
+		image_reference, image_query: numpy.ndarray
+			The [height, width] channels the points were clicked on (e.g. the Brightfield channels).
+		points_reference, points_query: numpy.ndarray
+			[n, 2] (x, y) clicked pairs.
+		patch_size: int = 64
+			The edge length of the correlated patches. Should comfortably exceed twice the expected click error.
+		matrix: numpy.ndarray = None
+			An approximate reference -> query transform (e.g. from `affinetransform.solve_affine` on the raw clicks). When
+			given, the reference patches are sampled in the query's orientation and scale so rotated or scaled pairs
+			still correlate. Without it the images are assumed to share orientation and scale.
+		max_shift: float = None
+			Reject shifts longer than this. Defaults to a quarter of the patch size.
+		min_score: float = 0.05
+			Reject pairs whose correlation peak is weaker than this.
+		iterations: int = 3
+			Re-sample the query patches at the refined position and correlate again, removing the bias of large shifts.
+		batch_size: int = 256
+			The number of pairs correlated per batched FFT.
+	"""
+	points_reference, points_query = affinetransform.validate_correspondences(points_reference, points_query)[:2]
+	points_reference = points_reference.astype(numpy.float64)
+	points_query = points_query.astype(numpy.float64)
+	max_shift = max_shift if max_shift is not None else patch_size / 4
+	linear = None
+	if matrix is not None:
+		linear = numpy.linalg.inv(numpy.asarray(matrix, dtype = numpy.float64)[:2, :2])
+
+	window = numpy.outer(numpy.hanning(patch_size), numpy.hanning(patch_size)).astype(numpy.float32)
+	shifts = numpy.zeros_like(points_query)
+	scores = numpy.zeros(len(points_query))
+	for start in range(0, len(points_query), batch_size):
+		batch = slice(start, start + batch_size)
+		reference = _prepare(sample_patches(image_reference, points_reference[batch], patch_size, linear = linear), window)
+		shift = numpy.zeros((len(reference), 2))
+		for _ in range(max(iterations, 1)):
+			query = _prepare(sample_patches(image_query, points_query[batch] + shift, patch_size), window)
+			update, peaks = phase_correlate(reference, query)
+			shift += update
+		shifts[batch] = shift
+		scores[batch] = peaks
+
+	accepted = (scores >= min_score) & (numpy.hypot(shifts[:, 0], shifts[:, 1]) <= max_shift)
+	refined = numpy.where(accepted[:, None], points_query + shifts, points_query)
+	logger.debug(f"Refined {accepted.sum()} of {len(accepted)} points (median shift {numpy.median(numpy.hypot(*shifts.T)) if len(shifts) else 0:.2f}px)")
+	return RefinementResult(points = refined, shifts = shifts, scores = scores, accepted = accepted)
+
+
+def refine_and_solve(
+		image_reference: numpy.ndarray, image_query: numpy.ndarray, points_reference: numpy.ndarray,
+		points_query: numpy.ndarray, **kwargs) -> Tuple[numpy.ndarray, RefinementResult]:
+	"""
+		Solves an initial transform from the raw clicks, refines the query points with it and re-solves with the refined
+		points. See `refine_points` for the parameters.
+		Returns
+		-------
+		Tuple[numpy.ndarray, RefinementResult]
+			The 3x3 reference -> query matrix and the refinement result.
+	"""
+	if 'matrix' not in kwargs and len(points_reference) >= 3:
+		kwargs['matrix'] = affinetransform.solve_affine(points_reference, points_query)
+	result = refine_points(image_reference, image_query, points_reference, points_query, **kwargs)
+	matrix = affinetransform.solve_affine(points_reference, result.points)
+	return matrix, result
@@ -0,0 +1,312 @@
+"""
+	Writes [channels, height, width] images (typically warped query images) as tiled, pyramidal, compressed OME-TIFF.
+
+	The full-resolution data is consumed one tile at a time, so it can be a memory-mapped array, a
+	`tileplanner.TiffRegionReader`, or tiles computed on the fly (`write_warped_image` warps each output tile just before
+	it is written). Each tile is downsampled into the next pyramid level while it is written, and the reduced levels are
+	kept in temporary memory-mapped files rather than in memory. Tiles are compressed in parallel by tifffile's encoder
+	threads.
+"""
+import math
+import os
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import *
+
+import numpy
+import tifffile
+from loguru import logger
+
+from coregistration import warping
+
+if TYPE_CHECKING:
+	from coregistration.metadata import ChannelData
+
+DEFAULT_TILE_SIZE = 512
+DEFAULT_COMPRESSION = 'zlib'
+
+# Tags tifffile derives from the data and options it is given. Copying them over from the source would be wrong.
+STRUCTURAL_TAGS = {
+	254, 256, 257, 258, 259, 262, 270, 273, 274, 277, 278, 279, 282, 283, 284, 296, 305, 306, 317, 320, 322, 323, 324,
+	325, 330, 338, 339, 340, 341, 347
+}
+
+
+def get_level_count(shape: Tuple[int, int], tile_size: int = DEFAULT_TILE_SIZE) -> int:
+	""" The number of pyramid levels needed for the smallest level to fit in one tile."""
+	largest = max(shape)
+	return 1 + max(0, math.ceil(math.log2(largest / tile_size))) if largest > tile_size else 1
+
+
+def downsample(tile: numpy.ndarray) -> numpy.ndarray:
+	""" Halves the last two axes of `tile` by averaging 2x2 blocks. Odd edges are averaged with themselves."""
+	height, width = tile.shape[-2:]
+	if height % 2 or width % 2:
+		padding = [(0, 0)] * (tile.ndim - 2) + [(0, height % 2), (0, width % 2)]
+		tile = numpy.pad(tile, padding, mode = 'edge')
+	values = tile.astype(numpy.float32, copy = False)
+	result = 0.25 * (values[..., 0::2, 0::2] + values[..., 1::2, 0::2] + values[..., 0::2, 1::2] + values[..., 1::2, 1::2])
+	return warping.cast_result(result, tile.dtype)
+
+
+def iterate_array_tiles(image: numpy.ndarray, tile_size: int) -> Iterator[numpy.ndarray]:
+	""" Reads the tiles of a [channels, height, width] array-like in the order tifffile writes them (see `write_tiles`)."""
+	channel_count, height, width = image.shape
+	for channel in range(channel_count):
+		for row_start, row_stop, column_start, column_stop in warping.iterate_tiles((height, width), tile_size):
+			yield numpy.asarray(image[channel, row_start:row_stop, column_start:column_stop])
+
+
+def iterate_warped_tiles(
+		source: numpy.ndarray, matrix: numpy.ndarray, output_shape: Tuple[int, int], tile_size: int = DEFAULT_TILE_SIZE,
+		method: str = 'bilinear', fill_value: float = 0, dtype: numpy.dtype = None, threads: int = None,
+		temporary_folder: Path = None) -> Iterator[numpy.ndarray]:
+	"""
+		Warps a [channels, height, width] source tile by tile with `warping.warp_region`, yielding the output tiles in the
+		order tifffile writes them. Every output box is warped once for all channels, sharing its coordinate map and its
+		source reads; with a `tileplanner.TiffRegionReader` source only the source tiles the box needs are decoded. Up to
+		two boxes per thread are warped ahead of the one being written.
+
+		tifffile writes all of the first channel before the second, so the first channel of each box is yielded right
+		away and the others are kept in a temporary memory-mapped file until their turn.
+	"""
+	dtype = numpy.dtype(dtype if dtype is not None else source.dtype)
+	channel_count = source.shape[0]
+	boxes = list(warping.iterate_tiles(tuple(output_shape), tile_size))
+
+	def warp(box: warping.BoxType) -> numpy.ndarray:
+		return warping.warp_region(source, matrix, box, method = method, fill_value = fill_value, dtype = dtype, threads = 1)
+
+	def iterate_boxes() -> Iterator[Tuple[warping.BoxType, numpy.ndarray]]:
+		workers = threads if threads is not None else (os.cpu_count() or 1)
+		if workers <= 1:
+			for box in boxes:
+				yield box, warp(box)
+			return
+		with ThreadPoolExecutor(max_workers = workers) as executor:
+			pending = deque()
+			for box in boxes:
+				pending.append((box, executor.submit(warp, box)))
+				if len(pending) > 2 * workers:
+					box, future = pending.popleft()
+					yield box, future.result()
+			while pending:
+				box, future = pending.popleft()
+				yield box, future.result()
+
+	with tempfile.TemporaryDirectory(dir = temporary_folder) as folder:
+		cache = None
+		if channel_count > 1:
+			cache = numpy.lib.format.open_memmap(
+				Path(folder) / "channels.npy", mode = 'w+', dtype = dtype, shape = (channel_count - 1,) + tuple(output_shape)
+			)
+		for (row_start, row_stop, column_start, column_stop), tile in iterate_boxes():
+			if cache is not None:
+				cache[:, row_start:row_stop, column_start:column_stop] = tile[1:]
+			yield tile[0]
+		if cache is not None:
+			yield from iterate_array_tiles(cache, tile_size)
+			del cache
+
+
+def _iterate_level_tiles(
+		tiles: Iterable[numpy.ndarray], shape: Tuple[int, int, int], tile_size: int,
+		reduced: Optional[numpy.ndarray]) -> Iterator[numpy.ndarray]:
+	"""
+		Passes the tiles of one level on to tifffile. If `reduced` is given, every tile is also downsampled into it,
+		building the next level as a side effect.
+	"""
+	tiles = iter(tiles)
+	channel_count, height, width = shape
+	for channel in range(channel_count):
+		for row_start, row_stop, column_start, column_stop in warping.iterate_tiles((height, width), tile_size):
+			tile = next(tiles)
+			if reduced is not None:
+				reduced[channel, row_start // 2:(row_stop + 1) // 2, column_start // 2:(column_stop + 1) // 2] = downsample(tile)
+			yield tile
+
+
+def filter_extra_tags(tags: Dict[int, tifffile.TiffTag]) -> List[Tuple[int, Any, int, Any]]:
+	"""
+		Converts the tags of a source image (e.g. `resources.Image.tags`) with `tifftags.format_extra_tags`, dropping the
+		tags that describe the layout of the source file.
+	"""
+	from coregistration.metadata import tifftags
+
+	tags = {code: tag for code, tag in tags.items() if tag.code not in STRUCTURAL_TAGS and tag.code < 65000}
+	return tifftags.format_extra_tags(tags)
+
+
+def build_ome_metadata(
+		channels: Optional[Sequence['ChannelData']], channel_count: int,
+		pixel_size: Optional[Tuple[float, float]]) -> Dict[str, Any]:
+	""" The OME metadata tifffile writes into the ImageDescription of the first page."""
+	ome = {'axes': 'CYX'}
+	if channels:
+		ordered = sorted(channels, key = lambda channel: channel.get('index') if channel.get('index') is not None else 0)
+		if len(ordered) != channel_count:
+			message = f"Got metadata for {len(ordered)} channels but the image has {channel_count} channels."
+			raise ValueError(message)
+		ome['Channel'] = {'Name': [channel.get('name') or channel.get('marker') for channel in ordered]}
+	if pixel_size is not None:
+		ome['PhysicalSizeX'], ome['PhysicalSizeY'] = pixel_size
+		ome['PhysicalSizeXUnit'] = ome['PhysicalSizeYUnit'] = 'µm'
+	return ome
+
+
+def write_ome_tiff(
+		path: Path, image: numpy.ndarray, channels: Sequence['ChannelData'] = None,
+		pixel_size: Tuple[float, float] = None, tags: Dict[int, tifffile.TiffTag] = None,
+		tile_size: int = DEFAULT_TILE_SIZE, levels: int = None, compression: Union[str, Tuple] = DEFAULT_COMPRESSION,
+		workers: int = None, temporary_folder: Path = None) -> Path:
+	"""
+		Writes a tiled, pyramidal, compressed OME-TIFF without loading the full-resolution image.
+		Parameters
+		----------
+		path: Path
+			The output file, usually '*.ome.tiff'.
+		image: numpy.ndarray
+			The [channels, height, width] (or [height, width]) image. May be memory-mapped or any array-like supporting
+			slicing, since it is only read one tile at a time.
+		See `write_tiles` for the other parameters.
+	"""
+	if image.ndim == 2:
+		image = image[None]
+	return write_tiles(
+		path, iterate_array_tiles(image, tile_size), image.shape, image.dtype, channels = channels, pixel_size = pixel_size,
+		tags = tags, tile_size = tile_size, levels = levels, compression = compression, workers = workers,
+		temporary_folder = temporary_folder
+	)
+
+
+def write_tiles(
+		path: Path, tiles: Iterable[numpy.ndarray], shape: Tuple[int, int, int], dtype: numpy.dtype,
+		channels: Sequence['ChannelData'] = None, pixel_size: Tuple[float, float] = None,
+		tags: Dict[int, tifffile.TiffTag] = None, tile_size: int = DEFAULT_TILE_SIZE, levels: int = None,
+		compression: Union[str, Tuple] = DEFAULT_COMPRESSION, workers: int = None, temporary_folder: Path = None) -> Path:
+	"""
+		Writes the full-resolution tiles of a [channels, height, width] image as a tiled, pyramidal, compressed OME-TIFF.
+		Parameters
+		----------
+		path: Path
+			The output file, usually '*.ome.tiff'.
+		tiles: Iterable[numpy.ndarray]
+			The full-resolution tiles, `tile_size` square except at the right and bottom edges, ordered by channel, then
+			tile row, then tile column (see `iterate_array_tiles` and `iterate_warped_tiles`).
+		shape: Tuple[int, int, int]
+			The [channels, height, width] shape of the full-resolution image.
+		dtype: numpy.dtype
+		channels: Sequence[ChannelData] = None
+			The channel metadata. Written as the OME channel names, ordered by their 'index'.
+		pixel_size: Tuple[float, float] = None
+			The (x, y) physical pixel size in micrometers at full resolution.
+		tags: Dict[int, tifffile.TiffTag] = None
+			Source tags (e.g. `resources.Image.tags`) to carry over. See `filter_extra_tags`.
+		tile_size: int = 512
+			The tile edge length. Must be a multiple of 16.
+		levels: int = None
+			The number of pyramid levels including full resolution. Defaults to halving until one tile covers the image.
+		compression: str = 'zlib'
+			Any compression tifffile supports, e.g. 'zlib', 'zstd', 'lzw', or a (name, level) tuple.
+		workers: int = None
+			The number of threads compressing tiles. Defaults to the number of CPUs.
+		temporary_folder: Path = None
+			Where to keep the reduced levels while writing. Defaults to the system temporary folder.
+	"""
+	path = Path(path)
+	if tile_size % 16:
+		message = f"The tile size must be a multiple of 16, got {tile_size}"
+		raise ValueError(message)
+	channel_count, height, width = shape
+	dtype = numpy.dtype(dtype)
+	levels = levels if levels is not None else get_level_count((height, width), tile_size)
+	compression_options = dict(compression = compression[0], compressionargs = {'level': compression[1]}) if isinstance(compression, tuple) else dict(compression = compression)
+	options = dict(tile = (tile_size, tile_size), photometric = 'minisblack', maxworkers = workers, **compression_options)
+	if pixel_size is not None:
+		options['resolutionunit'] = 'CENTIMETER'
+	extra_tags = filter_extra_tags(tags) if tags else []
+
+	logger.debug(f"Writing {path.name} with shape {tuple(shape)} as {levels} pyramid levels")
+	with tempfile.TemporaryDirectory(dir = temporary_folder) as folder, tifffile.TiffWriter(path, bigtiff = True, ome = True) as writer:
+		current, current_shape = None, tuple(shape)
+		for level in range(levels):
+			level_height, level_width = current_shape[-2:]
+			reduced = None
+			if level + 1 < levels:
+				reduced = numpy.lib.format.open_memmap(
+					Path(folder) / f"level{level + 1}.npy", mode = 'w+', dtype = dtype,
+					shape = (channel_count, (level_height + 1) // 2, (level_width + 1) // 2)
+				)
+			level_options = dict(options)
+			if pixel_size is not None:
+				scale = 2 ** level
+				level_options['resolution'] = (1E4 / (pixel_size[0] * scale), 1E4 / (pixel_size[1] * scale))
+			if level == 0:
+				level_options.update(
+					subifds = levels - 1, metadata = build_ome_metadata(channels, channel_count, pixel_size),
+					extratags = extra_tags
+				)
+			else:
+				level_options.update(subfiletype = 1, metadata = None)
+
+			level_tiles = tiles if level == 0 else iterate_array_tiles(current, tile_size)
+			writer.write(_iterate_level_tiles(level_tiles, current_shape, tile_size, reduced), shape = current_shape, dtype = dtype, **level_options)
+			if reduced is not None:
+				reduced.flush()
+				current_shape = reduced.shape
+			current = reduced
+		del current, reduced
+	return path
+
+
+def get_pixel_size(image) -> Optional[Tuple[float, float]]:
+	""" The (x, y) pixel size in micrometers of a `resources.Image`, if its tags record a resolution."""
+	from coregistration.metadata import tifftags
+
+	try:
+		pixels_per_micrometer_x, pixels_per_micrometer_y = tifftags.calculate_resolution_factor(image.tags)
+	except (KeyError, TypeError, ZeroDivisionError):
+		return None
+	if not (pixels_per_micrometer_x > 0 and pixels_per_micrometer_y > 0):
+		return None
+	return 1 / pixels_per_micrometer_x, 1 / pixels_per_micrometer_y
+
+
+def write_image(path: Path, image, **kwargs) -> Path:
+	""" Writes a `resources.Image` with its channel metadata, tags and pixel size. See `write_ome_tiff` for the options."""
+	kwargs.setdefault('channels', list(image.channels.values()) or None)
+	kwargs.setdefault('pixel_size', get_pixel_size(image))
+	kwargs.setdefault('tags', image.tags)
+	return write_ome_tiff(path, image.data, **kwargs)
+
+
+def write_warped_image(
+		path: Path, image, matrix: numpy.ndarray, output_shape: Tuple[int, int],
+		pixel_size: Tuple[float, float] = None, method: str = 'bilinear', fill_value: float = 0,
+		threads: int = None, temporary_folder: Path = None, **kwargs) -> Path:
+	"""
+		Warps every channel of a query `resources.Image` into the reference frame and writes it as a pyramidal OME-TIFF.
+		Each output box is warped once for all channels (see `iterate_warped_tiles`), reading the query through a
+		`tileplanner.TiffRegionReader` when it is backed by a TIFF file (see `warping.open_image_source`).
+		Parameters
+		----------
+		pixel_size: Tuple[float, float] = None
+			The (x, y) pixel size of the output (reference) grid in micrometers. Defaults to the query image's pixel size.
+		See `warping.warp_channels` and `write_tiles` for the other parameters.
+	"""
+	kwargs.setdefault('channels', list(image.channels.values()) or None)
+	kwargs.setdefault('tags', image.tags)
+	tile_size = kwargs.pop('tile_size', DEFAULT_TILE_SIZE)
+	with warping.open_image_source(image) as source:
+		tiles = iterate_warped_tiles(
+			source, matrix, output_shape, tile_size = tile_size, method = method, fill_value = fill_value, threads = threads,
+			temporary_folder = temporary_folder
+		)
+		write_tiles(
+			path, tiles, (source.shape[0],) + tuple(output_shape), source.dtype, tile_size = tile_size,
+			pixel_size = pixel_size if pixel_size is not None else get_pixel_size(image), workers = threads,
+			temporary_folder = temporary_folder, **kwargs
+		)
+	return path
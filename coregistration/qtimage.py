@@ -35,6 +35,12 @@ palette_distinct = [
 
 class QtImage(pg.GraphicsLayoutWidget):
 	""" example application main window """
+	# Emitted when the whole list of points is replaced or cleared (a new image, an import, refined points).
+	sigPointsChanged = QtCore.Signal()
+	# Emitted with the index (and the new point) of a single clicked, undone or moved point.
+	sigPointAdded = QtCore.Signal(int, object)
+	sigPointRemoved = QtCore.Signal(int)
+	sigPointMoved = QtCore.Signal(int, object)
 
 	def __init__(self, application_size: PointType = (1920, 1080), parent = None):
 		super().__init__(parent = parent)
@@ -78,20 +84,35 @@ class QtImage(pg.GraphicsLayoutWidget):
 		y = image_pos.y()
 
 		self.points.append((x, y))
-		self.set_points(self.points)
+		self._draw_points()
+		self.sigPointAdded.emit(len(self.points) - 1, (x, y))
 		return x, y
 
 	def remove_last_point(self):
+		if not self.points:
+			return
 		self.points = self.points[:-1]
-		self.set_points(self.points)
+		self._draw_points()
+		self.sigPointRemoved.emit(len(self.points))
+
+	def move_point(self, index: int, point: PointType):
+		self.points[index] = point
+		self._draw_points()
+		self.sigPointMoved.emit(index, point)
 
 	def set_image(self, array: numpy.ndarray):
 		self.image = pg.ImageItem(array, axisOrder = 'row-major')
 		self.plot.clear()
 		self.plot.addItem(self.image)
 		self.points = list()
+		self.series_object = None
+		self.sigPointsChanged.emit()
 
 	def set_points(self, points: List[PointType] = None):
+		self._draw_points(points)
+		self.sigPointsChanged.emit()
+
+	def _draw_points(self, points: List[PointType] = None):
 		if points is None:
 			points = self.points
 		if points:
@@ -107,6 +128,8 @@ class QtImage(pg.GraphicsLayoutWidget):
 				)
 			else:
 				self.series_object.setData(x, y, symbolBrush = colors)
+		elif self.series_object is not None:
+			self.series_object.setData([], [])
 
 
 def numpy_array_to_qimage(array: numpy.ndarray) -> QtGui.QImage:
@@ -0,0 +1,418 @@
+"""
+	Quantifies how well a query image is registered onto its reference, without ever holding either slide in memory.
+
+	The reference grid is walked tile by tile; each reference tile is read, the matching query region is warped into it
+	with `warping.warp_region`, and the pair only updates small accumulators before it is dropped:
+
+	- centered moments (merged per tile with the parallel variance formula) for the normalized cross-correlation (NCC),
+	- a joint intensity histogram for the mutual information (MI),
+	- tissue pixel counts for the overlap (Dice) of the two tissue masks.
+
+	Every tile also keeps its own NCC, MI and Dice, which give the low-resolution error heatmap (one pixel per tile).
+	The intensity range of the histogram and the tissue thresholds (Otsu) are estimated beforehand from a sample of tiles
+	of each image, so that all tiles share them. Tissue is bright on a dark background in fluorescence, but dark on a
+	bright background in brightfield; by default the Otsu class with the wider intensity spread is taken as tissue, since
+	the background is nearly uniform.
+
+	Usage:
+		python -m coregistration.qualitycontrol --table pairs.tsv --transforms exports/ --output-folder qc/
+"""
+import argparse
+import json
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import *
+
+import numpy
+import pandas
+import tifffile
+from loguru import logger
+
+from coregistration import affinetransform, tileplanner, transformmodels, warping
+from coregistration.imagemanager import ImageManager
+
+DEFAULT_TILE_SIZE = 512
+DEFAULT_BINS = 64
+DEFAULT_SAMPLE_TILES = 64
+MINIMUM_TILE_FRACTION = 0.05  # Tiles with fewer compared pixels than this fraction of their area get no metrics.
+POLARITIES = ('bright', 'dark')
+
+
+@dataclass
+class IntensityProfile:
+	"""
+		The intensity range binned for the mutual information, and the tissue threshold, of one image.
+		Parameters
+		----------
+		polarity: str = 'bright'
+			'bright' if tissue lies above the threshold (fluorescence), 'dark' if it lies below (brightfield).
+	"""
+	low: float
+	high: float
+	threshold: float
+	polarity: str = 'bright'
+
+	def __post_init__(self):
+		if self.polarity not in POLARITIES:
+			message = f"The tissue polarity must be one of {POLARITIES}, not '{self.polarity}'."
+			raise ValueError(message)
+
+	def tissue(self, values: numpy.ndarray) -> numpy.ndarray:
+		""" The tissue mask of `values`. NaN (uncovered) pixels are never tissue."""
+		return values > self.threshold if self.polarity == 'bright' else values < self.threshold
+
+
+@dataclass
+class Moments:
+	""" Running centered moments of paired intensities. `merge` combines two sets exactly (Chan et al.)."""
+	count: int = 0
+	mean_reference: float = 0.0
+	mean_query: float = 0.0
+	m2_reference: float = 0.0
+	m2_query: float = 0.0
+	comoment: float = 0.0
+
+	@classmethod
+	def from_values(cls, reference: numpy.ndarray, query: numpy.ndarray) -> 'Moments':
+		if not len(reference):
+			return cls()
+		reference = reference.astype(numpy.float64)
+		query = query.astype(numpy.float64)
+		mean_reference, mean_query = float(reference.mean()), float(query.mean())
+		reference -= mean_reference
+		query -= mean_query
+		return cls(
+			len(reference), mean_reference, mean_query,
+			float(reference @ reference), float(query @ query), float(reference @ query)
+		)
+
+	def merge(self, other: 'Moments'):
+		if not other.count:
+			return
+		count = self.count + other.count
+		delta_reference = other.mean_reference - self.mean_reference
+		delta_query = other.mean_query - self.mean_query
+		factor = self.count * other.count / count
+		self.m2_reference += other.m2_reference + delta_reference ** 2 * factor
+		self.m2_query += other.m2_query + delta_query ** 2 * factor
+		self.comoment += other.comoment + delta_reference * delta_query * factor
+		self.mean_reference += delta_reference * other.count / count
+		self.mean_query += delta_query * other.count / count
+		self.count = count
+
+	@property
+	def ncc(self) -> float:
+		denominator = numpy.sqrt(self.m2_reference * self.m2_query)
+		return float(self.comoment / denominator) if denominator > 0 else numpy.nan
+
+
+def mutual_information(histogram: numpy.ndarray) -> Tuple[float, float]:
+	"""
+		The mutual information (nats) and the normalized mutual information (H(r) + H(q)) / H(r, q) of a joint histogram.
+	"""
+	total = histogram.sum()
+	if not total:
+		return numpy.nan, numpy.nan
+	joint = histogram[histogram > 0] / total
+
+	def entropy(probabilities: numpy.ndarray) -> float:
+		probabilities = probabilities[probabilities > 0]
+		return float(-(probabilities * numpy.log(probabilities)).sum())
+
+	entropy_reference = entropy(histogram.sum(axis = 1) / total)
+	entropy_query = entropy(histogram.sum(axis = 0) / total)
+	entropy_joint = entropy(joint)
+	normalized = (entropy_reference + entropy_query) / entropy_joint if entropy_joint > 0 else numpy.nan
+	return entropy_reference + entropy_query - entropy_joint, normalized
+
+
+def otsu_threshold(values: numpy.ndarray, bins: int = 256) -> float:
+	""" The threshold maximizing the between-class variance of `values`."""
+	counts, edges = numpy.histogram(values, bins = bins)
+	centers = (edges[:-1] + edges[1:]) / 2
+	weight_below = numpy.cumsum(counts)
+	weight_above = weight_below[-1] - weight_below
+	sum_below = numpy.cumsum(counts * centers)
+	with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+		mean_below = sum_below / weight_below
+		mean_above = (sum_below[-1] - sum_below) / weight_above
+		variance = numpy.nan_to_num(weight_below * weight_above * (mean_below - mean_above) ** 2)
+	return float(edges[numpy.argmax(variance) + 1])
+
+
+def estimate_profile(
+		source: numpy.ndarray, tile_size: int = DEFAULT_TILE_SIZE, samples: int = DEFAULT_SAMPLE_TILES,
+		polarity: Optional[str] = None) -> IntensityProfile:
+	"""
+		Estimates the intensity profile of a 2D image (array, memory map or single-channel `TiffRegionReader`) from up to
+		`samples` tiles spread evenly over it, so only a fraction of the slide is read.
+		Parameters
+		----------
+		polarity: str = None
+			'bright' or 'dark' tissue (see `IntensityProfile`). By default the Otsu class whose sampled intensities vary
+			more is taken as tissue, because the background of both fluorescence and brightfield slides is nearly flat.
+	"""
+	tiles = list(warping.iterate_tiles(source.shape, tile_size))
+	selected = numpy.unique(numpy.linspace(0, len(tiles) - 1, min(samples, len(tiles))).round().astype(int))
+	step = max(1, tile_size // 128)
+	values = numpy.concatenate([
+		numpy.asarray(source[row_start:row_stop, column_start:column_stop])[::step, ::step].ravel()
+		for row_start, row_stop, column_start, column_stop in (tiles[index] for index in selected)
+	]).astype(numpy.float64)
+	values = values[numpy.isfinite(values)]
+	if not len(values):
+		message = f"The image contains no finite intensities."
+		raise ValueError(message)
+	# The top 0.1% are clipped into the last bin, so a few saturated pixels do not squeeze the others into one bin.
+	low, high = float(values.min()), float(numpy.percentile(values, 99.9))
+	if high <= low:
+		high = low + 1.0
+	threshold = otsu_threshold(numpy.clip(values, low, high))
+	if polarity is None:
+		clipped = numpy.clip(values, low, high)
+		above, below = clipped[clipped > threshold], clipped[clipped <= threshold]
+		spread_above = above.std() if len(above) else 0.0
+		spread_below = below.std() if len(below) else 0.0
+		polarity = 'bright' if spread_above >= spread_below else 'dark'
+	return IntensityProfile(low = low, high = high, threshold = threshold, polarity = polarity)
+
+
+def _bin(values: numpy.ndarray, profile: IntensityProfile, bins: int) -> numpy.ndarray:
+	scaled = (values - profile.low) * (bins / (profile.high - profile.low))
+	return numpy.clip(scaled, 0, bins - 1).astype(numpy.intp)
+
+
+@dataclass
+class QualityReport:
+	"""
+		Parameters
+		----------
+		metrics: Dict[str, Any]
+			The global metrics; see `measure_quality`.
+		tiles: pandas.DataFrame
+			One row per reference tile: its box, the number of compared pixels, and its 'ncc', 'mutual_information' and
+			'dice' (NaN where too few pixels were compared).
+		grid_shape: Tuple[int, int]
+			The number of tile rows and columns.
+	"""
+	barcode_reference: str
+	barcode_query: str
+	metrics: Dict[str, Any]
+	tiles: pandas.DataFrame
+	grid_shape: Tuple[int, int]
+	profiles: Dict[str, IntensityProfile] = field(default_factory = dict)
+
+	def heatmap(self, metric: str = 'ncc') -> numpy.ndarray:
+		""" The per-tile metric as a [tile rows, tile columns] image. For 'ncc' the error 1 - NCC is returned."""
+		values = self.tiles[metric].to_numpy(dtype = numpy.float32).reshape(self.grid_shape)
+		return 1 - values if metric == 'ncc' else values
+
+	def to_record(self) -> Dict[str, Any]:
+		return {
+			'barcode:reference': self.barcode_reference,
+			'barcode:query':     self.barcode_query,
+			**self.metrics,
+			'profiles':          {key: vars(profile) for key, profile in self.profiles.items()}
+		}
+
+	def write(self, folder: Union[str, Path]) -> Dict[str, Path]:
+		""" Writes '{reference}-{query}.qc.json', the per-tile '.qc.tiles.tsv' table and the '.qc.heatmap.tiff' NCC error map."""
+		folder = Path(folder)
+		stem = f"{self.barcode_reference}-{self.barcode_query}.qc"
+		paths = {'record': folder / f"{stem}.json", 'tiles': folder / f"{stem}.tiles.tsv", 'heatmap': folder / f"{stem}.heatmap.tiff"}
+		paths['record'].write_text(json.dumps(self.to_record()))
+		self.tiles.to_csv(paths['tiles'], sep = "\t", index = False)
+		tifffile.imwrite(paths['heatmap'], self.heatmap('ncc'))
+		return paths
+
+
+def measure_quality(
+		reference: numpy.ndarray, query: numpy.ndarray, transform: Union[numpy.ndarray, transformmodels.TransformModel],
+		tile_size: int = DEFAULT_TILE_SIZE, bins: int = DEFAULT_BINS, method: str = 'bilinear', tissue_only: bool = True,
+		profile_reference: IntensityProfile = None, profile_query: IntensityProfile = None,
+		barcode_reference: str = 'reference', barcode_query: str = 'query') -> QualityReport:
+	"""
+		Streams the aligned tiles of a registered pair and accumulates the quality metrics.
+		Parameters
+		----------
+		reference, query: numpy.ndarray
+			2D images: arrays, memory maps or single-channel `tileplanner.TiffRegionReader`s.
+		transform: numpy.ndarray | TransformModel
+			Maps reference coordinates onto query coordinates, as exported (see `affinetransform.read_transform`).
+		tile_size: int = 512
+			The tile edge length, which is also the pixel size of the heatmap.
+		bins: int = 64
+			The number of intensity bins per image of the joint histogram.
+		tissue_only: bool = True
+			Compare only pixels that are tissue in at least one image, so that the shared background does not inflate
+			the NCC and MI.
+		profile_reference, profile_query: IntensityProfile = None
+			Defaults to `estimate_profile` of each image, which also decides whether tissue is brighter or darker than the
+			background.
+		Returns
+		-------
+		QualityReport
+			The global metrics are 'ncc', 'mutual_information', 'normalized_mutual_information', 'dice',
+			'overlap:reference' (the fraction of reference tissue covered by query tissue), 'overlap:query', 'pixels'
+			(the number compared), 'coverage' (the fraction of the reference grid the query maps onto), and a summary of
+			the tile NCCs.
+	"""
+	profile_reference = profile_reference or estimate_profile(reference, tile_size)
+	profile_query = profile_query or estimate_profile(query, tile_size)
+	shape = tuple(reference.shape[-2:])
+	moments = Moments()
+	histogram = numpy.zeros(bins * bins, dtype = numpy.int64)
+	counts = numpy.zeros(4, dtype = numpy.int64)  # Reference tissue, query tissue, both, and covered pixels.
+	records = list()
+	for box in warping.iterate_tiles(shape, tile_size):
+		row_start, row_stop, column_start, column_stop = box
+		values_reference = numpy.asarray(reference[row_start:row_stop, column_start:column_stop], dtype = numpy.float32)
+		values_query = warping.warp_region(query, transform, box, method = method, fill_value = numpy.nan, dtype = numpy.float32, threads = 1)
+
+		covered = numpy.isfinite(values_query)
+		tissue_reference = profile_reference.tissue(values_reference)
+		tissue_query = profile_query.tissue(values_query)
+		tile_counts = numpy.array([
+			numpy.count_nonzero(tissue_reference), numpy.count_nonzero(tissue_query),
+			numpy.count_nonzero(tissue_reference & tissue_query), numpy.count_nonzero(covered)
+		])
+		counts += tile_counts
+
+		compared = covered & (tissue_reference | tissue_query) if tissue_only else covered
+		values_reference, values_query = values_reference[compared], values_query[compared]
+		tile_moments = Moments.from_values(values_reference, values_query)
+		moments.merge(tile_moments)
+		tile_histogram = numpy.bincount(
+			_bin(values_reference, profile_reference, bins) * bins + _bin(values_query, profile_query, bins), minlength = bins * bins
+		)
+		histogram += tile_histogram
+
+		record = {'row:start': row_start, 'row:stop': row_stop, 'column:start': column_start, 'column:stop': column_stop, 'pixels': tile_moments.count}
+		if tile_moments.count >= MINIMUM_TILE_FRACTION * (row_stop - row_start) * (column_stop - column_start):
+			tissue = tile_counts[0] + tile_counts[1]
+			record['ncc'] = tile_moments.ncc
+			record['mutual_information'] = mutual_information(tile_histogram.reshape(bins, bins))[0]
+			record['dice'] = 2 * tile_counts[2] / tissue if tissue else numpy.nan
+		records.append(record)
+
+	tiles = pandas.DataFrame(records, columns = ['row:start', 'row:stop', 'column:start', 'column:stop', 'pixels', 'ncc', 'mutual_information', 'dice'])
+	information, normalized = mutual_information(histogram.reshape(bins, bins))
+	tile_ncc = tiles['ncc'].dropna()
+	metrics = {
+		'ncc':                           moments.ncc,
+		'mutual_information':            information,
+		'normalized_mutual_information': normalized,
+		'dice':                          2 * counts[2] / (counts[0] + counts[1]) if counts[0] + counts[1] else numpy.nan,
+		'overlap:reference':             counts[2] / counts[0] if counts[0] else numpy.nan,
+		'overlap:query':                 counts[2] / counts[1] if counts[1] else numpy.nan,
+		'pixels':                        moments.count,
+		'coverage':                      counts[3] / (shape[0] * shape[1]),
+		'tiles':                         len(tiles),
+		'tiles:measured':                len(tile_ncc),
+		'tiles:ncc:median':              float(tile_ncc.median()) if len(tile_ncc) else numpy.nan,
+		'tiles:ncc:p10':                 float(tile_ncc.quantile(0.1)) if len(tile_ncc) else numpy.nan
+	}
+	# Plain floats (NaN included) keep the record JSON-serializable.
+	metrics = {key: float(value) if isinstance(value, (float, numpy.floating)) else int(value) for key, value in metrics.items()}
+	grid_shape = (-(-shape[0] // tile_size), -(-shape[1] // tile_size))
+	logger.debug(f"QC {barcode_reference} -> {barcode_query}: NCC {metrics['ncc']:.3f}, NMI {metrics['normalized_mutual_information']:.3f}, Dice {metrics['dice']:.3f} over {len(tiles)} tiles")
+	return QualityReport(
+		barcode_reference = barcode_reference, barcode_query = barcode_query, metrics = metrics, tiles = tiles,
+		grid_shape = grid_shape, profiles = {'reference': profile_reference, 'query': profile_query}
+	)
+
+
+@dataclass
+class QualityJob:
+	barcode_reference: str
+	barcode_query: str
+	path_reference: Path
+	path_query: Path
+	path_transform: Path
+	folder_output: Path
+	channel: Union[int, str] = 0
+	tile_size: int = DEFAULT_TILE_SIZE
+	bins: int = DEFAULT_BINS
+	polarity: Optional[str] = None
+
+
+def _run_job(job: QualityJob) -> Dict[str, Any]:
+	transform = affinetransform.read_transform(job.path_transform)
+	with tileplanner.TiffRegionReader(job.path_reference) as reader_reference, tileplanner.TiffRegionReader(job.path_query) as reader_query:
+		reader_reference, reader_query = reader_reference.select_channels(job.channel), reader_query.select_channels(job.channel)
+		report = measure_quality(
+			reader_reference, reader_query, transform, tile_size = job.tile_size, bins = job.bins,
+			profile_reference = estimate_profile(reader_reference, job.tile_size, polarity = job.polarity),
+			profile_query = estimate_profile(reader_query, job.tile_size, polarity = job.polarity),
+			barcode_reference = job.barcode_reference, barcode_query = job.barcode_query
+		)
+	report.write(job.folder_output)
+	return report.to_record()
+
+
+def measure_qualities(jobs: Sequence[QualityJob], processes: int = None) -> pandas.DataFrame:
+	"""
+		Runs several QC jobs in parallel, one image pair per worker process, and writes each pair's files.
+		Returns
+		-------
+		pandas.DataFrame
+			One row of global metrics per pair.
+	"""
+	if processes == 1 or len(jobs) <= 1:
+		records = [_run_job(job) for job in jobs]
+	else:
+		with ProcessPoolExecutor(max_workers = processes) as executor:
+			records = list(executor.map(_run_job, jobs))
+	return pandas.DataFrame([{key: value for key, value in record.items() if key != 'profiles'} for record in records])
+
+
+def get_jobs(path_table: Union[str, Path], folder_transforms: Union[str, Path], folder_output: Union[str, Path], **kwargs) -> List[QualityJob]:
+	"""
+		The QC jobs of the pairs of an `ImageManager` table whose transforms were exported into `folder_transforms`.
+		Pairs that have not been exported yet are skipped with a warning. Other keyword arguments are set on every job.
+	"""
+	jobs = list()
+	for pair in ImageManager.read_table(path_table):
+		path_transform = affinetransform.get_export_path(folder_transforms, pair.barcode_reference, pair.barcode_query)
+		if not path_transform.exists():
+			logger.warning(f"No exported transform for {pair.barcode_reference} -> {pair.barcode_query} in group {pair.id_group}")
+			continue
+		jobs.append(QualityJob(
+			barcode_reference = pair.barcode_reference, barcode_query = pair.barcode_query,
+			path_reference = Path(pair.path_reference), path_query = Path(pair.path_query),
+			path_transform = path_transform, folder_output = Path(folder_output), **kwargs
+		))
+	return jobs
+
+
+def main(arguments: List[str] = None):
+	parser = argparse.ArgumentParser(description = "Measure the registration quality of every exported pair of an image table.")
+	parser.add_argument('--table', required = True, type = Path, help = "The tab-separated table with 'id:group', 'barcode' and 'path' columns.")
+	parser.add_argument('--transforms', required = True, type = Path, help = "The folder of '*.transform.calculated.json' files.")
+	parser.add_argument('--output-folder', required = True, type = Path)
+	parser.add_argument(
+		'--channel', default = '0',
+		help = "The channel compared in both images: an index, or a name such as 'Brightfield' read from the OME metadata."
+	)
+	parser.add_argument(
+		'--polarity', choices = POLARITIES, default = None,
+		help = "Whether tissue is brighter ('bright', fluorescence) or darker ('dark', brightfield) than the background. Detected per image by default."
+	)
+	parser.add_argument('--tile-size', type = int, default = DEFAULT_TILE_SIZE)
+	parser.add_argument('--bins', type = int, default = DEFAULT_BINS)
+	parser.add_argument('--processes', type = int, default = None)
+	args = parser.parse_args(arguments)
+
+	args.output_folder.mkdir(parents = True, exist_ok = True)
+	channel = int(args.channel) if args.channel.isdigit() else args.channel
+	jobs = get_jobs(
+		args.table, args.transforms, args.output_folder, channel = channel, tile_size = args.tile_size, bins = args.bins,
+		polarity = args.polarity
+	)
+	summary = measure_qualities(jobs, processes = args.processes)
+	summary.to_csv(args.output_folder / "quality-control.tsv", sep = "\t", index = False)
+
+
+if __name__ == "__main__":
+	main()
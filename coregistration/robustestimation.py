@@ -0,0 +1,215 @@
+from dataclasses import dataclass
+from typing import *
+
+import numpy
+from loguru import logger
+
+from coregistration import affinetransform
+
+SAMPLE_SIZE = 3  # Number of correspondences that determine an affine transform.
+MAXIMUM_BATCH_ELEMENTS = 2 ** 22  # Upper bound on hypotheses * points evaluated at once.
+
+
+@dataclass
+class RansacResult:
+	"""
+		The result of a robust affine fit.
+		Parameters
+		----------
+		matrix: numpy.ndarray
+			The 3x3 affine matrix refit by least squares on the inliers.
+		inliers: numpy.ndarray
+			Boolean mask of the correspondences consistent with `matrix`.
+		iterations: int
+			The number of minimal-sample hypotheses that were scored.
+		rmse: float
+			Root-mean-square error of the inliers under `matrix`.
+	"""
+	matrix: numpy.ndarray
+	inliers: numpy.ndarray
+	iterations: int
+	rmse: float
+
+	@property
+	def inlier_count(self) -> int:
+		return int(self.inliers.sum())
+
+
+def _coerce_generator(seed: Union[int, numpy.random.Generator, None]) -> numpy.random.Generator:
+	if isinstance(seed, numpy.random.Generator):
+		return seed
+	return numpy.random.default_rng(seed)
+
+
+def _sample_indices(generator: numpy.random.Generator, number_of_points: int, number_of_samples: int) -> numpy.ndarray:
+	""" Draws `number_of_samples` minimal samples of distinct point indices. Returns an [m, 3] array with m <= number_of_samples."""
+	indices = generator.integers(0, number_of_points, size = (number_of_samples, SAMPLE_SIZE))
+	distinct = (indices[:, 0] != indices[:, 1]) & (indices[:, 0] != indices[:, 2]) & (indices[:, 1] != indices[:, 2])
+	return indices[distinct]
+
+
+def solve_minimal_affine(coordinates_left: numpy.ndarray, coordinates_right: numpy.ndarray, samples: numpy.ndarray) -> Tuple[numpy.ndarray, numpy.ndarray]:
+	"""
+		Solves the exact affine transform for each 3-point sample.
+		Parameters
+		----------
+		coordinates_left, coordinates_right: numpy.ndarray
+			[n, 2] arrays of matching points.
+		samples: numpy.ndarray
+			[m, 3] array of point indices.
+		Returns
+		-------
+		Tuple[numpy.ndarray, numpy.ndarray]
+			The [m, 2, 3] stack of transform rows and a boolean mask of the samples that were not degenerate.
+	"""
+	design = numpy.ones((len(samples), SAMPLE_SIZE, 3))
+	design[:, :, :2] = coordinates_left[samples]
+	targets = coordinates_right[samples]
+
+	# Reject (nearly) collinear samples: the triangle area relative to its squared size.
+	determinant = numpy.linalg.det(design)
+	extent = numpy.ptp(design[:, :, :2], axis = 1).max(axis = 1)
+	valid = numpy.abs(determinant) > 1E-6 * numpy.maximum(extent, 1E-12) ** 2
+
+	hypotheses = numpy.zeros((len(samples), 2, 3))
+	hypotheses[valid] = numpy.linalg.solve(design[valid], targets[valid]).transpose(0, 2, 1)
+	return hypotheses, valid
+
+
+def squared_residuals(hypotheses: numpy.ndarray, coordinates_left: numpy.ndarray, coordinates_right: numpy.ndarray) -> numpy.ndarray:
+	""" Evaluates the squared transfer error of every point under every hypothesis. Returns an [m, n] array."""
+	x = coordinates_left[:, 0]
+	y = coordinates_left[:, 1]
+	error_x = hypotheses[:, 0, 0, None] * x + hypotheses[:, 0, 1, None] * y + hypotheses[:, 0, 2, None] - coordinates_right[:, 0]
+	error_y = hypotheses[:, 1, 0, None] * x + hypotheses[:, 1, 1, None] * y + hypotheses[:, 1, 2, None] - coordinates_right[:, 1]
+	return error_x ** 2 + error_y ** 2
+
+
+def _score(errors: numpy.ndarray, threshold_squared: float, scoring: str) -> numpy.ndarray:
+	""" Returns a cost for each row of `errors` (lower is better)."""
+	if scoring == 'msac':
+		return numpy.minimum(errors, threshold_squared).sum(axis = -1)
+	return -(errors < threshold_squared).sum(axis = -1).astype(numpy.float64)
+
+
+def _required_iterations(inlier_ratio: float, confidence: float) -> float:
+	if inlier_ratio <= 0:
+		return numpy.inf
+	if inlier_ratio >= 1:
+		return 0
+	probability_all_inliers = inlier_ratio ** SAMPLE_SIZE
+	return numpy.log(1 - confidence) / numpy.log1p(-probability_all_inliers)
+
+
+def _refit(coordinates_left: numpy.ndarray, coordinates_right: numpy.ndarray, inliers: numpy.ndarray) -> Optional[numpy.ndarray]:
+	if inliers.sum() < SAMPLE_SIZE:
+		return None
+	solution = affinetransform.solve_affine_least_squares(coordinates_left[inliers], coordinates_right[inliers])
+	return solution.matrix[:2]
+
+
+def ransac_affine(
+		coordinates_left: numpy.ndarray, coordinates_right: numpy.ndarray, threshold: float = 3.0,
+		confidence: float = 0.999, max_iterations: int = 10_000, batch_size: int = 256,
+		scoring: Literal['ransac', 'msac'] = 'msac', local_optimization: int = 3,
+		seed: Union[int, numpy.random.Generator, None] = None) -> RansacResult:
+	"""
+		Robustly fits the affine transform mapping `coordinates_left` onto `coordinates_right`.
+
+		Minimal 3-point hypotheses are generated and scored in batches, with the residuals of every point under
+		every hypothesis in the batch evaluated at once. The number of iterations adapts to the best inlier ratio
+		seen so far and stops once `confidence` is reached.
+		Parameters
+		----------
+		coordinates_left, coordinates_right: numpy.ndarray
+			[n, 2] arrays of matching points (n >= 3).
+		threshold: float = 3.0
+			The maximum transfer error (in the units of `coordinates_right`) of an inlier.
+		confidence: float = 0.999
+			The probability of having drawn at least one all-inlier sample before stopping early.
+		max_iterations: int = 10000
+			Upper bound on the number of hypotheses.
+		batch_size: int = 256
+			The number of hypotheses scored together. Reduced automatically for very large point sets.
+		scoring: Literal['ransac', 'msac'] = 'msac'
+			'ransac' counts inliers, 'msac' sums the truncated squared errors.
+		local_optimization: int = 3
+			The number of least-squares refinements (LO-RANSAC) applied each time a better hypothesis is found. 0 disables it.
+		seed: int | numpy.random.Generator = None
+			Seed for the sampler, for reproducible results.
+	"""
+	if scoring not in {'ransac', 'msac'}:
+		message = f"Invalid scoring method: {scoring}"
+		raise ValueError(message)
+	coordinates_left, coordinates_right, _ = affinetransform.validate_correspondences(coordinates_left, coordinates_right)
+	coordinates_left = coordinates_left.astype(numpy.float64, copy = False)
+	coordinates_right = coordinates_right.astype(numpy.float64, copy = False)
+	number_of_points = len(coordinates_left)
+	if number_of_points < SAMPLE_SIZE:
+		message = f"At least {SAMPLE_SIZE} correspondences are required, got {number_of_points}."
+		raise ValueError(message)
+
+	generator = _coerce_generator(seed)
+	threshold_squared = float(threshold) ** 2
+	batch_size = max(1, min(batch_size, MAXIMUM_BATCH_ELEMENTS // number_of_points))
+
+	best_hypothesis = None
+	best_cost = numpy.inf
+	best_inliers = numpy.zeros(number_of_points, dtype = bool)
+	required = max_iterations
+	iterations = 0
+
+	while iterations < min(required, max_iterations):
+		samples = _sample_indices(generator, number_of_points, min(batch_size, max_iterations - iterations))
+		# Only the distinct samples are evaluated, so only they count towards the iterations.
+		iterations += len(samples)
+		hypotheses, valid = solve_minimal_affine(coordinates_left, coordinates_right, samples)
+		if not valid.any():
+			continue
+		hypotheses = hypotheses[valid]
+
+		costs = _score(squared_residuals(hypotheses, coordinates_left, coordinates_right), threshold_squared, scoring)
+		index = int(numpy.argmin(costs))
+		if costs[index] >= best_cost:
+			continue
+
+		best_cost = costs[index]
+		best_hypothesis = hypotheses[index]
+		best_inliers = squared_residuals(best_hypothesis[None], coordinates_left, coordinates_right)[0] < threshold_squared
+
+		# LO-RANSAC: refine the new best hypothesis on its own inliers while that keeps improving the score.
+		for _ in range(local_optimization):
+			refined = _refit(coordinates_left, coordinates_right, best_inliers)
+			if refined is None:
+				break
+			errors = squared_residuals(refined[None], coordinates_left, coordinates_right)[0]
+			cost = _score(errors, threshold_squared, scoring)
+			if cost >= best_cost:
+				break
+			best_cost = cost
+			best_hypothesis = refined
+			best_inliers = errors < threshold_squared
+
+		required = _required_iterations(best_inliers.mean(), confidence)
+
+	if best_hypothesis is None:
+		message = f"Could not find a non-degenerate sample after {iterations} iterations. The points may be collinear."
+		raise ValueError(message)
+
+	# Final least-squares refit on the consensus set.
+	refined = _refit(coordinates_left, coordinates_right, best_inliers)
+	if refined is not None:
+		errors = squared_residuals(refined[None], coordinates_left, coordinates_right)[0]
+		inliers = errors < threshold_squared
+		if inliers.sum() >= best_inliers.sum():
+			best_hypothesis = refined
+			best_inliers = inliers
+	else:
+		logger.warning(f"Only {int(best_inliers.sum())} inliers were found; returning the best minimal-sample hypothesis.")
+
+	errors = squared_residuals(best_hypothesis[None], coordinates_left, coordinates_right)[0]
+	rmse = float(numpy.sqrt(errors[best_inliers].mean())) if best_inliers.any() else numpy.nan
+
+	matrix = numpy.eye(3)
+	matrix[:2] = best_hypothesis
+	return RansacResult(matrix = matrix, inliers = best_inliers, iterations = iterations, rmse = rmse)
@@ -0,0 +1,227 @@
+"""
+	Streams large per-cell tables (CSV/TSV/Parquet) through a transform, e.g. to map cell centroids measured on a
+	query slide into the frame of its reference slide.
+
+	Usage:
+		python -m coregistration.tabletransform --transform A-B.transform.calculated.json --columns x y --output-folder out/ cells.csv
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import *
+
+import numpy
+import pandas
+from loguru import logger
+
+from coregistration import affinetransform, transformmodels
+
+DEFAULT_BATCH_SIZE = 500_000
+PARQUET_SUFFIXES = {'.parquet', '.pq'}
+
+
+@dataclass
+class TableTransformJob:
+	path_input: Path
+	path_output: Path
+	matrix: numpy.ndarray
+	columns: Tuple[str, str] = ('x', 'y')
+	suffix: Optional[str] = None
+	batch_size: int = DEFAULT_BATCH_SIZE
+
+
+def _import_pyarrow():
+	try:
+		import pyarrow
+		import pyarrow.parquet
+	except ImportError as exception:
+		message = f"Reading or writing parquet files requires the `pyarrow` package."
+		raise ImportError(message) from exception
+	return pyarrow
+
+
+def _get_separator(path: Path) -> str:
+	suffixes = [suffix.lower() for suffix in path.suffixes]
+	return "\t" if '.tsv' in suffixes or '.txt' in suffixes else ","
+
+
+def _is_parquet(path: Path) -> bool:
+	return path.suffix.lower() in PARQUET_SUFFIXES
+
+
+def read_batches(path: Path, batch_size: int = DEFAULT_BATCH_SIZE) -> Iterator[pandas.DataFrame]:
+	""" Yields the rows of a CSV/TSV/Parquet table as DataFrames of at most `batch_size` rows."""
+	path = Path(path)
+	if _is_parquet(path):
+		pyarrow = _import_pyarrow()
+		parquet_file = pyarrow.parquet.ParquetFile(path)
+		for batch in parquet_file.iter_batches(batch_size = batch_size):
+			yield batch.to_pandas()
+	else:
+		yield from pandas.read_csv(path, sep = _get_separator(path), chunksize = batch_size)
+
+
+class TableWriter:
+	""" Appends DataFrame batches to a CSV/TSV/Parquet file. Use as a context manager."""
+
+	def __init__(self, path: Path):
+		self.path = Path(path)
+		self.rows = 0
+		self._parquet_writer = None
+		self._schema = None
+		self._header_written = False
+
+	def __enter__(self) -> Self:
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def write(self, table: pandas.DataFrame):
+		if _is_parquet(self.path):
+			pyarrow = _import_pyarrow()
+			batch = pyarrow.Table.from_pandas(table, preserve_index = False)
+			if self._parquet_writer is None:
+				self._schema = batch.schema
+				self._parquet_writer = pyarrow.parquet.ParquetWriter(self.path, self._schema)
+			elif not batch.schema.equals(self._schema):
+				# pandas infers the dtypes of every CSV chunk separately, e.g. an int column becomes float once it has gaps.
+				try:
+					batch = batch.cast(self._schema)
+				except (pyarrow.ArrowInvalid, pyarrow.ArrowNotImplementedError, ValueError) as exception:
+					message = f"Rows {self.rows}-{self.rows + len(table)} of {self.path.name} do not fit the column types of the first batch ({self._schema}): {exception}"
+					raise ValueError(message) from exception
+			self._parquet_writer.write_table(batch)
+		else:
+			table.to_csv(
+				self.path, sep = _get_separator(self.path), index = False,
+				mode = 'a' if self._header_written else 'w', header = not self._header_written
+			)
+			self._header_written = True
+		self.rows += len(table)
+
+	def close(self):
+		if self._parquet_writer is not None:
+			self._parquet_writer.close()
+			self._parquet_writer = None
+
+
+def transform_dataframe(table: pandas.DataFrame, matrix: numpy.ndarray, columns: Tuple[str, str] = ('x', 'y'), suffix: Optional[str] = None) -> pandas.DataFrame:
+	"""
+		Applies `matrix` to the x/y columns of `table`.
+		Parameters
+		----------
+		table: pandas.DataFrame
+		matrix: numpy.ndarray
+			The 3x3 transform, or a `transformmodels.TransformModel` such as a piecewise-affine transform.
+		columns: Tuple[str, str] = ('x', 'y')
+			The names of the x and y columns.
+		suffix: str = None
+			If given, the transformed values are written to new columns named `{column}{suffix}`. Otherwise the columns are replaced.
+	"""
+	missing = [column for column in columns if column not in table.columns]
+	if missing:
+		message = f"The table does not contain the coordinate columns {missing}. Available columns: {list(table.columns)}"
+		raise ValueError(message)
+
+	coordinates = table[list(columns)].to_numpy(dtype = numpy.float64)
+	if isinstance(matrix, transformmodels.TransformModel):
+		transformed = matrix.apply(coordinates)
+	else:
+		transformed = affinetransform.apply_transform(matrix, coordinates)
+	column_x, column_y = columns if suffix is None else (f"{column}{suffix}" for column in columns)
+	table[column_x] = transformed[:, 0]
+	table[column_y] = transformed[:, 1]
+	return table
+
+
+def transform_table(
+		path_input: Path, path_output: Path, matrix: numpy.ndarray, columns: Tuple[str, str] = ('x', 'y'),
+		suffix: Optional[str] = None, batch_size: int = DEFAULT_BATCH_SIZE) -> int:
+	"""
+		Streams a table through `transform_dataframe` one batch at a time, so memory use is bounded by `batch_size`.
+		The input and output formats are chosen from the file extensions (.csv, .tsv, .parquet).
+		Returns
+		-------
+		int
+			The number of rows written.
+	"""
+	path_input = Path(path_input)
+	path_output = Path(path_output)
+	if path_input.resolve() == path_output.resolve():
+		message = f"The output file must differ from the input file: {path_input}"
+		raise ValueError(message)
+
+	try:
+		with TableWriter(path_output) as writer:
+			for batch in read_batches(path_input, batch_size = batch_size):
+				writer.write(transform_dataframe(batch, matrix, columns = columns, suffix = suffix))
+	except Exception:
+		# Do not leave a truncated table behind.
+		path_output.unlink(missing_ok = True)
+		raise
+	logger.debug(f"Transformed {writer.rows} rows from {path_input.name} into {path_output}")
+	return writer.rows
+
+
+def _run_job(job: TableTransformJob) -> int:
+	return transform_table(job.path_input, job.path_output, job.matrix, columns = job.columns, suffix = job.suffix, batch_size = job.batch_size)
+
+
+def transform_tables(jobs: Sequence[TableTransformJob], processes: int = None) -> Dict[Path, int]:
+	"""
+		Runs several table transforms in parallel, one file per worker process.
+		Returns
+		-------
+		Dict[Path, int]
+			The number of rows written to each output file.
+	"""
+	if processes == 1 or len(jobs) <= 1:
+		return {job.path_output: _run_job(job) for job in jobs}
+	with ProcessPoolExecutor(max_workers = processes) as executor:
+		rows = list(executor.map(_run_job, jobs))
+	return {job.path_output: count for job, count in zip(jobs, rows)}
+
+
+def get_output_path(path_input: Path, folder_output: Path, suffix: str = '.reference') -> Path:
+	""" 'cells.csv' -> '{folder_output}/cells.reference.csv'"""
+	path_input = Path(path_input)
+	extension = "".join(path_input.suffixes)
+	stem = path_input.name[:-len(extension)] if extension else path_input.name
+	return Path(folder_output) / f"{stem}{suffix}{extension}"
+
+
+def main(arguments: List[str] = None):
+	parser = argparse.ArgumentParser(description = "Transform the coordinate columns of cell tables with an exported transform.")
+	parser.add_argument('tables', nargs = '+', type = Path, help = "CSV/TSV/Parquet files to transform.")
+	parser.add_argument('--transform', required = True, type = Path, help = "A '*.transform.calculated.json' file written by the GUI.")
+	parser.add_argument('--columns', nargs = 2, default = ['x', 'y'], metavar = ('X', 'Y'), help = "The coordinate columns.")
+	parser.add_argument('--output-folder', required = True, type = Path)
+	parser.add_argument('--suffix', default = None, help = "Write the transformed coordinates to new '{column}{suffix}' columns instead of replacing them.")
+	parser.add_argument(
+		'--direction', choices = ['query-to-reference', 'reference-to-query'], default = 'query-to-reference',
+		help = "The exported matrix maps reference to query coordinates; the default applies its inverse."
+	)
+	parser.add_argument('--batch-size', type = int, default = DEFAULT_BATCH_SIZE)
+	parser.add_argument('--processes', type = int, default = None)
+	args = parser.parse_args(arguments)
+
+	matrix = affinetransform.read_transform(args.transform, invert = args.direction == 'query-to-reference')
+	args.output_folder.mkdir(parents = True, exist_ok = True)
+	jobs = [
+		TableTransformJob(
+			path_input = path,
+			path_output = get_output_path(path, args.output_folder),
+			matrix = matrix,
+			columns = tuple(args.columns),
+			suffix = args.suffix,
+			batch_size = args.batch_size
+		)
+		for path in args.tables
+	]
+	transform_tables(jobs, processes = args.processes)
+
+
+if __name__ == "__main__":
+	main()
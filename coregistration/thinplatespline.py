@@ -0,0 +1,281 @@
+"""
+	Thin-plate-spline (TPS) transforms for smooth non-rigid deformations fitted from clicked point pairs.
+
+	A TPS is an affine transform plus a sum of radial kernels U(r) = r^2 log(r) centered on the control points. Evaluating
+	it directly costs one kernel per control point per transformed point, so `ThinPlateSplineTransform.apply` works in
+	chunks with float32 kernels to bound memory. For whole slides (every output pixel of a warp, or tens of millions of
+	cell centroids) `ThinPlateSplineTransform.to_grid` evaluates the spline once on a coarse grid, and the returned
+	`GridTransform` bilinearly interpolates it at the cost of a few gathers per point.
+"""
+import math
+from typing import *
+
+import numpy
+from loguru import logger
+
+from coregistration import affinetransform, pointrefinement, transformmodels
+from coregistration.transformmodels import TransformModel
+
+DEFAULT_GRID_SPACING = 32
+KERNEL_CHUNK_ELEMENTS = 2 ** 22  # Points times control points evaluated at once, i.e. 16 MB of float32 kernels.
+
+
+def _kernel(squared_distances: numpy.ndarray) -> numpy.ndarray:
+	""" U = r^2 log(r) = r^2 log(r^2) / 2, computed in place on the squared distances. U(0) = 0."""
+	logarithm = numpy.log(numpy.maximum(squared_distances, numpy.finfo(squared_distances.dtype).tiny))
+	squared_distances *= logarithm
+	squared_distances *= 0.5
+	return squared_distances
+
+
+class ThinPlateSplineTransform(TransformModel):
+	"""
+		Parameters
+		----------
+		control_points: numpy.ndarray
+			[n, 2] left control points the kernels are centered on.
+		kernel_weights: numpy.ndarray
+			[n, 2] weight of each kernel, in the normalized coordinates.
+		matrix: numpy.ndarray
+			The 3x3 affine part of the spline, in pixels.
+		center, scale:
+			The left coordinates are normalized as (p - center) / scale before the kernels are evaluated.
+	"""
+	name = 'thin-plate-spline'
+	degrees_of_freedom = None
+	minimum_points = 3
+	rank = 7
+	has_matrix = False
+
+	def __init__(self, control_points: numpy.ndarray, kernel_weights: numpy.ndarray, matrix: numpy.ndarray, center: numpy.ndarray, scale: float):
+		super().__init__(matrix)
+		self.control_points = numpy.asarray(control_points, dtype = numpy.float64)
+		self.kernel_weights = numpy.asarray(kernel_weights, dtype = numpy.float64)
+		self.center = numpy.asarray(center, dtype = numpy.float64)
+		self.scale = float(scale)
+
+	def __repr__(self) -> str:
+		return f"{self.__class__.__name__}(points={len(self.control_points)})"
+
+	@classmethod
+	def from_matrix(cls, matrix: numpy.ndarray) -> Self:
+		message = f"A {cls.__name__} cannot be built from a matrix alone; use `fit` with control points."
+		raise ValueError(message)
+
+	@classmethod
+	def fit(
+			cls, coordinates_left: numpy.ndarray, coordinates_right: numpy.ndarray, weights: numpy.ndarray = None,
+			regularization: float = 0.0) -> Self:
+		"""
+			Fits the spline mapping `coordinates_left` onto `coordinates_right`.
+			Parameters
+			----------
+			weights: numpy.ndarray = None
+				Optional confidence of each pair. The smoothing of a pair is divided by its weight.
+			regularization: float = 0.0
+				Smoothing, relative to the bending energy of the spread of the points. 0 interpolates the points exactly;
+				larger values trade exactness for smoothness and approach the least-squares affine.
+		"""
+		coordinates_left, coordinates_right, weights = affinetransform.validate_correspondences(coordinates_left, coordinates_right, weights)
+		if len(coordinates_left) < cls.minimum_points:
+			message = f"{cls.__name__} requires at least {cls.minimum_points} points, got {len(coordinates_left)}."
+			raise ValueError(message)
+		left = coordinates_left.astype(numpy.float64)
+		right = coordinates_right.astype(numpy.float64)
+		center = left.mean(axis = 0)
+		scale = float(numpy.abs(left - center).max()) or 1.0
+		normalized = (left - center) / scale
+		count = len(left)
+
+		difference = normalized[:, None, :] - normalized[None, :, :]
+		system = numpy.zeros((count + 3, count + 3))
+		system[:count, :count] = _kernel((difference ** 2).sum(axis = 2))
+		if regularization > 0:
+			smoothing = regularization if weights is None else regularization / numpy.maximum(weights, 1E-12)
+			system[:count, :count] += numpy.diag(numpy.broadcast_to(smoothing, count))
+		system[:count, count] = 1
+		system[:count, count + 1:] = normalized
+		system[count:, :count] = system[:count, count:].T
+		values = numpy.zeros((count + 3, 2))
+		values[:count] = right
+		try:
+			solution = numpy.linalg.solve(system, values)
+		except numpy.linalg.LinAlgError as exception:
+			message = f"Cannot fit a thin-plate spline to these points (are they collinear or duplicated?)"
+			raise ValueError(message) from exception
+
+		# The affine part q = a0 + A (p - center) / scale, in pixels.
+		offset, linear = solution[count], solution[count + 1:].T / scale
+		matrix = numpy.eye(3)
+		matrix[:2, :2] = linear
+		matrix[:2, 2] = offset - linear @ center
+		return cls(left, solution[:count], matrix, center, scale)
+
+	def kernel_displacement(
+			self, coordinates: numpy.ndarray, chunk_size: int = None, dtype: numpy.dtype = numpy.float32) -> numpy.ndarray:
+		"""
+			The non-affine part of the spline at [m, 2] points: the sum of the weighted kernels.
+			Parameters
+			----------
+			chunk_size: int = None
+				The number of points evaluated at once. Defaults to bounding the kernel matrix to `KERNEL_CHUNK_ELEMENTS`.
+			dtype: numpy.dtype = numpy.float32
+				The kernel precision. The coordinates are normalized first, so float32 kernels lose well under 0.01 pixels.
+		"""
+		coordinates = affinetransform.coerce_to_array(coordinates, dtype = numpy.float64)
+		if chunk_size is None:
+			chunk_size = max(1, KERNEL_CHUNK_ELEMENTS // max(len(self.control_points), 1))
+		controls = ((self.control_points - self.center) / self.scale).astype(dtype)
+		controls_squared = (controls ** 2).sum(axis = 1)
+		kernel_weights = self.kernel_weights.astype(dtype)
+		result = numpy.empty((len(coordinates), 2), dtype = numpy.float64)
+		for chunk in affinetransform.iterate_chunks(len(coordinates), chunk_size):
+			points = ((coordinates[chunk] - self.center) / self.scale).astype(dtype)
+			squared = (points ** 2).sum(axis = 1)[:, None] + controls_squared[None, :]
+			squared -= 2 * (points @ controls.T)
+			numpy.maximum(squared, 0, out = squared)
+			result[chunk] = _kernel(squared) @ kernel_weights
+		return result
+
+	def apply(self, coordinates: numpy.ndarray, chunk_size: int = None, dtype: numpy.dtype = numpy.float32) -> numpy.ndarray:
+		""" Evaluates the spline at an [m, 2] array of points. See `kernel_displacement` for the parameters."""
+		coordinates = affinetransform.coerce_to_array(coordinates)
+		result = affinetransform.apply_transform(self.matrix, coordinates, dtype = numpy.float64)
+		result += self.kernel_displacement(coordinates, chunk_size = chunk_size, dtype = dtype)
+		return result.astype(coordinates.dtype, copy = False)
+
+	def inverse(self, regularization: float = 0.0) -> 'ThinPlateSplineTransform':
+		""" A spline fitted in the opposite direction. The inverse of a TPS is not a TPS, so this is exact only at the control points."""
+		return ThinPlateSplineTransform.fit(self.apply(self.control_points), self.control_points, regularization = regularization)
+
+	def compose(self, other: TransformModel) -> 'ThinPlateSplineTransform':
+		""" Returns the spline that applies `self` first and then the affine `other`, which is again a TPS."""
+		if not self.can_compose(other):
+			message = f"A thin-plate spline can only be followed by an affine transform, got {other!r}."
+			raise ValueError(message)
+		matrix = other.to_matrix()
+		return ThinPlateSplineTransform(self.control_points, self.kernel_weights @ matrix[:2, :2].T, matrix @ self.matrix, self.center, self.scale)
+
+	def can_compose(self, other: TransformModel) -> bool:
+		return transformmodels.is_affine_model(other)
+
+	def to_matrix(self) -> numpy.ndarray:
+		""" The affine part of the spline."""
+		return self.matrix.copy()
+
+	def to_parameters(self) -> Dict[str, float]:
+		return {'points': len(self.control_points), 'bending': float(numpy.abs(self.kernel_weights).sum())}
+
+	def to_grid(
+			self, shape: Tuple[int, int], spacing: float = DEFAULT_GRID_SPACING, origin: Tuple[float, float] = (0, 0),
+			dtype: numpy.dtype = numpy.float32) -> 'GridTransform':
+		"""
+			Evaluates the spline on a coarse grid covering a [height, width] region of left coordinates (e.g. the output
+			shape of a warp, or the extent of a cell table), for fast approximate evaluation with `GridTransform`.
+			Parameters
+			----------
+			shape: Tuple[int, int]
+				The (height, width) of the region.
+			spacing: float = 32
+				The distance between grid nodes in pixels. The interpolation error shrinks with its square.
+			origin: Tuple[float, float] = (0, 0)
+				The (x, y) position of the first node.
+		"""
+		height, width = shape
+		columns = max(2, int(math.ceil(width / spacing)) + 1)
+		rows = max(2, int(math.ceil(height / spacing)) + 1)
+		node_y, node_x = numpy.mgrid[0:rows, 0:columns]
+		nodes = numpy.column_stack((node_x.ravel(), node_y.ravel())) * spacing + numpy.asarray(origin, dtype = numpy.float64)
+		displacement = self.kernel_displacement(nodes, dtype = dtype)
+		logger.debug(f"Evaluated a thin-plate spline with {len(self.control_points)} points on a {rows}x{columns} grid")
+		return GridTransform(
+			displacement[:, 0].reshape(rows, columns).astype(numpy.float32), displacement[:, 1].reshape(rows, columns).astype(numpy.float32),
+			self.matrix, spacing = spacing, origin = origin
+		)
+
+
+class GridTransform(TransformModel):
+	"""
+		An affine transform plus a displacement sampled on a regular grid and interpolated bilinearly, e.g. a thin-plate
+		spline reduced with `ThinPlateSplineTransform.to_grid`. Outside the grid only the affine part applies.
+		Parameters
+		----------
+		displacement_x, displacement_y: numpy.ndarray
+			[rows, columns] displacement added to the affine part at each node.
+		matrix: numpy.ndarray
+			The 3x3 affine part.
+		spacing: float
+			The distance between nodes.
+		origin: Tuple[float, float] = (0, 0)
+			The (x, y) position of node [0, 0].
+	"""
+	name = 'grid'
+	degrees_of_freedom = None
+	minimum_points = 0
+	rank = 7
+	has_matrix = False
+
+	def __init__(
+			self, displacement_x: numpy.ndarray, displacement_y: numpy.ndarray, matrix: numpy.ndarray, spacing: float,
+			origin: Tuple[float, float] = (0, 0)):
+		super().__init__(matrix)
+		self.displacement_x = numpy.asarray(displacement_x)
+		self.displacement_y = numpy.asarray(displacement_y)
+		if self.displacement_x.shape != self.displacement_y.shape or self.displacement_x.ndim != 2:
+			message = f"Expected two displacement grids of the same 2D shape, got {self.displacement_x.shape} and {self.displacement_y.shape}"
+			raise ValueError(message)
+		self.spacing = float(spacing)
+		self.origin = numpy.asarray(origin, dtype = numpy.float64)
+
+	def __repr__(self) -> str:
+		return f"{self.__class__.__name__}(shape={self.displacement_x.shape}, spacing={self.spacing:g})"
+
+	@classmethod
+	def from_matrix(cls, matrix: numpy.ndarray) -> Self:
+		message = f"A {cls.__name__} cannot be built from a matrix alone."
+		raise ValueError(message)
+
+	@classmethod
+	def fit(cls, coordinates_left: numpy.ndarray, coordinates_right: numpy.ndarray, weights: numpy.ndarray = None) -> Self:
+		message = f"A {cls.__name__} is not fitted directly; use `ThinPlateSplineTransform.fit(...).to_grid(...)`."
+		raise ValueError(message)
+
+	def apply(self, coordinates: numpy.ndarray, chunk_size: int = affinetransform.DEFAULT_CHUNK_SIZE) -> numpy.ndarray:
+		""" Transforms an [n, 2] array of points, `chunk_size` points at a time."""
+		coordinates = affinetransform.coerce_to_array(coordinates)
+		result = affinetransform.apply_transform(self.matrix, coordinates, dtype = numpy.float64)
+		rows, columns = self.displacement_x.shape
+		for chunk in affinetransform.iterate_chunks(len(coordinates), chunk_size):
+			grid_x = (coordinates[chunk, 0] - self.origin[0]) / self.spacing
+			grid_y = (coordinates[chunk, 1] - self.origin[1]) / self.spacing
+			inside = numpy.flatnonzero((grid_x >= 0) & (grid_x <= columns - 1) & (grid_y >= 0) & (grid_y <= rows - 1))
+			grid_x, grid_y = grid_x[inside], grid_y[inside]
+			target = result[chunk]
+			target[inside, 0] += pointrefinement.sample_bilinear(self.displacement_x, grid_x, grid_y, dtype = numpy.float64)
+			target[inside, 1] += pointrefinement.sample_bilinear(self.displacement_y, grid_x, grid_y, dtype = numpy.float64)
+		return result.astype(coordinates.dtype, copy = False)
+
+	def inverse(self) -> 'GridTransform':
+		message = f"A {self.__class__.__name__} has no inverse; reduce the inverse spline to a grid instead."
+		raise ValueError(message)
+
+	def compose(self, other: TransformModel) -> 'GridTransform':
+		""" Returns the transform that applies `self` first and then the affine `other`."""
+		if not self.can_compose(other):
+			message = f"A grid transform can only be followed by an affine transform, got {other!r}."
+			raise ValueError(message)
+		matrix = other.to_matrix()
+		linear = matrix[:2, :2]
+		displacement_x = linear[0, 0] * self.displacement_x + linear[0, 1] * self.displacement_y
+		displacement_y = linear[1, 0] * self.displacement_x + linear[1, 1] * self.displacement_y
+		return GridTransform(displacement_x, displacement_y, matrix @ self.matrix, spacing = self.spacing, origin = tuple(self.origin))
+
+	def can_compose(self, other: TransformModel) -> bool:
+		return transformmodels.is_affine_model(other)
+
+	def to_matrix(self) -> numpy.ndarray:
+		""" The affine part."""
+		return self.matrix.copy()
+
+	def to_parameters(self) -> Dict[str, float]:
+		return {'rows': self.displacement_x.shape[0], 'columns': self.displacement_x.shape[1], 'spacing': self.spacing}
@@ -0,0 +1,350 @@
+"""
+	Plans which source tiles (or strips) of a TIFF a region warp actually needs, and decodes only those.
+
+	For an output box and the matrix mapping output pixels onto source pixels, the box's footprint in the source is the
+	(convex) quadrilateral spanned by its mapped corners, grown by the interpolation margin. A source tile is needed
+	only if it intersects that quadrilateral, which for rotated transforms is far fewer tiles than its bounding box.
+"""
+import math
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+from typing import *
+
+import numpy
+import tifffile
+from loguru import logger
+
+from coregistration import warping
+
+BoxType = warping.BoxType
+
+
+@dataclass
+class TileLayout:
+	"""
+		The segment grid of a TIFF page.
+		Parameters
+		----------
+		image_shape: Tuple[int, int]
+			The (height, width) of the page.
+		tile_shape: Tuple[int, int]
+			The (height, width) of one tile. Strips are treated as tiles spanning the full width.
+	"""
+	image_shape: Tuple[int, int]
+	tile_shape: Tuple[int, int]
+
+	@property
+	def grid_shape(self) -> Tuple[int, int]:
+		return math.ceil(self.image_shape[0] / self.tile_shape[0]), math.ceil(self.image_shape[1] / self.tile_shape[1])
+
+	@classmethod
+	def from_page(cls, page: Union[tifffile.TiffPage, tifffile.TiffFrame]) -> 'TileLayout':
+		keyframe = page.keyframe
+		height, width = keyframe.imagelength, keyframe.imagewidth
+		if keyframe.is_tiled:
+			tile_shape = (keyframe.tilelength, keyframe.tilewidth)
+		else:
+			rows_per_strip = keyframe.rowsperstrip if keyframe.rowsperstrip else height
+			tile_shape = (min(rows_per_strip, height), width)
+		return cls(image_shape = (height, width), tile_shape = tile_shape)
+
+	def tile_box(self, tile_row: int, tile_column: int) -> BoxType:
+		row_start = tile_row * self.tile_shape[0]
+		column_start = tile_column * self.tile_shape[1]
+		return (
+			row_start, min(row_start + self.tile_shape[0], self.image_shape[0]),
+			column_start, min(column_start + self.tile_shape[1], self.image_shape[1])
+		)
+
+
+def source_footprint(matrix: numpy.ndarray, box: BoxType) -> numpy.ndarray:
+	"""
+		Maps the corner pixel centers of an output box into the source.
+		Returns
+		-------
+		numpy.ndarray
+			[4, 2] array of (x, y) source coordinates, in order around the quadrilateral.
+	"""
+	matrix = warping.coerce_matrix(matrix)
+	row_start, row_stop, column_start, column_stop = box
+	corners = numpy.array([
+		[column_start, row_start, 1],
+		[column_stop - 1, row_start, 1],
+		[column_stop - 1, row_stop - 1, 1],
+		[column_start, row_stop - 1, 1]
+	], dtype = numpy.float64)
+	mapped = corners @ matrix.T
+	return mapped[:, :2] / mapped[:, 2:]
+
+
+def footprint_window(matrix: numpy.ndarray, box: BoxType, source_shape: Tuple[int, int], method: str = 'bilinear') -> Optional[BoxType]:
+	""" The source box covering the footprint of `box` plus the interpolation margin, or None if it misses the source."""
+	corners = source_footprint(matrix, box)
+	margin = warping.TAP_MARGIN[method]
+	height, width = source_shape
+	row_start = max(int(numpy.floor(corners[:, 1].min())) - margin, 0)
+	row_stop = min(int(numpy.ceil(corners[:, 1].max())) + margin + 1, height)
+	column_start = max(int(numpy.floor(corners[:, 0].min())) - margin, 0)
+	column_stop = min(int(numpy.ceil(corners[:, 0].max())) + margin + 1, width)
+	if row_start >= row_stop or column_start >= column_stop:
+		return None
+	return row_start, row_stop, column_start, column_stop
+
+
+def plan_source_tiles(matrix: numpy.ndarray, box: BoxType, layout: TileLayout, method: str = 'bilinear') -> numpy.ndarray:
+	"""
+		Returns the minimal set of source tiles needed to warp the output `box`.
+		Parameters
+		----------
+		matrix: numpy.ndarray
+			The 3x3 matrix mapping output pixel coordinates onto source pixel coordinates.
+		box: BoxType
+			The output (row_start, row_stop, column_start, column_stop).
+		layout: TileLayout
+			The source tile grid.
+		method: str
+			The interpolation method, which sets the margin around the footprint.
+		Returns
+		-------
+		numpy.ndarray
+			[k, 2] array of (tile_row, tile_column) indices.
+	"""
+	window = footprint_window(matrix, box, layout.image_shape, method = method)
+	if window is None:
+		return numpy.empty((0, 2), dtype = int)
+	tile_height, tile_width = layout.tile_shape
+	tile_rows = numpy.arange(window[0] // tile_height, (window[1] - 1) // tile_height + 1)
+	tile_columns = numpy.arange(window[2] // tile_width, (window[3] - 1) // tile_width + 1)
+	candidates = numpy.stack(numpy.meshgrid(tile_rows, tile_columns, indexing = 'ij'), axis = -1).reshape(-1, 2)
+
+	# Separating-axis test between each candidate tile (grown by the margin) and the convex footprint.
+	corners = source_footprint(matrix, box)
+	margin = warping.TAP_MARGIN[method] + 0.5
+	minimum_x = candidates[:, 1] * tile_width - margin
+	maximum_x = (candidates[:, 1] + 1) * tile_width - 1 + margin
+	minimum_y = candidates[:, 0] * tile_height - margin
+	maximum_y = (candidates[:, 0] + 1) * tile_height - 1 + margin
+	rectangle_corners = numpy.stack([
+		numpy.stack((minimum_x, minimum_y), axis = -1),
+		numpy.stack((maximum_x, minimum_y), axis = -1),
+		numpy.stack((maximum_x, maximum_y), axis = -1),
+		numpy.stack((minimum_x, maximum_y), axis = -1)
+	], axis = 1)  # [k, 4, 2]
+
+	keep = numpy.ones(len(candidates), dtype = bool)
+	edges = numpy.roll(corners, -1, axis = 0) - corners
+	for edge, corner in zip(edges, corners):
+		normal = numpy.array([-edge[1], edge[0]])
+		if not normal.any():
+			continue
+		footprint_projection = corners @ normal
+		rectangle_projection = rectangle_corners @ normal
+		separated = (rectangle_projection.max(axis = 1) < footprint_projection.min() - 1E-9) | (rectangle_projection.min(axis = 1) > footprint_projection.max() + 1E-9)
+		keep &= ~separated
+	return candidates[keep]
+
+
+class TiffRegionReader:
+	"""
+		Array-like access to a [channels, height, width] TIFF series that decodes only the tiles a request touches.
+		Channels may be stored as separate pages, as separate sample planes, or as interleaved samples.
+
+		Can be passed as the `source` of `warping.warp_array` / `warping.warp_channels`, which then call `read_window` with
+		each output tile's footprint so that only the tiles intersecting it are read.
+		Parameters
+		----------
+		path: Path
+			The TIFF file.
+		series: int = 0
+		level: int = 0
+			The pyramid level to read.
+	"""
+
+	def __init__(self, path: Union[str, Path], series: int = 0, level: int = 0):
+		self.path = Path(path)
+		self.tiff = tifffile.TiffFile(self.path)
+		self._lock = threading.Lock()
+		pages = list(self.tiff.series[series].levels[level].pages)
+
+		# (page, separate sample plane, interleaved sample) for each channel.
+		self._channels: List[Tuple[Union[tifffile.TiffPage, tifffile.TiffFrame], int, Optional[int]]] = list()
+		for page in pages:
+			keyframe = page.keyframe
+			if keyframe.imagedepth > 1:
+				message = f"Volumetric TIFF pages are not supported: {self.path}"
+				raise ValueError(message)
+			samples = keyframe.samplesperpixel
+			if samples == 1:
+				self._channels.append((page, 0, None))
+			elif keyframe.planarconfig == tifffile.PLANARCONFIG.SEPARATE:
+				self._channels.extend((page, plane, None) for plane in range(samples))
+			else:
+				self._channels.extend((page, 0, sample) for sample in range(samples))
+
+		self.layout = TileLayout.from_page(pages[0])
+		self.dtype = pages[0].keyframe.dtype
+		self.shape = (len(self._channels),) + self.layout.image_shape
+		self.ndim = 3
+		self.bytes_read = 0
+		self._selection = list(range(len(self._channels)))
+		self._squeeze = False
+		self._names = self._read_channel_names(series)
+
+	def __enter__(self) -> Self:
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def close(self):
+		self.tiff.close()
+
+	def _read_channel_names(self, series: int) -> List[Optional[str]]:
+		""" The OME channel names of the series (as `pyramidwriter.write_ome_tiff` writes them), or None per channel."""
+		names = [None] * len(self._channels)
+		if not self.tiff.is_ome:
+			return names
+		images = tifffile.xml2dict(self.tiff.ome_metadata).get('OME', {}).get('Image', [])
+		images = images if isinstance(images, list) else [images]
+		if series >= len(images):
+			return names
+		channels = images[series].get('Pixels', {}).get('Channel', [])
+		channels = channels if isinstance(channels, list) else [channels]
+		for index, channel in enumerate(channels[:len(names)]):
+			names[index] = channel.get('Name')
+		return names
+
+	@property
+	def channel_names(self) -> List[Optional[str]]:
+		return [self._names[channel] for channel in self._selection]
+
+	def get_channel_index(self, name: str) -> int:
+		"""
+			The index of the channel called `name`. Like `resources.Image.get_channel`, the first word of a channel name
+			(the marker, e.g. 'Brightfield' for 'Brightfield (RGB)') also matches.
+		"""
+		names = self.channel_names
+		for index, channel_name in enumerate(names):
+			if channel_name is not None and name in (channel_name, str(channel_name).split(" ")[0]):
+				return index
+		message = f"{self.path.name} has no channel named '{name}'. Available channels: {names}"
+		raise ValueError(message)
+
+	def select_channels(self, channels: Union[int, str, Sequence[Union[int, str]]]) -> 'TiffRegionReader':
+		"""
+			Returns a reader restricted to some channels, sharing the open file. An int or a channel name selects one
+			channel as a 2D array.
+		"""
+		subset = object.__new__(TiffRegionReader)
+		subset.__dict__.update(self.__dict__)
+		if isinstance(channels, str):
+			channels = self.get_channel_index(channels)
+		else:
+			channels = channels if isinstance(channels, (int, numpy.integer)) else [
+				self.get_channel_index(channel) if isinstance(channel, str) else channel for channel in channels
+			]
+		if isinstance(channels, (int, numpy.integer)):
+			subset._selection = [self._selection[int(channels)]]
+			subset._squeeze = True
+			subset.shape = self.layout.image_shape
+			subset.ndim = 2
+		else:
+			subset._selection = [self._selection[channel] for channel in channels]
+			subset._squeeze = False
+			subset.shape = (len(subset._selection),) + self.layout.image_shape
+			subset.ndim = 3
+		return subset
+
+	def _read_segment(self, page, index: int) -> Tuple[numpy.ndarray, Tuple[int, int]]:
+		keyframe = page.keyframe
+		offset = page.dataoffsets[index]
+		count = page.databytecounts[index]
+		with self._lock:
+			filehandle = self.tiff.filehandle
+			filehandle.seek(offset)
+			data = filehandle.read(count)
+			self.bytes_read += count
+		segment, indices, _ = keyframe.decode(data, index, jpegtables = keyframe.jpegtables)
+		return segment, (indices[2], indices[3])
+
+	def read_tiles(self, box: BoxType, tiles: numpy.ndarray) -> numpy.ndarray:
+		"""
+			Reads the region `box` of the selected channels, decoding only `tiles` ([k, 2] tile row/column indices).
+			Pixels of the region outside those tiles are left as zero.
+		"""
+		row_start, row_stop, column_start, column_stop = box
+		result = numpy.zeros((len(self._selection), row_stop - row_start, column_stop - column_start), dtype = self.dtype)
+		tiles_down, tiles_across = self.layout.grid_shape
+		for output_index, channel in enumerate(self._selection):
+			page, plane, sample = self._channels[channel]
+			for tile_row, tile_column in tiles:
+				index = plane * tiles_down * tiles_across + int(tile_row) * tiles_across + int(tile_column)
+				segment, (segment_row, segment_column) = self._read_segment(page, index)
+				segment = segment[0, ..., sample if sample is not None else 0]
+				tile_row_start, tile_row_stop, tile_column_start, tile_column_stop = self.layout.tile_box(int(tile_row), int(tile_column))
+
+				# The overlap of the tile and the requested box, in image coordinates.
+				top, bottom = max(row_start, tile_row_start), min(row_stop, tile_row_stop)
+				left, right = max(column_start, tile_column_start), min(column_stop, tile_column_stop)
+				if top >= bottom or left >= right:
+					continue
+				result[output_index, top - row_start:bottom - row_start, left - column_start:right - column_start] = segment[
+					top - segment_row:bottom - segment_row, left - segment_column:right - segment_column
+				]
+		return result[0] if self._squeeze else result
+
+	def read_region(self, box: BoxType) -> numpy.ndarray:
+		""" Reads a rectangular region, decoding every tile that overlaps it."""
+		row_start, row_stop, column_start, column_stop = box
+		tile_height, tile_width = self.layout.tile_shape
+		tile_rows = numpy.arange(row_start // tile_height, max(row_stop - 1, row_start) // tile_height + 1)
+		tile_columns = numpy.arange(column_start // tile_width, max(column_stop - 1, column_start) // tile_width + 1)
+		tiles = numpy.stack(numpy.meshgrid(tile_rows, tile_columns, indexing = 'ij'), axis = -1).reshape(-1, 2)
+		return self.read_tiles(box, tiles)
+
+	def read_window(self, window: BoxType, matrix: numpy.ndarray, box: BoxType, method: str) -> numpy.ndarray:
+		""" Reads the source `window` needed to warp the output `box`, decoding only the tiles its footprint intersects."""
+		return self.read_tiles(window, plan_source_tiles(matrix, box, self.layout, method = method))
+
+	def __getitem__(self, key) -> numpy.ndarray:
+		""" Supports integer and unit-step slice indexing, e.g. reader[:, 100:200, 300:400] or reader[2, :50, :50]."""
+		if not isinstance(key, tuple):
+			key = (key,)
+		if self._squeeze:
+			key = (0,) + key
+		key = key + (slice(None),) * (3 - len(key))
+		channel_key, row_key, column_key = key
+
+		bounds = list()
+		for item, size in zip((row_key, column_key), self.layout.image_shape):
+			if isinstance(item, (int, numpy.integer)):
+				item = slice(int(item), int(item) + 1)
+			start, stop, step = item.indices(size)
+			if step != 1:
+				message = f"{self.__class__.__name__} only supports unit-step slices."
+				raise IndexError(message)
+			bounds.append((start, max(stop, start)))
+		(row_start, row_stop), (column_start, column_stop) = bounds
+
+		# An integer channel selects a squeezed single-channel reader, a slice selects a list of channels.
+		channels = list(range(len(self._selection)))[channel_key]
+		region = self.select_channels(channels).read_region((row_start, row_stop, column_start, column_stop))
+		# Drop the axes that were indexed with integers.
+		if isinstance(row_key, (int, numpy.integer)):
+			region = region[..., 0, :]
+		if isinstance(column_key, (int, numpy.integer)):
+			region = region[..., 0]
+		return region
+
+
+def read_region(path: Union[str, Path], box: BoxType, channels: Sequence[int] = None, level: int = 0) -> numpy.ndarray:
+	"""
+		Reads a [channels, rows, columns] region of a TIFF file, decoding only the tiles/strips that overlap `box`.
+	"""
+	with TiffRegionReader(path, level = level) as reader:
+		if channels is not None:
+			reader = reader.select_channels(list(channels))
+		region = reader.read_region(box)
+		logger.debug(f"Read {reader.bytes_read / 1024 ** 2:.2f}MB from {Path(path).name} for the region {box}")
+	return region
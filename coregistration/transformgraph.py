@@ -0,0 +1,167 @@
+"""
+	Maps coordinates between any two registered images of a project, not just between a query and its reference.
+
+	Every exported transform is an edge between two barcodes: the matrix maps reference coordinates onto query
+	coordinates, and the opposite direction uses its inverse. A mapping between two barcodes is the composition of the
+	edges along the shortest path connecting them (e.g. query -> reference -> other query within an `id:group`). Each
+	composed mapping is cached, so after the first request it is a dictionary lookup, and for matrix transforms the whole
+	chain is a single 3x3 matrix that is applied to the points in one pass.
+"""
+import json
+from collections import deque
+from pathlib import Path
+from typing import *
+
+import numpy
+from loguru import logger
+
+from coregistration import affinetransform, transformmodels
+from coregistration.imagemanager import ImageManager
+from coregistration.transformmodels import TransformModel
+
+class TransformGraph:
+	"""
+		Transforms between barcodes.
+		Parameters
+		----------
+		edges: Iterable[Tuple[str, str, numpy.ndarray | TransformModel]] = None
+			Initial (source, target, transform) edges; see `add`.
+	"""
+
+	def __init__(self, edges: Iterable[Tuple[str, str, Union[numpy.ndarray, TransformModel]]] = None):
+		# adjacency[a][b] is the transform mapping a's coordinates onto b's. Reverse edges are inverted when first used.
+		self.adjacency: Dict[str, Dict[str, Optional[TransformModel]]] = dict()
+		self._inverses: Dict[Tuple[str, str], TransformModel] = dict()
+		self._cache: Dict[Tuple[str, str], TransformModel] = dict()
+		for source, target, transform in edges or []:
+			self.add(source, target, transform)
+
+	def __contains__(self, barcode: str) -> bool:
+		return barcode in self.adjacency
+
+	def __len__(self) -> int:
+		return len(self.adjacency)
+
+	@property
+	def barcodes(self) -> List[str]:
+		return list(self.adjacency)
+
+	def add(self, source: str, target: str, transform: Union[numpy.ndarray, TransformModel]):
+		"""
+			Adds the transform mapping `source` coordinates onto `target` coordinates. For an exported transform the source
+			is the reference barcode and the target the query barcode. Replaces any existing edge between the two.
+		"""
+		if source == target:
+			message = f"Cannot add a transform from '{source}' onto itself."
+			raise ValueError(message)
+		self.adjacency.setdefault(source, dict())[target] = transformmodels.coerce_transform(transform)
+		self.adjacency.setdefault(target, dict())[source] = None
+		self._inverses.pop((source, target), None)
+		self._inverses.pop((target, source), None)
+		self._cache.clear()
+
+	def edge(self, source: str, target: str) -> TransformModel:
+		""" The transform of a single edge, inverting the stored transform if the edge was added in the other direction."""
+		transform = self.adjacency[source][target]
+		if transform is None:
+			key = (source, target)
+			if key not in self._inverses:
+				self._inverses[key] = self.adjacency[target][source].inverse()
+			transform = self._inverses[key]
+		return transform
+
+	def path(self, source: str, target: str) -> List[str]:
+		""" The barcodes along the shortest path from `source` to `target`, both included."""
+		for barcode in (source, target):
+			if barcode not in self.adjacency:
+				message = f"The barcode '{barcode}' has no transforms. Available barcodes: {sorted(self.adjacency)}"
+				raise ValueError(message)
+		previous = {source: None}
+		queue = deque([source])
+		while queue and target not in previous:
+			barcode = queue.popleft()
+			for neighbour in self.adjacency[barcode]:
+				if neighbour not in previous:
+					previous[neighbour] = barcode
+					queue.append(neighbour)
+		if target not in previous:
+			message = f"There is no chain of transforms connecting '{source}' and '{target}'."
+			raise ValueError(message)
+		path = [target]
+		while path[-1] != source:
+			path.append(previous[path[-1]])
+		return path[::-1]
+
+	def get(self, source: str, target: str) -> TransformModel:
+		""" The transform mapping `source` coordinates onto `target` coordinates, composed once and then cached."""
+		key = (source, target)
+		if key not in self._cache:
+			path = self.path(source, target)
+			transform = transformmodels.compose_transforms([self.edge(left, right) for left, right in zip(path[:-1], path[1:])])
+			self._cache[key] = transform
+			logger.debug(f"Composed {source} -> {target} over {len(path) - 1} transforms: {transform!r}")
+		return self._cache[key]
+
+	def get_matrix(self, source: str, target: str) -> numpy.ndarray:
+		""" The 3x3 matrix mapping `source` coordinates onto `target` coordinates. Fails if a non-matrix transform is on the path."""
+		transform = self.get(source, target)
+		if not transform.has_matrix:
+			message = f"The transform from '{source}' to '{target}' is not a matrix: {transform!r}"
+			raise ValueError(message)
+		return transform.to_matrix()
+
+	def apply(self, source: str, target: str, coordinates: numpy.ndarray) -> numpy.ndarray:
+		""" Maps [n, 2] coordinates measured on `source` into the frame of `target`."""
+		transform = self.get(source, target)
+		if transform.has_matrix:
+			return affinetransform.apply_transform(transform.to_matrix(), coordinates)
+		return transform.apply(coordinates)
+
+	def components(self) -> List[Set[str]]:
+		""" The groups of barcodes connected by transforms."""
+		remaining = set(self.adjacency)
+		components = list()
+		while remaining:
+			component = {remaining.pop()}
+			queue = deque(component)
+			while queue:
+				for neighbour in self.adjacency[queue.popleft()]:
+					if neighbour not in component:
+						component.add(neighbour)
+						queue.append(neighbour)
+			remaining -= component
+			components.append(component)
+		return components
+
+	@classmethod
+	def from_exports(cls, paths: Iterable[Union[str, Path]]) -> 'TransformGraph':
+		""" Builds the graph from `*.transform.calculated.json` files written by `MainGui.export_data`."""
+		graph = cls()
+		for path in paths:
+			data = json.loads(Path(path).read_text())
+			if 'barcode:reference' not in data or 'barcode:query' not in data:
+				message = f"The file '{path}' does not name its reference and query barcodes."
+				raise ValueError(message)
+			graph.add(data['barcode:reference'], data['barcode:query'], affinetransform.read_transform(path))
+		logger.debug(f"Read {sum(len(neighbours) for neighbours in graph.adjacency.values()) // 2} transforms between {len(graph)} barcodes")
+		return graph
+
+	@classmethod
+	def from_folder(cls, folder: Union[str, Path]) -> 'TransformGraph':
+		""" Builds the graph from every exported transform in `folder`."""
+		return cls.from_exports(sorted(Path(folder).glob(f"*{affinetransform.EXPORT_SUFFIX}")))
+
+	@classmethod
+	def from_table(cls, path: Union[str, Path], folder: Union[str, Path]) -> 'TransformGraph':
+		"""
+			Builds the graph for the pairs of an `ImageManager` table from the transforms exported into `folder`. Pairs that
+			have not been exported yet are skipped with a warning.
+		"""
+		paths = list()
+		for pair in ImageManager.read_table(path):
+			path_transform = affinetransform.get_export_path(folder, pair.barcode_reference, pair.barcode_query)
+			if path_transform.exists():
+				paths.append(path_transform)
+			else:
+				logger.warning(f"No exported transform for {pair.barcode_reference} -> {pair.barcode_query} in group {pair.id_group}")
+		return cls.from_exports(paths)
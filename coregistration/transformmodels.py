@@ -0,0 +1,419 @@
+import abc
+from typing import *
+
+import numpy
+from loguru import logger
+
+from coregistration import affinetransform
+
+
+class TransformModel(abc.ABC):
+	"""
+		Base class for the 2D transform models mapping left (source) coordinates onto right (target) coordinates. Every
+		model stores a 3x3 homogeneous matrix: the whole transform for the `MatrixTransform` models, and the affine part
+		(or fallback) for the models without a matrix.
+		Parameters
+		----------
+		matrix: numpy.ndarray = None
+			The 3x3 matrix. Defaults to the identity.
+	"""
+	name: str = 'base'
+	degrees_of_freedom: Optional[int] = None  # None for models whose parameter count depends on their control points.
+	minimum_points: int = 0
+	rank: int = 0  # Orders the models from least to most general, used to pick the class of a composition.
+	has_matrix: bool = True  # False for models (e.g. piecewise-affine) that a single 3x3 matrix does not describe.
+
+	def __init__(self, matrix: numpy.ndarray = None):
+		if matrix is None:
+			matrix = numpy.eye(3)
+		matrix = numpy.array(matrix, dtype = numpy.float64)
+		if matrix.shape == (2, 3):
+			matrix = numpy.vstack((matrix, [0, 0, 1]))
+		if matrix.shape != (3, 3):
+			message = f"Expected a 2x3 or 3x3 matrix, got {matrix.shape}"
+			raise ValueError(message)
+		self.matrix = matrix
+
+	def __repr__(self) -> str:
+		parameters = ", ".join(f"{key}={value:.6g}" for key, value in self.to_parameters().items())
+		return f"{self.__class__.__name__}({parameters})"
+
+	@classmethod
+	def from_matrix(cls, matrix: numpy.ndarray) -> Self:
+		return cls(matrix)
+
+	@classmethod
+	@abc.abstractmethod
+	def fit(cls, coordinates_left: numpy.ndarray, coordinates_right: numpy.ndarray, weights: numpy.ndarray = None) -> Self:
+		"""
+			Fits the model mapping `coordinates_left` onto `coordinates_right`.
+			Parameters
+			----------
+			coordinates_left, coordinates_right: numpy.ndarray
+				[n, 2] arrays of matching points, with n >= `minimum_points`.
+			weights: numpy.ndarray = None
+				Optional non-negative weight for each point.
+		"""
+
+	def apply(self, coordinates: numpy.ndarray) -> numpy.ndarray:
+		""" Transforms an [n, 2] array of points."""
+		coordinates = affinetransform.coerce_to_array(coordinates)
+		linear = self.matrix[:2, :2].astype(coordinates.dtype)
+		offset = self.matrix[:2, 2].astype(coordinates.dtype)
+		return coordinates @ linear.T + offset
+
+	def inverse(self) -> 'TransformModel':
+		return self.__class__(numpy.linalg.inv(self.matrix))
+
+	def compose(self, other: 'TransformModel') -> 'TransformModel':
+		"""
+			Returns the transform that applies `self` first and then `other`.
+			The result is an instance of whichever of the two models is more general.
+		"""
+		if not other.has_matrix:
+			return other._precompose(self)
+		matrix = other.to_matrix() @ self.matrix
+		model = self.__class__ if self.rank >= other.rank else other.__class__
+		return model(matrix)
+
+	def can_compose(self, other: 'TransformModel') -> bool:
+		""" Whether `compose(other)` merges the two transforms into a single model rather than a `TransformChain`."""
+		return other.has_matrix or other._can_precompose(self)
+
+	def _can_precompose(self, other: 'TransformModel') -> bool:
+		""" Whether `_precompose(other)` absorbs `other` into a single model. By default the two are chained."""
+		return False
+
+	def _precompose(self, other: 'TransformModel') -> 'TransformModel':
+		"""
+			Returns the transform that applies `other` first and then `self`, which `compose` delegates to for models
+			without a matrix. Unless a model can absorb `other`, the two are kept as a `TransformChain`.
+		"""
+		return TransformChain([other, self])
+
+	def to_matrix(self) -> numpy.ndarray:
+		return self.matrix.copy()
+
+	@abc.abstractmethod
+	def to_parameters(self) -> Dict[str, float]:
+		""" The named parameters of the model, for display."""
+
+	def residuals(self, coordinates_left: numpy.ndarray, coordinates_right: numpy.ndarray) -> numpy.ndarray:
+		""" Returns the distance between each transformed left point and its matching right point."""
+		coordinates_right = affinetransform.coerce_to_array(coordinates_right)
+		difference = self.apply(coordinates_left) - coordinates_right
+		return numpy.hypot(difference[:, 0], difference[:, 1])
+
+
+class MatrixTransform(TransformModel):
+	"""
+		A model completely described by its 3x3 matrix, fitted by (weighted) least squares with the cheapest solver its
+		degrees of freedom allow.
+	"""
+
+	@classmethod
+	def fit(cls, coordinates_left: numpy.ndarray, coordinates_right: numpy.ndarray, weights: numpy.ndarray = None) -> Self:
+		"""
+			Fits the model mapping `coordinates_left` onto `coordinates_right` by (weighted) least squares.
+			Parameters
+			----------
+			coordinates_left, coordinates_right: numpy.ndarray
+				[n, 2] arrays of matching points, with n >= `minimum_points`.
+			weights: numpy.ndarray = None
+				Optional non-negative weight for each point.
+		"""
+		coordinates_left, coordinates_right, weights = affinetransform.validate_correspondences(coordinates_left, coordinates_right, weights)
+		if len(coordinates_left) < cls.minimum_points:
+			message = f"{cls.__name__} requires at least {cls.minimum_points} points, got {len(coordinates_left)}."
+			raise ValueError(message)
+		matrix = cls._solve(coordinates_left.astype(numpy.float64, copy = False), coordinates_right.astype(numpy.float64, copy = False), weights)
+		return cls(matrix)
+
+	@staticmethod
+	@abc.abstractmethod
+	def _solve(coordinates_left: numpy.ndarray, coordinates_right: numpy.ndarray, weights: Optional[numpy.ndarray]) -> numpy.ndarray:
+		""" Returns the least-squares 3x3 matrix of the model."""
+
+
+def _weighted_centers(coordinates_left: numpy.ndarray, coordinates_right: numpy.ndarray, weights: Optional[numpy.ndarray]) -> Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+	""" Returns the weighted centroids of both point sets and the normalized weights."""
+	if weights is None:
+		weights = numpy.full(len(coordinates_left), 1 / len(coordinates_left))
+	else:
+		total = weights.sum()
+		if total <= 0:
+			message = f"Cannot fit a transform without any (weighted) points."
+			raise ValueError(message)
+		weights = weights / total
+	return weights @ coordinates_left, weights @ coordinates_right, weights
+
+
+def _rotation_terms(coordinates_left: numpy.ndarray, coordinates_right: numpy.ndarray, weights: Optional[numpy.ndarray]) -> Tuple[float, float, float, numpy.ndarray, numpy.ndarray]:
+	"""
+		Closed-form (2D Umeyama) terms shared by the rigid and similarity solvers.
+		Returns the weighted sums Σ(x·x' + y·y'), Σ(x·y' - y·x') and Σ(x² + y²) over the centered points, plus both centroids.
+	"""
+	center_left, center_right, weights = _weighted_centers(coordinates_left, coordinates_right, weights)
+	left = coordinates_left - center_left
+	right = coordinates_right - center_right
+	cosine_term = weights @ (left[:, 0] * right[:, 0] + left[:, 1] * right[:, 1])
+	sine_term = weights @ (left[:, 0] * right[:, 1] - left[:, 1] * right[:, 0])
+	variance = weights @ (left ** 2).sum(axis = 1)
+	return cosine_term, sine_term, variance, center_left, center_right
+
+
+def _linear_with_offset(linear: numpy.ndarray, center_left: numpy.ndarray, center_right: numpy.ndarray) -> numpy.ndarray:
+	matrix = numpy.eye(3)
+	matrix[:2, :2] = linear
+	matrix[:2, 2] = center_right - linear @ center_left
+	return matrix
+
+
+class TranslationTransform(MatrixTransform):
+	""" x' = x + xoff, y' = y + yoff """
+	name = 'translation'
+	degrees_of_freedom = 2
+	minimum_points = 1
+	rank = 1
+
+	def __init__(self, matrix: numpy.ndarray = None):
+		super().__init__(matrix)
+		if not numpy.allclose(self.matrix[:2, :2], numpy.eye(2)) or not numpy.allclose(self.matrix[2], [0, 0, 1]):
+			message = f"A translation matrix must have an identity linear part, got {self.matrix.tolist()}"
+			raise ValueError(message)
+
+	@staticmethod
+	def _solve(coordinates_left, coordinates_right, weights) -> numpy.ndarray:
+		center_left, center_right, _ = _weighted_centers(coordinates_left, coordinates_right, weights)
+		return _linear_with_offset(numpy.eye(2), center_left, center_right)
+
+	def apply(self, coordinates: numpy.ndarray) -> numpy.ndarray:
+		coordinates = affinetransform.coerce_to_array(coordinates)
+		return coordinates + self.matrix[:2, 2].astype(coordinates.dtype)
+
+	def to_parameters(self) -> Dict[str, float]:
+		return {'xoff': float(self.matrix[0, 2]), 'yoff': float(self.matrix[1, 2])}
+
+
+class RigidTransform(MatrixTransform):
+	""" A rotation followed by a translation. """
+	name = 'rigid'
+	degrees_of_freedom = 3
+	minimum_points = 2
+	rank = 2
+
+	@staticmethod
+	def _solve(coordinates_left, coordinates_right, weights) -> numpy.ndarray:
+		cosine_term, sine_term, _, center_left, center_right = _rotation_terms(coordinates_left, coordinates_right, weights)
+		angle = numpy.arctan2(sine_term, cosine_term)
+		rotation = numpy.array([[numpy.cos(angle), -numpy.sin(angle)], [numpy.sin(angle), numpy.cos(angle)]])
+		return _linear_with_offset(rotation, center_left, center_right)
+
+	def to_parameters(self) -> Dict[str, float]:
+		return {
+			'angle': float(numpy.arctan2(self.matrix[1, 0], self.matrix[0, 0])),
+			'xoff':  float(self.matrix[0, 2]),
+			'yoff':  float(self.matrix[1, 2])
+		}
+
+
+class SimilarityTransform(MatrixTransform):
+	""" An isotropic scaling and rotation followed by a translation. """
+	name = 'similarity'
+	degrees_of_freedom = 4
+	minimum_points = 2
+	rank = 3
+
+	@staticmethod
+	def _solve(coordinates_left, coordinates_right, weights) -> numpy.ndarray:
+		cosine_term, sine_term, variance, center_left, center_right = _rotation_terms(coordinates_left, coordinates_right, weights)
+		if variance <= 0:
+			message = f"Cannot fit a similarity transform to coincident points."
+			raise ValueError(message)
+		a = cosine_term / variance
+		b = sine_term / variance
+		return _linear_with_offset(numpy.array([[a, -b], [b, a]]), center_left, center_right)
+
+	def to_parameters(self) -> Dict[str, float]:
+		return {
+			'scale': float(numpy.hypot(self.matrix[0, 0], self.matrix[1, 0])),
+			'angle': float(numpy.arctan2(self.matrix[1, 0], self.matrix[0, 0])),
+			'xoff':  float(self.matrix[0, 2]),
+			'yoff':  float(self.matrix[1, 2])
+		}
+
+
+class AffineTransform(MatrixTransform):
+	""" The full 6-parameter affine transform (see `affinetransform.solve_affine_least_squares`). """
+	name = 'affine'
+	degrees_of_freedom = 6
+	minimum_points = 3
+	rank = 4
+
+	@staticmethod
+	def _solve(coordinates_left, coordinates_right, weights) -> numpy.ndarray:
+		return affinetransform.solve_affine_least_squares(coordinates_left, coordinates_right, weights = weights).matrix
+
+	def to_parameters(self) -> Dict[str, float]:
+		return affinetransform.TransformParameters.from_matrix(self.matrix).to_parameters()
+
+
+def _normalize_points(coordinates: numpy.ndarray) -> numpy.ndarray:
+	""" Hartley normalization: the 3x3 similarity moving the centroid to the origin with a mean distance of sqrt(2)."""
+	center = coordinates.mean(axis = 0)
+	distance = numpy.hypot(*(coordinates - center).T).mean()
+	scale = numpy.sqrt(2) / distance if distance > 0 else 1.0
+	return numpy.array([[scale, 0, -scale * center[0]], [0, scale, -scale * center[1]], [0, 0, 1]])
+
+
+class ProjectiveTransform(MatrixTransform):
+	""" A homography, fit with the normalized direct linear transform. """
+	name = 'projective'
+	degrees_of_freedom = 8
+	minimum_points = 4
+	rank = 5
+
+	@staticmethod
+	def _solve(coordinates_left, coordinates_right, weights) -> numpy.ndarray:
+		normalization_left = _normalize_points(coordinates_left)
+		normalization_right = _normalize_points(coordinates_right)
+		left = coordinates_left @ normalization_left[:2, :2].T + normalization_left[:2, 2]
+		right = coordinates_right @ normalization_right[:2, :2].T + normalization_right[:2, 2]
+
+		# Each correspondence contributes two rows to the [2n, 9] DLT system. Only the 9x9 normal matrix is accumulated.
+		normal = numpy.zeros((9, 9))
+		for chunk in affinetransform.iterate_chunks(len(left), affinetransform.DEFAULT_CHUNK_SIZE):
+			x, y = left[chunk, 0], left[chunk, 1]
+			u, v = right[chunk, 0], right[chunk, 1]
+			zeros = numpy.zeros_like(x)
+			ones = numpy.ones_like(x)
+			rows_u = numpy.stack((-x, -y, -ones, zeros, zeros, zeros, u * x, u * y, u), axis = 1)
+			rows_v = numpy.stack((zeros, zeros, zeros, -x, -y, -ones, v * x, v * y, v), axis = 1)
+			if weights is not None:
+				w = weights[chunk, None]
+				normal += (rows_u * w).T @ rows_u + (rows_v * w).T @ rows_v
+			else:
+				normal += rows_u.T @ rows_u + rows_v.T @ rows_v
+
+		eigenvalues, eigenvectors = numpy.linalg.eigh(normal)
+		if eigenvalues[1] <= 1E-12 * max(eigenvalues[-1], 1E-300):
+			logger.warning(f"The homography is not uniquely determined by the given points.")
+		homography = eigenvectors[:, 0].reshape(3, 3)
+		homography = numpy.linalg.inv(normalization_right) @ homography @ normalization_left
+		return homography / homography[2, 2]
+
+	def apply(self, coordinates: numpy.ndarray) -> numpy.ndarray:
+		coordinates = affinetransform.coerce_to_array(coordinates)
+		matrix = self.matrix.astype(coordinates.dtype)
+		projected = coordinates @ matrix[:2, :2].T + matrix[:2, 2]
+		denominator = coordinates @ matrix[2, :2] + matrix[2, 2]
+		return projected / denominator[:, None]
+
+	def to_parameters(self) -> Dict[str, float]:
+		return {f"h{row}{column}": float(self.matrix[row, column]) for row in range(3) for column in range(3)}
+
+
+class TransformChain(TransformModel):
+	"""
+		Several transforms applied one after another, for sequences that cannot be merged into a single model (e.g. two
+		piecewise-affine transforms). Build chains with `compose_transforms`, which merges whatever can be merged first.
+		Parameters
+		----------
+		transforms: Sequence[TransformModel]
+			The transforms in the order they are applied.
+	"""
+	name = 'chain'
+	degrees_of_freedom = None
+	minimum_points = 0
+	rank = 8
+	has_matrix = False
+
+	def __init__(self, transforms: Sequence[TransformModel]):
+		super().__init__()
+		self.transforms = list(transforms)
+
+	def __repr__(self) -> str:
+		return f"{self.__class__.__name__}({', '.join(repr(transform) for transform in self.transforms)})"
+
+	@classmethod
+	def from_matrix(cls, matrix: numpy.ndarray) -> Self:
+		message = f"A {cls.__name__} cannot be built from a matrix; use `compose_transforms`."
+		raise ValueError(message)
+
+	@classmethod
+	def fit(cls, coordinates_left: numpy.ndarray, coordinates_right: numpy.ndarray, weights: numpy.ndarray = None) -> Self:
+		message = f"A {cls.__name__} cannot be fitted; use `compose_transforms`."
+		raise ValueError(message)
+
+	def apply(self, coordinates: numpy.ndarray) -> numpy.ndarray:
+		for transform in self.transforms:
+			coordinates = transform.apply(coordinates)
+		return affinetransform.coerce_to_array(coordinates)
+
+	def inverse(self) -> TransformModel:
+		return compose_transforms([transform.inverse() for transform in reversed(self.transforms)])
+
+	def compose(self, other: TransformModel) -> TransformModel:
+		return compose_transforms(self.transforms + [other])
+
+	def can_compose(self, other: TransformModel) -> bool:
+		return False
+
+	def _precompose(self, other: TransformModel) -> TransformModel:
+		return compose_transforms([other] + self.transforms)
+
+	def to_matrix(self) -> numpy.ndarray:
+		message = f"A chain of transforms without a single matrix has no matrix: {self!r}"
+		raise ValueError(message)
+
+	def to_parameters(self) -> Dict[str, float]:
+		return {'transforms': len(self.transforms)}
+
+
+def coerce_transform(transform: Union[numpy.ndarray, TransformModel]) -> TransformModel:
+	""" Wraps a 2x3/3x3 matrix into an `AffineTransform` (or a `ProjectiveTransform` if it is not affine). Models are returned as they are."""
+	if isinstance(transform, TransformModel):
+		return transform
+	matrix = numpy.asarray(transform, dtype = numpy.float64)
+	return AffineTransform(matrix) if affinetransform.is_affine(matrix) else ProjectiveTransform(matrix)
+
+
+def is_affine_model(transform: TransformModel) -> bool:
+	""" Whether the whole transform is one affine matrix, which every model without a matrix can absorb."""
+	return transform.has_matrix and affinetransform.is_affine(transform.to_matrix())
+
+
+def compose_transforms(transforms: Sequence[Union[numpy.ndarray, TransformModel]]) -> TransformModel:
+	"""
+		Composes transforms given in the order they are applied. Neighbours are merged wherever `can_compose` allows it
+		(every matrix model, and non-matrix models next to affine ones), so a sequence of matrices becomes one matrix
+		model and only the remaining unmergeable pieces form a `TransformChain`.
+	"""
+	transforms = [coerce_transform(transform) for transform in transforms]
+	transforms = [piece for transform in transforms for piece in (transform.transforms if isinstance(transform, TransformChain) else [transform])]
+	if not transforms:
+		return AffineTransform()
+	pieces = list()
+	current = transforms[0]
+	for transform in transforms[1:]:
+		if current.can_compose(transform):
+			current = current.compose(transform)
+		else:
+			pieces.append(current)
+			current = transform
+	pieces.append(current)
+	return pieces[0] if len(pieces) == 1 else TransformChain(pieces)
+
+
+MODELS: Dict[str, Type[MatrixTransform]] = {
+	model.name: model for model in (TranslationTransform, RigidTransform, SimilarityTransform, AffineTransform, ProjectiveTransform)
+}
+
+
+def get_model(name: str) -> Type[MatrixTransform]:
+	""" Returns the transform model class registered under `name` ('translation', 'rigid', 'similarity', 'affine', 'projective')."""
+	try:
+		return MODELS[name]
+	except KeyError:
+		message = f"Invalid transform model '{name}'. Expected one of {sorted(MODELS)}"
+		raise ValueError(message)
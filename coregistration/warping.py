@@ -0,0 +1,757 @@
+"""
+	Resamples query images into the reference frame.
+
+	Every function takes the 3x3 `matrix` that maps output (reference) pixel coordinates onto source (query) pixel
+	coordinates, which is the direction `affinetransform.solve_affine(coordinates_reference, coordinates_query)` solves
+	and `MainGui.export_data` saves. Pixel centers sit at integer coordinates, with x along columns and y along rows.
+
+	The output is processed in independent tiles on a thread pool. For each tile only the bounding box of the source
+	pixels it samples is read, so the source may be a memory-mapped array, and the output may be preallocated or
+	memory-mapped as well. The interpolation kernels are NumPy gathers and arithmetic, which release the GIL.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import *
+
+import numpy
+from loguru import logger
+
+from coregistration import affinetransform, transformmodels
+
+DEFAULT_TILE_SIZE = 1024
+INTERPOLATION_METHODS = ('nearest', 'bilinear', 'bicubic')
+CUBIC_COEFFICIENT = -0.5  # The Keys cubic convolution kernel parameter.
+DEFAULT_TOLERANCE = 1E-3  # Pixels. See `classify_matrix`.
+
+BoxType = Tuple[int, int, int, int]  # (row_start, row_stop, column_start, column_stop)
+
+
+def _validate_method(method: str) -> str:
+	if method not in INTERPOLATION_METHODS:
+		message = f"Invalid interpolation method '{method}'. Expected one of {INTERPOLATION_METHODS}"
+		raise ValueError(message)
+	return method
+
+
+def coerce_matrix(matrix: numpy.ndarray) -> numpy.ndarray:
+	matrix = numpy.asarray(matrix, dtype = numpy.float64)
+	if matrix.shape == (2, 3):
+		matrix = numpy.vstack((matrix, [0, 0, 1]))
+	if matrix.shape != (3, 3):
+		message = f"Expected a 2x3 or 3x3 matrix, got {matrix.shape}"
+		raise ValueError(message)
+	return matrix
+
+
+def iterate_tiles(shape: Tuple[int, int], tile_size: int = DEFAULT_TILE_SIZE) -> Iterator[BoxType]:
+	""" Yields the (row_start, row_stop, column_start, column_stop) boxes that cover an array of `shape`."""
+	height, width = shape
+	for row in range(0, height, tile_size):
+		for column in range(0, width, tile_size):
+			yield row, min(row + tile_size, height), column, min(column + tile_size, width)
+
+
+def map_tile_coordinates(matrix: numpy.ndarray, box: BoxType, dtype: numpy.dtype = numpy.float64) -> Tuple[numpy.ndarray, numpy.ndarray]:
+	"""
+		Computes the source coordinates sampled by every output pixel of a tile.
+		Returns
+		-------
+		Tuple[numpy.ndarray, numpy.ndarray]
+			The source x and y coordinates, each with the shape of the tile.
+	"""
+	row_start, row_stop, column_start, column_stop = box
+	columns = numpy.arange(column_start, column_stop, dtype = dtype)[None, :]
+	rows = numpy.arange(row_start, row_stop, dtype = dtype)[:, None]
+	m = matrix.astype(dtype)
+
+	source_x = m[0, 0] * columns + (m[0, 1] * rows + m[0, 2])
+	source_y = m[1, 0] * columns + (m[1, 1] * rows + m[1, 2])
+	if not affinetransform.is_affine(matrix):
+		w = m[2, 0] * columns + (m[2, 1] * rows + m[2, 2])
+		source_x /= w
+		source_y /= w
+	return source_x, source_y
+
+
+def map_tile_points(transform: transformmodels.TransformModel, box: BoxType, dtype: numpy.dtype = numpy.float64) -> Tuple[numpy.ndarray, numpy.ndarray]:
+	""" Like `map_tile_coordinates`, for transform models that no matrix describes (e.g. piecewise-affine)."""
+	row_start, row_stop, column_start, column_stop = box
+	rows, columns = numpy.mgrid[row_start:row_stop, column_start:column_stop]
+	mapped = transform.apply(numpy.column_stack((columns.ravel(), rows.ravel())).astype(numpy.float64))
+	shape = (row_stop - row_start, column_stop - column_start)
+	return mapped[:, 0].reshape(shape).astype(dtype, copy = False), mapped[:, 1].reshape(shape).astype(dtype, copy = False)
+
+
+def _cubic_weights(fraction: numpy.ndarray) -> List[numpy.ndarray]:
+	""" The four Keys cubic convolution weights for the taps at offsets -1, 0, 1, 2 from floor(x)."""
+	a = CUBIC_COEFFICIENT
+	t = fraction
+	u = 1 - t
+	weight_0 = ((a * (t + 1) - 5 * a) * (t + 1) + 8 * a) * (t + 1) - 4 * a
+	weight_1 = ((a + 2) * t - (a + 3)) * t * t + 1
+	weight_2 = ((a + 2) * u - (a + 3)) * u * u + 1
+	weight_3 = 1 - weight_0 - weight_1 - weight_2
+	return [weight_0, weight_1, weight_2, weight_3]
+
+
+def _axis_taps(coordinates: numpy.ndarray, method: str, start: int, stop: int, dtype: numpy.dtype) -> Tuple[List[numpy.ndarray], Optional[List[numpy.ndarray]]]:
+	"""
+		Returns the integer tap positions along one axis, relative to and clamped within [start, stop), and their weights
+		(None for nearest-neighbour sampling).
+	"""
+	if method == 'nearest':
+		base = numpy.floor(coordinates + 0.5)
+		offsets = [0]
+		weights = None
+	else:
+		base = numpy.floor(coordinates)
+		fraction = (coordinates - base).astype(dtype, copy = False)
+		if method == 'bilinear':
+			offsets = [0, 1]
+			weights = [1 - fraction, fraction]
+		else:
+			offsets = [-1, 0, 1, 2]
+			weights = _cubic_weights(fraction)
+
+	base -= start
+	# Pointer-sized taps keep the flat indices of windows larger than 2**31 pixels from wrapping.
+	base = base.astype(numpy.intp)
+	taps = list()
+	for offset in offsets:
+		# A fresh array per tap: clipping `base` itself in place would shift every later tap on the borders.
+		taps.append(numpy.clip(base + offset, 0, stop - start - 1))
+	return taps, weights
+
+
+TAP_MARGIN = {'nearest': 1, 'bilinear': 2, 'bicubic': 3}
+
+
+@dataclass
+class SamplingPlan:
+	"""
+		Everything needed to resample one output tile from a source window, independent of the channel values.
+		Parameters
+		----------
+		window: BoxType
+			The source box that has to be read.
+		taps_x, taps_y: List[numpy.ndarray]
+			The [h, w] tap columns/rows relative to the window, one array per kernel tap.
+		weights_x, weights_y: List[numpy.ndarray]
+			The [h, w] interpolation weights of each tap, or None for nearest-neighbour sampling.
+		valid: numpy.ndarray
+			[h, w] mask of the output pixels that sample inside the source, or None if they all do.
+	"""
+	window: BoxType
+	taps_x: List[numpy.ndarray]
+	taps_y: List[numpy.ndarray]
+	weights_x: Optional[List[numpy.ndarray]]
+	weights_y: Optional[List[numpy.ndarray]]
+	valid: Optional[numpy.ndarray]
+	_indices: Optional[List[List[numpy.ndarray]]] = field(default = None, repr = False)
+
+	@property
+	def shape(self) -> Tuple[int, int]:
+		return self.taps_x[0].shape
+
+	def indices(self) -> List[List[numpy.ndarray]]:
+		""" The flat window index of every (y tap, x tap) pair. Computed once and reused for every channel."""
+		if self._indices is None:
+			window_width = self.window[3] - self.window[2]
+			self._indices = [[tap_y * window_width + tap_x for tap_x in self.taps_x] for tap_y in self.taps_y]
+		return self._indices
+
+
+def build_sampling_plan(
+		source_x: numpy.ndarray, source_y: numpy.ndarray, source_shape: Tuple[int, int],
+		method: str = 'bilinear', dtype: numpy.dtype = numpy.float32) -> Optional[SamplingPlan]:
+	"""
+		Converts source coordinates into tap indices and `dtype` weights. Taps outside the source are clamped to the edge,
+		and output pixels whose sample point lies more than half a pixel outside the source are marked invalid.
+		Returns None when no output pixel samples the source.
+	"""
+	height, width = source_shape
+	minimum_x, maximum_x = float(source_x.min()), float(source_x.max())
+	minimum_y, maximum_y = float(source_y.min()), float(source_y.max())
+	if maximum_x < -0.5 or minimum_x > width - 0.5 or maximum_y < -0.5 or minimum_y > height - 0.5 or numpy.isnan(minimum_x + minimum_y):
+		return None
+
+	if minimum_x >= -0.5 and maximum_x <= width - 0.5 and minimum_y >= -0.5 and maximum_y <= height - 0.5:
+		valid = None
+	else:
+		valid = (source_x >= -0.5) & (source_x <= width - 0.5) & (source_y >= -0.5) & (source_y <= height - 0.5)
+		if not valid.any():
+			return None
+
+	# The source window covering every tap, clipped to the source.
+	margin = TAP_MARGIN[method]
+	column_start = min(max(int(numpy.floor(minimum_x)) - margin, 0), width - 1)
+	column_stop = max(min(int(numpy.ceil(maximum_x)) + margin + 1, width), column_start + 1)
+	row_start = min(max(int(numpy.floor(minimum_y)) - margin, 0), height - 1)
+	row_stop = max(min(int(numpy.ceil(maximum_y)) + margin + 1, height), row_start + 1)
+
+	taps_x, weights_x = _axis_taps(source_x, method, column_start, column_stop, dtype)
+	taps_y, weights_y = _axis_taps(source_y, method, row_start, row_stop, dtype)
+
+	return SamplingPlan(
+		window = (row_start, row_stop, column_start, column_stop),
+		taps_x = taps_x, taps_y = taps_y,
+		weights_x = weights_x, weights_y = weights_y,
+		valid = valid
+	)
+
+
+def apply_sampling_plan(plan: SamplingPlan, window: numpy.ndarray, fill_value: float = 0, dtype: numpy.dtype = numpy.float32) -> numpy.ndarray:
+	"""
+		Resamples a source window with a precomputed plan. `window` is either one channel ([rows, columns]) or several
+		channels stored channels-last ([rows, columns, channels]), in which case every tap gathers all channels at once.
+		Returns an array with the shape of the tile (plus the channel axis), in the window dtype for nearest-neighbour
+		sampling and in `dtype` otherwise.
+	"""
+	channels_last = window.ndim == 3
+	flat = numpy.ascontiguousarray(window).reshape((-1, window.shape[2]) if channels_last else -1)
+	indices = plan.indices()
+	expand = (lambda array: array[..., None]) if channels_last else (lambda array: array)
+	shape = plan.shape + ((window.shape[2],) if channels_last else ())
+
+	if plan.weights_x is None:
+		result = flat.take(indices[0][0], axis = 0)
+	else:
+		result = numpy.zeros(shape, dtype = dtype)
+		row = numpy.empty(shape, dtype = dtype)
+		for row_indices, weight_y in zip(indices, plan.weights_y):
+			row[...] = 0
+			for index, weight_x in zip(row_indices, plan.weights_x):
+				row += expand(weight_x) * flat.take(index, axis = 0)
+			row *= expand(weight_y)
+			result += row
+
+	if plan.valid is not None:
+		result = numpy.where(expand(plan.valid), result, numpy.asarray(fill_value).astype(result.dtype))
+	return result
+
+
+def cast_result(values: numpy.ndarray, dtype: numpy.dtype) -> numpy.ndarray:
+	""" Rounds and clips interpolated values into an integer output dtype."""
+	dtype = numpy.dtype(dtype)
+	if values.dtype == dtype:
+		return values
+	if dtype.kind in 'iu' and values.dtype.kind == 'f':
+		information = numpy.iinfo(dtype)
+		values = numpy.clip(numpy.rint(values), information.min, information.max)
+	return values.astype(dtype, copy = False)
+
+
+def allocate_output(shape: Tuple[int, ...], dtype: numpy.dtype, path: Optional[Path] = None, fill_value: float = 0) -> numpy.ndarray:
+	"""
+		Creates the output array, memory-mapped to a '.npy' file at `path` if one is given.
+		Memory-mapped outputs are not pre-filled: every pixel is written by the warp.
+	"""
+	if path is None:
+		return numpy.full(shape, fill_value, dtype = dtype)
+	return numpy.lib.format.open_memmap(Path(path), mode = 'w+', dtype = dtype, shape = shape)
+
+
+def _read_window(source: numpy.ndarray, window: BoxType, matrix: Optional[numpy.ndarray], box: BoxType, method: str) -> numpy.ndarray:
+	"""
+		Reads the source `window` needed for the output `box`. Sources with a `read_window` method (e.g.
+		`tileplanner.TiffRegionReader`) are given the tile's footprint so they can skip the tiles it does not touch.
+		Without a `matrix` (non-matrix transforms) the whole window is read.
+	"""
+	if matrix is not None and hasattr(source, 'read_window'):
+		return source.read_window(window, matrix, box, method)
+	row_start, row_stop, column_start, column_stop = window
+	key = (slice(None),) * (source.ndim - 2) + (slice(row_start, row_stop), slice(column_start, column_stop))
+	return numpy.asarray(source[key])
+
+
+def _select_channels(source: numpy.ndarray, channels: Union[int, List[int]]) -> numpy.ndarray:
+	""" Selects channels of a [channels, height, width] source without reading sources that support `select_channels`."""
+	if hasattr(source, 'select_channels'):
+		return source.select_channels(channels)
+	if isinstance(channels, int):
+		return source[channels]
+	return _ChannelSubset(source, channels)
+
+
+def _read_footprint(source: numpy.ndarray, matrix: numpy.ndarray, output_shape: Tuple[int, int]) -> Tuple[numpy.ndarray, numpy.ndarray]:
+	"""
+		Reads the part of a non-array source that an integer-offset transform maps the output onto, and returns it with the
+		matrix shifted into the coordinates of that region.
+	"""
+	height, width = source.shape[-2:]
+	corners = numpy.array([[0, 0, 1], [output_shape[1] - 1, 0, 1], [0, output_shape[0] - 1, 1], [output_shape[1] - 1, output_shape[0] - 1, 1]], dtype = numpy.float64)
+	mapped = numpy.rint(corners @ matrix.T).astype(int)
+	column_start, row_start = (max(value, 0) for value in mapped[:, :2].min(axis = 0))
+	column_stop, row_stop = (min(value + 1, limit) for value, limit in zip(mapped[:, :2].max(axis = 0), (width, height)))
+	if row_start >= row_stop or column_start >= column_stop:
+		return numpy.empty((0, 0), dtype = source.dtype), matrix
+	shift = numpy.array([[1, 0, -column_start], [0, 1, -row_start], [0, 0, 1]], dtype = numpy.float64)
+	return numpy.asarray(source[row_start:row_stop, column_start:column_stop]), shift @ matrix
+
+
+def _warp_tile(source: numpy.ndarray, matrix: numpy.ndarray, box: BoxType, out: numpy.ndarray, method: str, fill_value: float, compute_dtype: numpy.dtype):
+	row_start, row_stop, column_start, column_stop = box
+	source_x, source_y = map_tile_coordinates(matrix, box)
+	plan = build_sampling_plan(source_x, source_y, source.shape[-2:], method = method, dtype = compute_dtype)
+	if plan is None:
+		out[row_start:row_stop, column_start:column_stop] = fill_value
+		return
+	window = _read_window(source, plan.window, matrix, box, method)
+	values = apply_sampling_plan(plan, window, fill_value = fill_value, dtype = compute_dtype)
+	out[row_start:row_stop, column_start:column_stop] = cast_result(values, out.dtype)
+
+
+def classify_matrix(matrix: numpy.ndarray, output_shape: Tuple[int, int], tolerance: float = DEFAULT_TOLERANCE) -> str:
+	"""
+		Determines which warp path a matrix can use. A coefficient is treated as exact when rounding it moves no output
+		pixel's sample point by more than `tolerance` pixels.
+		Returns
+		-------
+		str
+			'translation' (integer shift), 'orthogonal' (90 degree rotations/flips plus an integer shift),
+			'axis-aligned' (independent scaling and shifting of each axis) or 'general'.
+	"""
+	matrix = coerce_matrix(matrix)
+	if not affinetransform.is_affine(matrix):
+		return 'general'
+	extent = max(max(output_shape), 1)
+	linear = matrix[:2, :2]
+	offsets = matrix[:2, 2]
+
+	linear_rounded = numpy.rint(linear)
+	deviation = numpy.abs(linear - linear_rounded).sum(axis = 1) * extent + numpy.abs(offsets - numpy.rint(offsets))
+	signed_permutation = (
+		numpy.isin(linear_rounded, (-1, 0, 1)).all()
+		and (numpy.abs(linear_rounded).sum(axis = 0) == 1).all()
+		and (numpy.abs(linear_rounded).sum(axis = 1) == 1).all()
+	)
+	if signed_permutation and (deviation <= tolerance).all():
+		return 'translation' if numpy.array_equal(linear_rounded, numpy.eye(2)) else 'orthogonal'
+	if abs(linear[0, 1]) * extent <= tolerance and abs(linear[1, 0]) * extent <= tolerance:
+		return 'axis-aligned'
+	return 'general'
+
+
+def _orient_view(source: numpy.ndarray, matrix: numpy.ndarray) -> Tuple[numpy.ndarray, int, int]:
+	"""
+		For a signed-permutation matrix with integer offsets, returns a strided view of `source` (transposed and/or
+		flipped, never copied) and the integer (row, column) shift such that output[r, c] = view[r + row_shift, c + column_shift].
+	"""
+	linear = numpy.rint(matrix[:2, :2]).astype(int)
+	offset_x, offset_y = (int(i) for i in numpy.rint(matrix[:2, 2]))
+	if linear[0, 1] == 0:
+		# x' = L00 * c + tx, y' = L11 * r + ty
+		view = source
+		row_sign, row_shift = linear[1, 1], offset_y
+		column_sign, column_shift = linear[0, 0], offset_x
+	else:
+		# x' = L01 * r + tx, y' = L10 * c + ty, so index the transposed source as [x', y'].
+		view = source.T
+		row_sign, row_shift = linear[0, 1], offset_x
+		column_sign, column_shift = linear[1, 0], offset_y
+	if row_sign < 0:
+		view = view[::-1]
+		row_shift = view.shape[0] - 1 - row_shift
+	if column_sign < 0:
+		view = view[:, ::-1]
+		column_shift = view.shape[1] - 1 - column_shift
+	return view, row_shift, column_shift
+
+
+def _shift_into(view: numpy.ndarray, row_shift: int, column_shift: int, out: numpy.ndarray, fill_value: float):
+	"""
+		Writes output[r, c] = view[r + row_shift, c + column_shift] with slicing, filling the pixels that have no source.
+		Values and fill are rounded and clipped into an integer output like the interpolating paths do.
+	"""
+	height, width = out.shape
+	fill_value = cast_result(numpy.asarray(fill_value, dtype = numpy.float64), out.dtype)
+	row_start = min(max(0, -row_shift), height)
+	row_stop = max(min(height, view.shape[0] - row_shift), row_start)
+	column_start = min(max(0, -column_shift), width)
+	column_stop = max(min(width, view.shape[1] - column_shift), column_start)
+
+	out[:row_start] = fill_value
+	out[row_stop:] = fill_value
+	out[row_start:row_stop, :column_start] = fill_value
+	out[row_start:row_stop, column_stop:] = fill_value
+	out[row_start:row_stop, column_start:column_stop] = cast_result(view[
+		row_start + row_shift:row_stop + row_shift,
+		column_start + column_shift:column_stop + column_shift
+	], out.dtype)
+
+
+def _warp_tile_separable(source: numpy.ndarray, matrix: numpy.ndarray, box: BoxType, out: numpy.ndarray, method: str, fill_value: float, compute_dtype: numpy.dtype):
+	""" Resamples a tile of an axis-aligned transform as two 1-D passes, since each output row/column samples one source row/column."""
+	row_start, row_stop, column_start, column_stop = box
+	height, width = source.shape
+	source_x = matrix[0, 0] * numpy.arange(column_start, column_stop) + matrix[0, 2]
+	source_y = matrix[1, 1] * numpy.arange(row_start, row_stop) + matrix[1, 2]
+	valid_x = (source_x >= -0.5) & (source_x <= width - 0.5)
+	valid_y = (source_y >= -0.5) & (source_y <= height - 0.5)
+	if not valid_x.any() or not valid_y.any():
+		out[row_start:row_stop, column_start:column_stop] = fill_value
+		return
+
+	margin = TAP_MARGIN[method]
+	window_column_start = min(max(int(numpy.floor(source_x[valid_x].min())) - margin, 0), width - 1)
+	window_column_stop = max(min(int(numpy.ceil(source_x[valid_x].max())) + margin + 1, width), window_column_start + 1)
+	window_row_start = min(max(int(numpy.floor(source_y[valid_y].min())) - margin, 0), height - 1)
+	window_row_stop = max(min(int(numpy.ceil(source_y[valid_y].max())) + margin + 1, height), window_row_start + 1)
+	taps_x, weights_x = _axis_taps(source_x, method, window_column_start, window_column_stop, compute_dtype)
+	taps_y, weights_y = _axis_taps(source_y, method, window_row_start, window_row_stop, compute_dtype)
+	window = numpy.asarray(source[window_row_start:window_row_stop, window_column_start:window_column_stop])
+
+	if weights_x is None:
+		values = window.take(taps_y[0], axis = 0).take(taps_x[0], axis = 1)
+	elif window.shape[0] * len(source_x) <= len(source_y) * window.shape[1]:
+		# Resample along x first, since that intermediate is smaller.
+		intermediate = sum(weight[None, :] * window[:, tap].astype(compute_dtype, copy = False) for tap, weight in zip(taps_x, weights_x))
+		values = sum(weight[:, None] * intermediate[tap, :] for tap, weight in zip(taps_y, weights_y))
+	else:
+		intermediate = sum(weight[:, None] * window[tap, :].astype(compute_dtype, copy = False) for tap, weight in zip(taps_y, weights_y))
+		values = sum(weight[None, :] * intermediate[:, tap] for tap, weight in zip(taps_x, weights_x))
+
+	if not (valid_x.all() and valid_y.all()):
+		values = numpy.where(valid_y[:, None] & valid_x[None, :], values, numpy.asarray(fill_value).astype(values.dtype))
+	out[row_start:row_stop, column_start:column_stop] = cast_result(values, out.dtype)
+
+
+def _run_tiles(task: Callable[[BoxType], None], tiles: List[BoxType], threads: Optional[int]):
+	""" Runs `task` for every tile, on a thread pool unless a single thread is requested."""
+	threads = threads if threads is not None else (os.cpu_count() or 1)
+	if threads <= 1 or len(tiles) == 1:
+		for box in tiles:
+			task(box)
+	else:
+		with ThreadPoolExecutor(max_workers = threads) as executor:
+			for _ in executor.map(task, tiles):
+				pass
+
+
+def warp_array(
+		source: numpy.ndarray, matrix: numpy.ndarray, output_shape: Tuple[int, int], method: str = 'bilinear',
+		fill_value: float = 0, out: numpy.ndarray = None, dtype: numpy.dtype = None,
+		tile_size: int = DEFAULT_TILE_SIZE, threads: int = None, fast_paths: bool = True,
+		tolerance: float = DEFAULT_TOLERANCE) -> numpy.ndarray:
+	"""
+		Warps a 2D source array into an output grid.
+
+		Unless `fast_paths` is disabled, the matrix is first classified with `classify_matrix`: integer translations and
+		90 degree rotations/flips are done as strided views and slicing with no interpolation at all, and axis-aligned
+		scalings are resampled as two separable 1-D passes. Everything else goes through the general tiled path.
+		Parameters
+		----------
+		source: numpy.ndarray
+			The [height, width] source (query) array. May be memory-mapped, or a `tileplanner.TiffRegionReader`; only the
+			windows each tile needs are read.
+		matrix: numpy.ndarray
+			The 3x3 matrix mapping output (reference) pixel coordinates onto source pixel coordinates. Transform models
+			without a matrix (see `warp_mapped`) are accepted as well.
+		output_shape: Tuple[int, int]
+			The (height, width) of the output.
+		method: Literal['nearest', 'bilinear', 'bicubic'] = 'bilinear'
+		fill_value: float = 0
+			The value of output pixels that map outside the source.
+		out: numpy.ndarray = None
+			Optional preallocated (or memory-mapped, see `allocate_output`) output array.
+		dtype: numpy.dtype = None
+			The output dtype when `out` is not given. Defaults to the source dtype.
+		tile_size: int = 1024
+			The edge length of the output tiles processed independently.
+		threads: int = None
+			The number of worker threads. Defaults to the number of CPUs.
+		fast_paths: bool = True
+			Whether to detect and use the translation/orthogonal/axis-aligned fast paths.
+		tolerance: float = 1E-3
+			The largest displacement (in pixels) allowed when rounding the matrix onto a fast path.
+	"""
+	if _is_mapping(matrix):
+		return warp_mapped(source, matrix, output_shape, method = method, fill_value = fill_value, out = out, dtype = dtype, tile_size = tile_size, threads = threads)
+	method = _validate_method(method)
+	matrix = coerce_matrix(matrix)
+	if source.ndim != 2:
+		message = f"Expected a 2D source array, got shape {source.shape}"
+		raise ValueError(message)
+	output_shape = tuple(int(i) for i in output_shape)
+	if out is None:
+		out = numpy.empty(output_shape, dtype = dtype if dtype is not None else source.dtype)
+	elif out.shape != output_shape:
+		message = f"The output array has shape {out.shape}, expected {output_shape}"
+		raise ValueError(message)
+	compute_dtype = numpy.float64 if out.dtype == numpy.float64 else numpy.float32
+
+	path = classify_matrix(matrix, output_shape, tolerance = tolerance) if fast_paths else 'general'
+	if path in {'translation', 'orthogonal'}:
+		if not isinstance(source, numpy.ndarray):
+			source, matrix = _read_footprint(source, matrix, output_shape)
+		view, row_shift, column_shift = _orient_view(source, matrix)
+		_shift_into(view, row_shift, column_shift, out, fill_value)
+		return out
+
+	tile_function = _warp_tile_separable if path == 'axis-aligned' else _warp_tile
+	tiles = list(iterate_tiles(output_shape, tile_size))
+	_run_tiles(lambda box: tile_function(source, matrix, box, out, method, fill_value, compute_dtype), tiles, threads)
+	return out
+
+
+def _warp_tile_channels(
+		source: numpy.ndarray, matrix: numpy.ndarray, box: BoxType, method: str, fill_value: float,
+		compute_dtype: numpy.dtype, output_dtype: numpy.dtype, gather: str) -> numpy.ndarray:
+	""" Warps one output tile of every channel of a [channels, height, width] source. Returns [channels, h, w]."""
+	row_start, row_stop, column_start, column_stop = box
+	channel_count = source.shape[0]
+	source_x, source_y = map_tile_coordinates(matrix, box)
+	plan = build_sampling_plan(source_x, source_y, source.shape[-2:], method = method, dtype = compute_dtype)
+	if plan is None:
+		return numpy.full((channel_count, row_stop - row_start, column_stop - column_start), fill_value, dtype = output_dtype)
+
+	window = _read_window(source, plan.window, matrix, box, method)
+	if gather == 'channels-last':
+		values = apply_sampling_plan(plan, numpy.moveaxis(window, 0, -1), fill_value = fill_value, dtype = compute_dtype)
+		values = numpy.moveaxis(values, -1, 0)
+	else:
+		values = numpy.stack([apply_sampling_plan(plan, channel, fill_value = fill_value, dtype = compute_dtype) for channel in window])
+	return cast_result(values, output_dtype)
+
+
+class _ChannelSubset:
+	""" Lazily selects channels of a (possibly memory-mapped) [channels, height, width] array without copying the selection."""
+
+	def __init__(self, array: numpy.ndarray, channels: List[int]):
+		self.array = array
+		self.channels = channels
+		self.shape = (len(channels),) + array.shape[1:]
+		self.dtype = array.dtype
+		self.ndim = array.ndim
+
+	def __getitem__(self, key):
+		if not isinstance(key, tuple):
+			key = (key,)
+		channel_key, spatial_key = key[0], key[1:]
+		if isinstance(channel_key, slice):
+			selected = self.channels[channel_key]
+			return numpy.stack([self.array[(channel,) + spatial_key] for channel in selected])
+		return self.array[(self.channels[channel_key],) + spatial_key]
+
+
+def warp_channels(
+		source: numpy.ndarray, matrix: numpy.ndarray, output_shape: Tuple[int, int], channels: Sequence[int] = None,
+		method: str = 'bilinear', fill_value: float = 0, out: numpy.ndarray = None, dtype: numpy.dtype = None,
+		tile_size: int = DEFAULT_TILE_SIZE // 2, threads: int = None, gather: Literal['channels-last', 'channels-first'] = 'channels-last',
+		fast_paths: bool = True, tolerance: float = DEFAULT_TOLERANCE) -> numpy.ndarray:
+	"""
+		Warps several channels of a [channels, height, width] source (the layout of `resources.Image.data`) at once.
+
+		The inverse-mapped coordinates, tap indices and interpolation weights of each output tile are computed once and
+		applied to every channel, so an N-channel warp costs about one coordinate map plus N gathers. With
+		`gather = 'channels-last'` the source window is transposed so that each tap fetches all channels of a pixel
+		together; 'channels-first' gathers one channel at a time. Transforms that qualify for a fast path (see
+		`classify_matrix`) are warped one channel at a time with `warp_array`, since they need no shared coordinate map.
+		Parameters
+		----------
+		source: numpy.ndarray
+			The [channels, height, width] source array. May be memory-mapped, or a `tileplanner.TiffRegionReader`.
+		channels: Sequence[int] = None
+			The channel indices to warp. Defaults to all channels.
+		out: numpy.ndarray = None
+			Optional preallocated [len(channels), output height, output width] array.
+		tile_size: int = 512
+			Smaller than the single-channel default since each tile caches one index array per tap pair.
+		See `warp_array` for the other parameters.
+	"""
+	if _is_mapping(matrix):
+		return warp_mapped(
+			source, matrix, output_shape, channels = channels, method = method, fill_value = fill_value, out = out, dtype = dtype,
+			tile_size = tile_size, threads = threads
+		)
+	method = _validate_method(method)
+	matrix = coerce_matrix(matrix)
+	if gather not in {'channels-last', 'channels-first'}:
+		message = f"Invalid gather strategy '{gather}'. Expected 'channels-last' or 'channels-first'"
+		raise ValueError(message)
+	if source.ndim == 2:
+		source = source[None]
+	if source.ndim != 3:
+		message = f"Expected a [channels, height, width] source array, got shape {source.shape}"
+		raise ValueError(message)
+	if channels is not None:
+		channels = list(channels)
+		if channels != list(range(source.shape[0])):
+			source = _select_channels(source, channels)
+	output_shape = tuple(int(i) for i in output_shape)
+	full_shape = (source.shape[0],) + output_shape
+	if out is None:
+		out = numpy.empty(full_shape, dtype = dtype if dtype is not None else source.dtype)
+	elif out.shape != full_shape:
+		message = f"The output array has shape {out.shape}, expected {full_shape}"
+		raise ValueError(message)
+	compute_dtype = numpy.float64 if out.dtype == numpy.float64 else numpy.float32
+
+	if fast_paths and classify_matrix(matrix, output_shape, tolerance = tolerance) != 'general':
+		for index in range(source.shape[0]):
+			warp_array(
+				_select_channels(source, index), matrix, output_shape, method = method, fill_value = fill_value, out = out[index],
+				tile_size = tile_size, threads = threads, tolerance = tolerance
+			)
+		return out
+
+	def task(box: BoxType):
+		row_start, row_stop, column_start, column_stop = box
+		out[:, row_start:row_stop, column_start:column_stop] = _warp_tile_channels(
+			source, matrix, box, method, fill_value, compute_dtype, out.dtype, gather
+		)
+
+	_run_tiles(task, list(iterate_tiles(output_shape, tile_size)), threads)
+	return out
+
+
+def _is_mapping(matrix) -> bool:
+	""" Whether `matrix` is a transform model that has to be evaluated point by point, rather than a 3x3 matrix."""
+	return isinstance(matrix, transformmodels.TransformModel) and not matrix.has_matrix
+
+
+def _warp_tile_mapped(
+		source: numpy.ndarray, transform: transformmodels.TransformModel, box: BoxType, out: numpy.ndarray, method: str,
+		fill_value: float, compute_dtype: numpy.dtype):
+	row_start, row_stop, column_start, column_stop = box
+	source_x, source_y = map_tile_points(transform, box)
+	plan = build_sampling_plan(source_x, source_y, source.shape[-2:], method = method, dtype = compute_dtype)
+	target = out[..., row_start:row_stop, column_start:column_stop]
+	if plan is None:
+		target[...] = fill_value
+		return
+	window = _read_window(source, plan.window, None, box, method)
+	if window.ndim == 3:
+		values = numpy.moveaxis(apply_sampling_plan(plan, numpy.moveaxis(window, 0, -1), fill_value = fill_value, dtype = compute_dtype), -1, 0)
+	else:
+		values = apply_sampling_plan(plan, window, fill_value = fill_value, dtype = compute_dtype)
+	target[...] = cast_result(values, out.dtype)
+
+
+def warp_mapped(
+		source: numpy.ndarray, transform: transformmodels.TransformModel, output_shape: Tuple[int, int],
+		channels: Sequence[int] = None, method: str = 'bilinear', fill_value: float = 0, out: numpy.ndarray = None,
+		dtype: numpy.dtype = None, tile_size: int = DEFAULT_TILE_SIZE // 2, threads: int = None) -> numpy.ndarray:
+	"""
+		Warps a [height, width] or [channels, height, width] source with a transform model that no single matrix
+		describes, such as `piecewiseaffine.PiecewiseAffineTransform`. `warp_array` and `warp_channels` dispatch here when
+		given such a model instead of a matrix.
+
+		The model's `apply` maps the output pixel centers of each tile onto source coordinates, and the resulting sampling
+		plan is shared by every channel. There are no fast paths.
+		Parameters
+		----------
+		transform: transformmodels.TransformModel
+			Maps output (reference) pixel coordinates onto source (query) pixel coordinates, like the matrices.
+		See `warp_channels` for the other parameters.
+	"""
+	method = _validate_method(method)
+	if source.ndim not in {2, 3}:
+		message = f"Expected a [height, width] or [channels, height, width] source array, got shape {source.shape}"
+		raise ValueError(message)
+	if channels is not None and source.ndim == 3:
+		channels = list(channels)
+		if channels != list(range(source.shape[0])):
+			source = _select_channels(source, channels)
+	output_shape = tuple(int(i) for i in output_shape)
+	full_shape = source.shape[:-2] + output_shape
+	if out is None:
+		out = numpy.empty(full_shape, dtype = dtype if dtype is not None else source.dtype)
+	elif out.shape != full_shape:
+		message = f"The output array has shape {out.shape}, expected {full_shape}"
+		raise ValueError(message)
+	compute_dtype = numpy.float64 if out.dtype == numpy.float64 else numpy.float32
+
+	tiles = list(iterate_tiles(output_shape, tile_size))
+	_run_tiles(lambda box: _warp_tile_mapped(source, transform, box, out, method, fill_value, compute_dtype), tiles, threads)
+	return out
+
+
+def warp_region(source: numpy.ndarray, matrix: numpy.ndarray, box: BoxType, **kwargs) -> numpy.ndarray:
+	"""
+		Warps only the output region `box` = (row_start, row_stop, column_start, column_stop) of a larger output grid.
+		Combined with a `tileplanner.TiffRegionReader` source, only the source tiles that region needs are decoded.
+		Dispatches to `warp_array` for 2D sources and to `warp_channels` otherwise; see those for the other parameters.
+	"""
+	row_start, row_stop, column_start, column_stop = box
+	offset = numpy.array([[1, 0, column_start], [0, 1, row_start], [0, 0, 1]], dtype = numpy.float64)
+	output_shape = (row_stop - row_start, column_stop - column_start)
+	if _is_mapping(matrix):
+		return warp_mapped(source, transformmodels.TranslationTransform(offset).compose(matrix), output_shape, **kwargs)
+	matrix = coerce_matrix(matrix)
+	if source.ndim == 2:
+		return warp_array(source, matrix @ offset, output_shape, **kwargs)
+	return warp_channels(source, matrix @ offset, output_shape, **kwargs)
+
+
+TIFF_SUFFIXES = ('.tif', '.tiff')
+
+
+@contextmanager
+def open_image_source(image) -> Iterator[numpy.ndarray]:
+	"""
+		The [channels, height, width] source to warp a `resources.Image` from. Images whose pixels were never loaded into
+		memory (a memory-mapped or missing `data` array) are read through a `tileplanner.TiffRegionReader` over their TIFF
+		file, so that warps decode only the source tiles they need. Loaded images, which may also have been edited in
+		place, are warped from their `data` array, as are other formats and normalized or clipped images.
+	"""
+	path = getattr(image, 'filename', None)
+	data = getattr(image, 'data', None)
+	loaded = data is not None and not isinstance(data, numpy.memmap)
+	if loaded or path is None or Path(path).suffix.lower() not in TIFF_SUFFIXES or getattr(image, 'is_norm', False) or getattr(image, 'is_clip', False):
+		yield data
+		return
+	from coregistration import tileplanner
+
+	with tileplanner.TiffRegionReader(path) as reader:
+		if data is not None and (reader.shape != tuple(data.shape) or reader.dtype != data.dtype):
+			logger.debug(f"The layout of {Path(path).name} does not match the image data; warping from the memory map.")
+			yield data
+		else:
+			yield reader
+
+
+def warp_image(
+		image, matrix: numpy.ndarray, output_shape: Tuple[int, int] = None, channels: Sequence[Union[str, int]] = None,
+		**kwargs) -> numpy.ndarray:
+	"""
+		Warps several (by default all) channels of a query `resources.Image` into the reference frame with a shared
+		coordinate map. Channels may be given by name or index. A TIFF-backed image is read through a
+		`tileplanner.TiffRegionReader` (see `open_image_source`). See `warp_channels` for the other parameters.
+		Returns
+		-------
+		numpy.ndarray
+			The [channels, height, width] warped stack. `output_shape` defaults to the query image's own size.
+	"""
+	if output_shape is None:
+		output_shape = image.shape[-2:]
+	if channels is not None:
+		indices = [image.channel_name_map.get(channel) if isinstance(channel, str) else channel for channel in channels]
+		missing = [channel for channel, index in zip(channels, indices) if index is None]
+		if missing:
+			message = f"The image {image.barcode} has no channels named {missing}. Available channels: {list(image.channels)}"
+			raise ValueError(message)
+	else:
+		indices = None
+	logger.debug(f"Warping {len(indices) if indices else image.channel_count} channels of {image.barcode} into an output of shape {tuple(output_shape)}")
+	with open_image_source(image) as source:
+		return warp_channels(source, matrix, output_shape, channels = indices, **kwargs)
+
+
+def warp_image_channel(
+		image, channel: Union[str, int], matrix: numpy.ndarray, output_shape: Tuple[int, int],
+		method: str = 'bilinear', fill_value: float = 0, out: numpy.ndarray = None, **kwargs) -> numpy.ndarray:
+	"""
+		Warps one channel of a query `resources.Image` into the reference frame, reading a TIFF-backed image through a
+		`tileplanner.TiffRegionReader` (see `open_image_source`). See `warp_array` for the parameters.
+	"""
+	index = image.channel_name_map.get(channel) if isinstance(channel, str) else channel
+	if index is None:
+		message = f"The image {image.barcode} has no channel '{channel}'. Available channels: {list(image.channels)}"
+		raise ValueError(message)
+	logger.debug(f"Warping channel '{channel}' of {image.barcode} into an output of shape {tuple(output_shape)}")
+	with open_image_source(image) as source:
+		return warp_array(_select_channels(source, index), matrix, output_shape, method = method, fill_value = fill_value, out = out, **kwargs)
@@ -1,8 +1,8 @@
 from coregistration import affinetransform
+import numpy
+import pandas
 import pytest
 
-from coregistration.affine import affinetransform
-
 
 @pytest.fixture
 def transform() -> affinetransform.TransformParameters:
@@ -56,7 +56,129 @@ def test_solve_affine():
 	points_transformed = [(13.5, -7), (19.5, -1), (18, -13)]
 
 	solution = affinetransform.solve_affine(points, points_transformed)
-	solution = solution.to_list()
+	solution = affinetransform.TransformParameters.from_matrix(solution).to_list()
 
 	assert pytest.approx(solution) == expected_list
 
+
+def test_build_point_array():
+	points = numpy.array([(1, 2), (3, 4)])
+	expected = [
+		[1, 2, 1, 0, 0, 0],
+		[0, 0, 0, 1, 2, 1],
+		[3, 4, 1, 0, 0, 0],
+		[0, 0, 0, 3, 4, 1]
+	]
+	result = affinetransform.build_point_array(points)
+	assert result.dtype == numpy.float64
+	assert result.tolist() == expected
+
+
+def test_build_point_array_preserves_float32():
+	points = pandas.DataFrame({'x': [1.5, 2.5], 'y': [3.5, 4.5]}, dtype = numpy.float32)
+	assert affinetransform.build_point_array(points).dtype == numpy.float32
+	assert affinetransform.build_prime_array(points).ravel().tolist() == [1.5, 3.5, 2.5, 4.5]
+
+
+def test_solve_affine_keeps_small_coefficients():
+	angle = 5E-4
+	expected = numpy.array([[numpy.cos(angle), -numpy.sin(angle), 4.0], [numpy.sin(angle), numpy.cos(angle), -2.0], [0, 0, 1]])
+	points = numpy.random.default_rng(0).uniform(0, 1000, size = (50, 2))
+	points_transformed = points @ expected[:2, :2].T + expected[:2, 2]
+
+	solution = affinetransform.solve_affine_least_squares(points, points_transformed)
+
+	assert solution.rank == 3
+	assert numpy.allclose(solution.matrix, expected, atol = 1E-9)
+
+
+def test_solve_affine_weights_ignore_outlier():
+	points = [(1, 1), (13, 4), (10, -2), (5, 5)]
+	points_transformed = [(13.5, -7), (19.5, -1), (18, -13), (100, 100)]
+
+	solution = affinetransform.solve_affine(points, points_transformed, weights = [1, 1, 1, 0])
+
+	assert numpy.allclose(solution, [[0.5, 0, 13], [0, 2, -9], [0, 0, 1]])
+
+
+def test_solve_affine_batch_matches_solve_affine():
+	generator = numpy.random.default_rng(0)
+	points_left = [generator.uniform(0, 100, size = (count, 2)) for count in (3, 7, 12)]
+	points_right = [points * 2 + (index, -index) for index, points in enumerate(points_left)]
+
+	concatenated_left, offsets = affinetransform.concatenate_point_sets(points_left)
+	concatenated_right, _ = affinetransform.concatenate_point_sets(points_right)
+	result = affinetransform.solve_affine_batch(concatenated_left, concatenated_right, offsets)
+
+	assert result.matrices.shape == (3, 3, 3)
+	assert result.counts.tolist() == [3, 7, 12]
+	for matrix, left, right in zip(result.matrices, points_left, points_right):
+		assert numpy.allclose(matrix, affinetransform.solve_affine(left, right))
+	assert numpy.allclose(result.rmse, 0, atol = 1E-9)
+
+
+def test_apply_transform_chunked_into_preallocated_output():
+	matrix = numpy.array([[0.9, 0.1, 20], [-0.05, 1.1, -7], [0, 0, 1]])
+	points = numpy.random.default_rng(0).uniform(0, 500, size = (100, 2))
+	expected = points @ matrix[:2, :2].T + matrix[:2, 2]
+
+	output = numpy.empty((100, 2), dtype = numpy.float32)
+	result = affinetransform.apply_transform(matrix, points, out = output, chunk_size = 7)
+
+	assert result is output
+	assert numpy.allclose(result, expected, rtol = 1E-6)
+	assert affinetransform.apply_transform(matrix, points, dropz = False)[:, 2].tolist() == [1] * 100
+
+
+def test_fit_diagnostics_leave_one_out_matches_refits():
+	generator = numpy.random.default_rng(11)
+	left = generator.uniform(0, 1000, size = (12, 2))
+	matrix = numpy.array([[1.02, 0.05, 30], [-0.04, 0.98, -12], [0, 0, 1]])
+	right = affinetransform.apply_transform(matrix, left) + generator.normal(0, 1.5, size = (12, 2))
+	right[5] += (25, -10)
+
+	diagnostics = affinetransform.calculate_fit_diagnostics(left, right)
+
+	expected = list()
+	for index in range(len(left)):
+		keep = numpy.arange(len(left)) != index
+		refit = affinetransform.solve_affine(left[keep], right[keep])
+		predicted = affinetransform.apply_transform(refit, left[index:index + 1])[0]
+		expected.append(numpy.hypot(*(right[index] - predicted)))
+	assert numpy.allclose(diagnostics.loo_errors, expected)
+	assert diagnostics.worst_point == 5
+	assert numpy.isclose(diagnostics.rmse, numpy.sqrt(numpy.mean(diagnostics.errors ** 2)))
+	assert diagnostics.max_error == diagnostics.errors.max()
+
+
+def test_fit_diagnostics_exact_fit_has_undefined_leave_one_out():
+	diagnostics = affinetransform.calculate_fit_diagnostics([(0, 0), (10, 0), (0, 10)], [(1, 1), (11, 1), (1, 11)])
+
+	assert numpy.allclose(diagnostics.leverage, 1)
+	assert diagnostics.to_dict()['loo_errors'] == [None, None, None]
+	assert diagnostics.to_dict()['loo_rmse'] is None
+
+
+def test_incremental_estimator_matches_batch_fit():
+	generator = numpy.random.default_rng(5)
+	left = generator.uniform(10_000, 60_000, size = (40, 2))
+	matrix = numpy.array([[0.99, 0.03, -250], [-0.02, 1.01, 480], [0, 0, 1]])
+	right = affinetransform.apply_transform(matrix, left) + generator.normal(0, 2, size = (40, 2))
+
+	estimator = affinetransform.IncrementalAffineEstimator()
+	for point_left, point_right in zip(left[:2], right[:2]):
+		estimator.add(point_left, point_right)
+	assert estimator.matrix is None
+	for point_left, point_right in zip(left[2:], right[2:]):
+		estimator.add(point_left, point_right)
+	estimator.add((0, 0), (5000, 5000))
+	estimator.remove_last()
+	estimator.move(7, right = right[7] + 30)
+	right[7] += 30
+
+	expected = affinetransform.calculate_fit_diagnostics(left, right)
+	assert numpy.allclose(estimator.matrix, expected.matrix, atol = 1E-6)
+	assert numpy.isclose(estimator.rmse, expected.rmse)
+	diagnostics = estimator.diagnostics()
+	assert numpy.allclose(diagnostics.loo_errors, expected.loo_errors)
+	assert diagnostics.worst_point == 7
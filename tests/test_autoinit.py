@@ -0,0 +1,33 @@
+import math
+
+import numpy
+import pytest
+
+from coregistration import autoinit, warping
+
+
+@pytest.fixture
+def tissue() -> numpy.ndarray:
+	""" A textured elliptical 'section' on an empty background."""
+	size = 600
+	generator = numpy.random.default_rng(2)
+	spectrum = numpy.fft.rfft2(generator.normal(size = (size, size)))
+	frequency = numpy.hypot(*numpy.meshgrid(numpy.fft.rfftfreq(size), numpy.fft.fftfreq(size)))
+	texture = numpy.fft.irfft2(spectrum * numpy.exp(-(frequency / 0.02) ** 2), s = (size, size)).astype(numpy.float32)
+	rows, columns = numpy.mgrid[0:size, 0:size]
+	return texture * (((columns - 300) / 200) ** 2 + ((rows - 300) / 140) ** 2 < 1)
+
+
+@pytest.mark.parametrize("rotation, scale, translation", [(0, 1, (25, -15)), (-130, 0.9, (-10, 20)), (20, 1.1, (5, 30))])
+def test_estimate_similarity(tissue, rotation, scale, translation):
+	matrix = autoinit._similarity(math.radians(rotation), scale, (300, 300))
+	matrix[:2, 2] += translation
+	query = warping.warp_array(tissue, numpy.linalg.inv(matrix), tissue.shape, threads = 1)
+
+	result = autoinit.estimate_similarity(tissue, query, resolution = 200)
+
+	assert abs(result.rotation - rotation) < 1
+	assert abs(result.scale - scale) < 0.01
+	points = numpy.array([[200, 250, 1], [400, 350, 1]])
+	assert numpy.abs(points @ result.matrix.T - points @ matrix.T).max() < 3
+	assert result.score > 0.5
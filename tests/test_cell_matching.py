@@ -0,0 +1,81 @@
+import numpy
+import pandas
+import pytest
+
+from coregistration import cellmatching
+
+
+@pytest.fixture
+def cells() -> numpy.ndarray:
+	generator = numpy.random.default_rng(0)
+	# A jittered lattice keeps every cell at least ~10px away from its neighbours.
+	grid = numpy.stack(numpy.meshgrid(numpy.arange(0, 1000, 20.0), numpy.arange(0, 1000, 20.0)), axis = -1).reshape(-1, 2)
+	return grid + generator.uniform(-3, 3, size = grid.shape)
+
+
+def test_match_recovers_shuffled_cells(cells):
+	generator = numpy.random.default_rng(1)
+	order = generator.permutation(len(cells))
+	query = cells[order] + generator.normal(scale = 0.5, size = cells.shape)
+
+	matches = cellmatching.match_cells(cells, query, max_distance = 5)
+
+	assert len(matches) == len(cells)
+	assert numpy.array_equal(matches.indices_reference, order[matches.indices_query])
+	statistics = matches.statistics()
+	assert statistics['fraction:query'] == 1.0
+	assert abs(statistics['offset:x']) < 0.1 and abs(statistics['offset:y']) < 0.1
+
+
+def test_match_respects_cutoff_and_one_to_one():
+	reference = numpy.array([[0.0, 0.0], [100.0, 0.0]])
+	# Both query cells are closest to the first reference cell; the farther one must not steal it or reach the second.
+	query = numpy.array([[1.0, 0.0], [3.0, 0.0], [50.0, 50.0]])
+
+	matches = cellmatching.match_cells(reference, query, max_distance = 10)
+	assert matches.to_dataframe().values.tolist() == [[0, 0, 1.0]]
+
+	many = cellmatching.match_cells(reference, query, max_distance = 10, one_to_one = False)
+	assert many.indices_reference.tolist() == [0, 0]
+
+
+def test_assign_one_to_one_matches_greedy():
+	generator = numpy.random.default_rng(2)
+	sources = generator.integers(0, 50, size = 400)
+	targets = generator.integers(0, 50, size = 400)
+	distances = generator.uniform(size = 400)
+
+	selected = cellmatching.assign_one_to_one(sources, targets, distances)
+
+	expected, used_sources, used_targets = list(), set(), set()
+	for index in numpy.argsort(distances):
+		if sources[index] not in used_sources and targets[index] not in used_targets:
+			expected.append(index)
+			used_sources.add(sources[index])
+			used_targets.add(targets[index])
+	assert selected.tolist() == sorted(expected)
+
+
+def test_index_radius_queries(cells):
+	index = cellmatching.CellIndex(cells, chunk_size = 97)
+	points = cells[:300] + 4
+	sources, targets, distances = index.within(points, radius = 12)
+
+	brute = numpy.hypot(*(points[:, None] - cells[None]).transpose(2, 0, 1))
+	expected = numpy.argwhere(brute <= 12)
+	assert sorted(zip(sources.tolist(), targets.tolist())) == sorted(map(tuple, expected.tolist()))
+	assert numpy.allclose(distances, brute[sources, targets])
+	assert numpy.array_equal(index.count_within(points, radius = 12), (brute <= 12).sum(axis = 1))
+
+
+def test_match_tables_applies_transform(cells):
+	matrix = numpy.array([[1.0, 0.0, 25.0], [0.0, 1.0, -40.0], [0.0, 0.0, 1.0]])
+	reference = pandas.DataFrame(cells, columns = ['x', 'y'])
+	query = pandas.DataFrame(cells - matrix[:2, 2], columns = ['x', 'y'])
+
+	matches = cellmatching.match_tables(reference, query, max_distance = 2, transform = matrix)
+
+	assert len(matches) == len(cells)
+	assert numpy.array_equal(matches.indices_reference, matches.indices_query)
+	with pytest.raises(ValueError):
+		cellmatching.match_tables(reference, query.rename(columns = {'x': 'X'}), max_distance = 2)
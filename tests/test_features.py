@@ -0,0 +1,48 @@
+import math
+
+import numpy
+import pytest
+
+from coregistration import autoinit, features, warping
+
+
+@pytest.fixture
+def texture() -> numpy.ndarray:
+	size = 500
+	generator = numpy.random.default_rng(4)
+	spectrum = numpy.fft.rfft2(generator.normal(size = (size, size)))
+	frequency = numpy.hypot(*numpy.meshgrid(numpy.fft.rfftfreq(size), numpy.fft.fftfreq(size)))
+	return numpy.fft.irfft2(spectrum * numpy.exp(-(frequency / 0.06) ** 2), s = (size, size)).astype(numpy.float32)
+
+
+@pytest.mark.parametrize("lookup_table", [False, True])
+def test_hamming_distances(monkeypatch, lookup_table):
+	if lookup_table:
+		# numpy < 2.0 has no bitwise_count.
+		monkeypatch.delattr(numpy, 'bitwise_count', raising = False)
+	generator = numpy.random.default_rng(0)
+	left = generator.integers(0, 256, size = (5, 32), dtype = numpy.uint8)
+	right = generator.integers(0, 256, size = (7, 32), dtype = numpy.uint8)
+	expected = numpy.unpackbits(left[:, None, :] ^ right[None, :, :], axis = 2).sum(axis = 2)
+	numpy.testing.assert_array_equal(features.hamming_distances(left, right), expected)
+
+
+@pytest.mark.parametrize("rotation, scale, translation", [(0, 1, (12, -7)), (30, 1.05, (-20, 15))])
+def test_estimate_transform(texture, rotation, scale, translation):
+	matrix = autoinit._similarity(math.radians(rotation), scale, (250, 250))
+	matrix[:2, 2] += translation
+	query = warping.warp_array(texture, numpy.linalg.inv(matrix), texture.shape, threads = 1)
+
+	result, matches = features.estimate_transform(texture, query, max_keypoints = 1000)
+
+	assert len(matches) >= 50
+	# Mutual matches: no keypoint is used twice.
+	assert len(numpy.unique(matches.indices_query)) == len(matches)
+	points = numpy.array([[150, 150, 1], [350, 150, 1], [250, 350, 1]])
+	assert numpy.abs(points @ result.matrix.T - points @ matrix.T).max() < 0.5
+
+
+def test_estimate_transform_without_matches():
+	flat = numpy.zeros((200, 200), dtype = numpy.float32)
+	with pytest.raises(ValueError):
+		features.estimate_transform(flat, flat)
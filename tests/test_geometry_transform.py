@@ -0,0 +1,57 @@
+import json
+
+import numpy
+
+from coregistration import geometrytransform
+
+MATRIX = numpy.array([[2, 0, 10], [0, 3, -5], [0, 0, 1]])
+
+
+def _feature(geometry):
+	return {'type': 'Feature', 'properties': {}, 'geometry': geometry}
+
+
+def test_transform_geojson_all_geometry_types():
+	collection = {
+		'type':     'FeatureCollection',
+		'features': [
+			_feature({'type': 'Point', 'coordinates': [1, 2]}),
+			_feature({'type': 'Polygon', 'coordinates': [[[0, 0], [1, 0], [1, 1], [0, 0]]]}),
+			_feature({'type': 'MultiPolygon', 'coordinates': [[[[0, 0, 7], [1, 1, 7], [0, 1, 7], [0, 0, 7]]]]}),
+			_feature({'type': 'GeometryCollection', 'geometries': [{'type': 'LineString', 'coordinates': [[0, 0], [1, 1]]}]}),
+			_feature(None)
+		]
+	}
+
+	features = geometrytransform.transform_geojson(collection, MATRIX)['features']
+
+	assert features[0]['geometry']['coordinates'] == [12, 1]
+	assert features[1]['geometry']['coordinates'] == [[[10, -5], [12, -5], [12, -2], [10, -5]]]
+	assert features[2]['geometry']['coordinates'][0][0][1] == [12, -2, 7]
+	assert features[3]['geometry']['geometries'][0]['coordinates'] == [[10, -5], [12, -2]]
+
+
+def test_transform_geojson_empty_geometries():
+	feature = geometrytransform.transform_geojson(_feature({'type': 'LineString', 'coordinates': []}), MATRIX)
+	assert feature['geometry']['coordinates'] == []
+
+	collection = {'type': 'FeatureCollection', 'features': [
+		_feature({'type': 'MultiPoint', 'coordinates': []}),
+		_feature({'type': 'Polygon', 'coordinates': [[]]}),
+		_feature({'type': 'Point', 'coordinates': [1, 2]})
+	]}
+	features = geometrytransform.transform_geojson(collection, MATRIX)['features']
+	assert [item['geometry']['coordinates'] for item in features] == [[], [[]], [12, 1]]
+
+
+def test_transform_geojson_file_streaming_line_delimited(tmp_path):
+	features = [_feature({'type': 'Point', 'coordinates': [index, index]}) for index in range(25)]
+	path_input = tmp_path / "cells.geojsonl"
+	path_input.write_text("".join(json.dumps(feature) + "\n" for feature in features))
+	path_output = tmp_path / "cells.reference.geojson"
+
+	count = geometrytransform.transform_geojson_file(path_input, path_output, MATRIX, streaming = True, batch_size = 4)
+
+	result = json.loads(path_output.read_text())
+	assert count == 25
+	assert [feature['geometry']['coordinates'] for feature in result['features']] == [[2 * i + 10, 3 * i - 5] for i in range(25)]
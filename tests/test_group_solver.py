@@ -0,0 +1,92 @@
+import numpy
+import pytest
+
+from coregistration import affinetransform, groupsolver
+
+
+def _random_affine(generator: numpy.random.Generator) -> numpy.ndarray:
+	matrix = numpy.eye(3)
+	angle = generator.uniform(-0.3, 0.3)
+	matrix[:2, :2] = generator.uniform(0.95, 1.05) * numpy.array([[numpy.cos(angle), -numpy.sin(angle)], [numpy.sin(angle), numpy.cos(angle)]])
+	matrix[:2, 2] = generator.uniform(-200, 200, size = 2)
+	return matrix
+
+
+def _correspondence(generator, matrices, left: str, right: str, count: int = 20, noise: float = 0.0) -> groupsolver.Correspondence:
+	points = numpy.column_stack((generator.uniform(0, 5000, size = (count, 2)), numpy.ones(count)))
+	points_left = (points @ matrices[left].T)[:, :2]
+	points_right = (points @ matrices[right].T)[:, :2] + generator.normal(scale = noise, size = (count, 2))
+	return groupsolver.Correspondence(left, right, points_left, points_right)
+
+
+@pytest.fixture
+def matrices() -> dict:
+	generator = numpy.random.default_rng(0)
+	result = {'S0': numpy.eye(3)}
+	result.update({f"S{index}": _random_affine(generator) for index in range(1, 8)})
+	return result
+
+
+def test_recovers_chain_of_sections(matrices):
+	# Only neighbouring sections are registered to each other; S0 is the reference.
+	generator = numpy.random.default_rng(1)
+	correspondences = [_correspondence(generator, matrices, f"S{index}", f"S{index + 1}") for index in range(7)]
+
+	solution = groupsolver.solve_group(correspondences, 'S0')
+
+	for barcode, matrix in matrices.items():
+		assert numpy.allclose(solution.matrices[barcode], matrix, atol = 1E-6)
+	assert max(solution.rmse.values()) < 1E-6
+	records = solution.to_exports()
+	assert {record['barcode:query'] for record in records} == set(matrices) - {'S0'}
+	assert all(record['barcode:reference'] == 'S0' for record in records)
+
+
+def test_cycles_average_noise(matrices):
+	generator = numpy.random.default_rng(2)
+	correspondences = [
+		_correspondence(generator, matrices, left, right, count = 50, noise = 1.0)
+		for left in matrices for right in matrices if left < right
+	]
+	solution = groupsolver.solve_group(correspondences, 'S3')
+
+	points = numpy.array([[0, 0, 1], [5000, 0, 1], [0, 5000, 1], [5000, 5000, 1]], dtype = float)
+	reference = numpy.linalg.inv(matrices['S3'])
+	for barcode, matrix in matrices.items():
+		# The solution maps S3's frame onto each image.
+		expected = points @ (matrix @ reference).T
+		assert numpy.abs(points @ solution.matrices[barcode].T - expected).max() < 1.0
+	assert 0.5 < numpy.mean(list(solution.pair_rmse.values())) < 2.0
+
+
+def test_disconnected_image(matrices):
+	generator = numpy.random.default_rng(3)
+	correspondences = [_correspondence(generator, matrices, 'S0', 'S1'), _correspondence(generator, matrices, 'S2', 'S3')]
+	with pytest.raises(ValueError):
+		groupsolver.solve_group(correspondences, 'S0')
+
+
+def test_rejects_self_correspondences(matrices):
+	generator = numpy.random.default_rng(4)
+	correspondences = [_correspondence(generator, matrices, 'S0', 'S1'), _correspondence(generator, matrices, 'S1', 'S1')]
+	with pytest.raises(ValueError, match = "themselves"):
+		groupsolver.solve_group(correspondences, 'S0')
+
+
+def test_singular_system_raises_without_warnings(recwarn):
+	# A single repeated point leaves the transform undetermined, so the normal matrix is exactly singular.
+	points = numpy.full((5, 2), 100.0)
+	correspondences = [groupsolver.Correspondence('S0', 'S1', points, points + 10)]
+	with pytest.raises(ValueError, match = "non-collinear"):
+		groupsolver.solve_group(correspondences, 'S0')
+	assert not [item for item in recwarn if 'MatrixRankWarning' in type(item.message).__name__]
+
+
+def test_read_and_write_exports(tmp_path, matrices):
+	generator = numpy.random.default_rng(4)
+	correspondences = [_correspondence(generator, matrices, 'S0', f"S{index}") for index in (1, 2)]
+	solution = groupsolver.solve_group(correspondences, 'S0')
+	paths = solution.write_exports(tmp_path)
+	assert sorted(path.name for path in paths) == [f"S0-S{index}{affinetransform.EXPORT_SUFFIX}" for index in (1, 2)]
+
+	assert numpy.allclose(affinetransform.read_transform(paths[0]), solution.matrices['S1'])
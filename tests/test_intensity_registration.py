@@ -0,0 +1,36 @@
+import numpy
+
+from coregistration import intensityregistration, warping
+
+
+def _tissue(size: int = 400) -> numpy.ndarray:
+	generator = numpy.random.default_rng(9)
+	spectrum = numpy.fft.rfft2(generator.normal(size = (size, size)))
+	frequency = numpy.hypot(*numpy.meshgrid(numpy.fft.rfftfreq(size), numpy.fft.fftfreq(size)))
+	texture = numpy.fft.irfft2(spectrum * numpy.exp(-(frequency / 0.03) ** 2), s = (size, size)).astype(numpy.float32)
+	rows, columns = numpy.mgrid[0:size, 0:size]
+	return texture * (((columns - size / 2) / (size * 0.37)) ** 2 + ((rows - size / 2) / (size * 0.27)) ** 2 < 1)
+
+
+def test_register_affine_recovers_transform():
+	reference = _tissue()
+	matrix = numpy.array([[1.03, 0.05, -9], [-0.04, 0.98, 12], [0, 0, 1]])
+	query = warping.warp_array(reference, numpy.linalg.inv(matrix), reference.shape, threads = 1)
+
+	result = intensityregistration.register_affine(reference, query, samples = 10_000)
+	again = intensityregistration.register_affine(reference, query, samples = 10_000)
+
+	points = numpy.array([[100, 140, 1], [300, 260, 1], [200, 200, 1]])
+	assert numpy.abs(points @ result.matrix.T - points @ matrix.T).max() < 0.5
+	assert result.metric > 0.99
+	assert numpy.array_equal(result.matrix, again.matrix)
+
+
+def test_register_affine_downsampled_input_keeps_full_resolution_matrix():
+	reference = _tissue()
+	matrix = numpy.array([[1, 0, 6], [0, 1, -4], [0, 0, 1.0]])
+	query = warping.warp_array(reference, numpy.linalg.inv(matrix), reference.shape, threads = 1)
+
+	result = intensityregistration.register_affine(reference, query, max_size = 200)
+
+	assert numpy.allclose(result.matrix, matrix, atol = 0.5)
@@ -0,0 +1,69 @@
+import numpy
+import pytest
+
+from coregistration import piecewiseaffine, tabletransform, transformmodels, warping
+
+
+def _deform(points: numpy.ndarray) -> numpy.ndarray:
+	return points + 8 * numpy.sin(points[:, ::-1] / 120)
+
+
+@pytest.fixture
+def transform() -> piecewiseaffine.PiecewiseAffineTransform:
+	rows, columns = numpy.mgrid[0:401:50, 0:401:50]
+	points = numpy.column_stack((columns.ravel(), rows.ravel())) + numpy.random.default_rng(0).uniform(-10, 10, size = (81, 2))
+	return piecewiseaffine.PiecewiseAffineTransform.fit(points, _deform(points))
+
+
+def test_interpolates_control_points(transform):
+	assert numpy.allclose(transform.apply(transform.vertices_left), transform.vertices_right)
+
+
+def test_locate_matches_scipy(transform):
+	scipy_spatial = pytest.importorskip('scipy.spatial')
+	points = numpy.random.default_rng(1).uniform(-50, 450, size = (20_000, 2))
+	triangles, weights = transform.locator.locate(points)
+	expected = scipy_spatial.Delaunay(transform.vertices_left).find_simplex(points)
+	numpy.testing.assert_array_equal(triangles, expected)
+	assert numpy.allclose(weights[triangles >= 0].sum(axis = 1), 1)
+
+
+def test_outside_hull_uses_global_affine(transform):
+	points = numpy.array([[-500.0, -500.0], [1000.0, 20.0]])
+	assert numpy.allclose(transform.apply(points), points @ transform.matrix[:2, :2].T + transform.matrix[:2, 2])
+
+
+def test_inverse_and_compose(transform):
+	points = numpy.random.default_rng(2).uniform(0, 400, size = (500, 2))
+	inside = transform.locator.locate(points)[0] >= 0
+	assert numpy.allclose(transform.inverse().apply(transform.apply(points[inside])), points[inside])
+
+	affine = transformmodels.AffineTransform(numpy.array([[1.02, 0.05, -3], [-0.01, 0.98, 7], [0, 0, 1]]))
+	assert numpy.allclose(transform.compose(affine).apply(points), affine.apply(transform.apply(points)))
+	assert numpy.allclose(affine.compose(transform).apply(points), transform.apply(affine.apply(points)))
+	projective = transformmodels.ProjectiveTransform(numpy.array([[1, 0, 0], [0, 1, 0], [1E-4, 0, 1]]))
+	assert transform.can_compose(affine) and not transform.can_compose(projective) and not projective.can_compose(transform)
+	with pytest.raises(ValueError):
+		transform.compose(projective)
+	chain = transformmodels.compose_transforms([projective, transform, affine])
+	assert isinstance(chain, transformmodels.TransformChain) and len(chain.transforms) == 2
+
+
+def test_warp_matches_pointwise_sampling(transform):
+	source = numpy.random.default_rng(3).uniform(0, 1000, size = (2, 420, 420)).astype(numpy.float32)
+	warped = warping.warp_channels(source, transform, (300, 300), tile_size = 128)
+
+	rows, columns = numpy.mgrid[0:300, 0:300]
+	mapped = transform.apply(numpy.column_stack((columns.ravel(), rows.ravel())).astype(float))
+	nearest = warping.warp_array(source[1], transform, (300, 300), method = 'nearest')
+	expected = source[1][numpy.rint(mapped[:, 1]).astype(int), numpy.rint(mapped[:, 0]).astype(int)].reshape(300, 300)
+	numpy.testing.assert_array_equal(nearest, expected)
+	numpy.testing.assert_allclose(warped[1], warping.warp_array(source[1], transform, (300, 300)))
+	numpy.testing.assert_allclose(warping.warp_region(source[0], transform, (50, 150, 100, 250)), warped[0, 50:150, 100:250])
+
+
+def test_transform_dataframe(transform):
+	pandas = pytest.importorskip('pandas')
+	points = numpy.random.default_rng(4).uniform(0, 400, size = (100, 2))
+	table = tabletransform.transform_dataframe(pandas.DataFrame(points, columns = ['x', 'y']), transform)
+	assert numpy.allclose(table[['x', 'y']].to_numpy(), transform.apply(points))
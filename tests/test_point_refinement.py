@@ -0,0 +1,36 @@
+import numpy
+import pytest
+
+from coregistration import pointrefinement, warping
+
+
+@pytest.fixture
+def texture() -> numpy.ndarray:
+	""" Smooth random texture, so patches have structure at every scale the correlation looks at."""
+	generator = numpy.random.default_rng(2)
+	noise = generator.normal(size = (400, 400))
+	spectrum = numpy.fft.rfft2(noise)
+	frequency = numpy.hypot(*numpy.meshgrid(numpy.fft.rfftfreq(400), numpy.fft.fftfreq(400)))
+	return numpy.fft.irfft2(spectrum * numpy.exp(-(frequency / 0.05) ** 2), s = (400, 400)).astype(numpy.float32)
+
+
+@pytest.mark.parametrize("angle", [0, 12])
+def test_refine_points_recovers_subpixel_offsets(texture, angle):
+	radians = numpy.radians(angle)
+	# Reference -> query: rotate about the image center and shift by a non-integer amount.
+	rotation = numpy.array([[numpy.cos(radians), -numpy.sin(radians)], [numpy.sin(radians), numpy.cos(radians)]])
+	matrix = numpy.eye(3)
+	matrix[:2, :2] = rotation
+	matrix[:2, 2] = (200, 200) - rotation @ (200, 200) + (3.35, -2.6)
+	# warp_array expects output (query) pixels -> source (reference) pixels.
+	query = warping.warp_array(texture, numpy.linalg.inv(matrix), texture.shape, method = 'bicubic', threads = 1)
+
+	generator = numpy.random.default_rng(4)
+	points_reference = generator.uniform(120, 280, size = (30, 2))
+	truth = points_reference @ matrix[:2, :2].T + matrix[:2, 2]
+	clicked = truth + generator.uniform(-4, 4, size = truth.shape)
+
+	result = pointrefinement.refine_points(texture, query, points_reference, clicked, patch_size = 48, matrix = matrix if angle else None)
+
+	assert result.accepted.all()
+	assert numpy.abs(result.points - truth).max() < 0.25
@@ -0,0 +1,67 @@
+from types import SimpleNamespace
+
+import numpy
+import pytest
+import tifffile
+
+from coregistration import pyramidwriter, tileplanner, warping
+
+
+def test_write_ome_tiff_pyramid(tmp_path):
+	generator = numpy.random.default_rng(3)
+	image = generator.integers(0, 4000, size = (2, 300, 410), dtype = numpy.uint16)
+	channels = [
+		{'barcode': None, 'color': '#0000FF', 'index': 1, 'name': 'CD8', 'marker': 'CD8', 'signal': None, 'alias': None, 'fluor': None},
+		{'barcode': None, 'color': '#FFFFFF', 'index': 0, 'name': 'DAPI', 'marker': 'DAPI', 'signal': None, 'alias': None, 'fluor': None}
+	]
+	path = pyramidwriter.write_ome_tiff(
+		tmp_path / "image.ome.tiff", image, channels = channels, pixel_size = (0.5, 0.5), tile_size = 64,
+		compression = 'zlib', workers = 2
+	)
+
+	with tifffile.TiffFile(path) as tiff:
+		series = tiff.series[0]
+		assert series.axes == 'CYX'
+		assert len(series.levels) == 4
+		assert numpy.array_equal(series.asarray(), image)
+		assert numpy.array_equal(series.levels[1].asarray(), pyramidwriter.downsample(image))
+		assert series.levels[3].shape == (2, 38, 52)
+
+		page = tiff.pages[0]
+		assert page.is_tiled and page.tilewidth == 64
+		assert page.compression == tifffile.COMPRESSION.ADOBE_DEFLATE
+		assert page.tags['XResolution'].value == (20000, 1)
+		assert 'Name="DAPI"' in tiff.ome_metadata and 'PhysicalSizeX="0.5"' in tiff.ome_metadata
+		assert tiff.ome_metadata.index('DAPI') < tiff.ome_metadata.index('CD8')
+
+
+def test_downsample_odd_edges():
+	tile = numpy.array([[0, 2, 4], [2, 4, 6], [8, 8, 9]], dtype = numpy.uint8)
+	assert numpy.array_equal(pyramidwriter.downsample(tile), numpy.array([[2, 5], [8, 9]], dtype = numpy.uint8))
+
+
+@pytest.mark.parametrize("backed, threads", [(False, 1), (True, 1), (True, 3)])
+def test_write_warped_image_streams_tiles(tmp_path, monkeypatch, backed, threads):
+	generator = numpy.random.default_rng(5)
+	data = generator.integers(0, 4000, size = (2, 200, 260), dtype = numpy.uint16)
+	path_query = tmp_path / "query.tiff"
+	tifffile.imwrite(path_query, data, photometric = 'minisblack')
+	# A memory-mapped image is read through the region reader, a loaded one from memory.
+	image = SimpleNamespace(data = tifffile.memmap(path_query) if backed else data, channels = {}, tags = {}, filename = path_query)
+	angle = 0.1
+	matrix = numpy.array([[numpy.cos(angle), -numpy.sin(angle), 20.0], [numpy.sin(angle), numpy.cos(angle), -5.0], [0, 0, 1]])
+
+	reads = list()
+	read_window = tileplanner.TiffRegionReader.read_window
+	monkeypatch.setattr(tileplanner.TiffRegionReader, 'read_window', lambda self, *args: reads.append(args) or read_window(self, *args))
+
+	path = pyramidwriter.write_warped_image(
+		tmp_path / "warped.ome.tiff", image, matrix, (150, 230), pixel_size = (0.5, 0.5), threads = threads, tile_size = 64
+	)
+
+	expected = warping.warp_channels(data, matrix, (150, 230), threads = 1)
+	with tifffile.TiffFile(path) as tiff:
+		assert numpy.array_equal(tiff.series[0].asarray(), expected)
+		assert numpy.array_equal(tiff.series[0].levels[1].asarray(), pyramidwriter.downsample(expected))
+	# One footprint read per output tile, shared by both channels, when the query is read from its TIFF file.
+	assert len(reads) == (3 * 4 if backed else 0)
@@ -0,0 +1,124 @@
+import json
+
+import numpy
+import pandas
+import pytest
+import tifffile
+
+from coregistration import affinetransform, intensityregistration, qualitycontrol, warping
+
+
+@pytest.fixture
+def reference() -> numpy.ndarray:
+	generator = numpy.random.default_rng(0)
+	image = intensityregistration.gaussian_blur(generator.random((300, 400)), 3.0)
+	image = (image - image.min()) / (image.max() - image.min()) * 4000
+	# A tissue section on an empty background.
+	rows, columns = numpy.mgrid[:300, :400]
+	image[((rows - 150) / 120) ** 2 + ((columns - 200) / 170) ** 2 > 1] = 10
+	return image.astype(numpy.uint16)
+
+
+@pytest.fixture
+def matrix() -> numpy.ndarray:
+	angle = 0.05
+	return numpy.array([[numpy.cos(angle), -numpy.sin(angle), 6.0], [numpy.sin(angle), numpy.cos(angle), -4.0], [0.0, 0.0, 1.0]])
+
+
+def test_moments_merge_matches_direct():
+	generator = numpy.random.default_rng(1)
+	reference = generator.normal(1000, 50, size = 5000)
+	query = 0.5 * reference + generator.normal(size = 5000)
+	moments = qualitycontrol.Moments()
+	for chunk in numpy.array_split(numpy.arange(5000), 7):
+		moments.merge(qualitycontrol.Moments.from_values(reference[chunk], query[chunk]))
+	assert moments.count == 5000
+	assert moments.ncc == pytest.approx(numpy.corrcoef(reference, query)[0, 1], abs = 1E-12)
+
+
+def test_registered_pair_scores_higher(reference, matrix):
+	query = warping.warp_array(reference, numpy.linalg.inv(matrix), reference.shape)
+
+	good = qualitycontrol.measure_quality(reference, query, matrix, tile_size = 64)
+	bad = qualitycontrol.measure_quality(reference, query, numpy.eye(3), tile_size = 64)
+
+	assert good.metrics['ncc'] > 0.95
+	assert good.metrics['dice'] > 0.95
+	assert good.metrics['normalized_mutual_information'] > bad.metrics['normalized_mutual_information']
+	assert bad.metrics['ncc'] < 0.8
+	assert good.heatmap().shape == (5, 7) == good.grid_shape
+	assert numpy.nanmedian(good.heatmap()) < numpy.nanmedian(bad.heatmap())
+
+
+def test_dark_tissue_on_bright_background(reference, matrix):
+	# Brightfield: the tissue absorbs light and is darker than the empty slide.
+	reference = (4010 - reference.astype(numpy.float32)).astype(numpy.uint16)
+	query = warping.warp_array(reference, numpy.linalg.inv(matrix), reference.shape)
+	profile = qualitycontrol.estimate_profile(reference, 64)
+	assert profile.polarity == 'dark'
+	rows, columns = numpy.mgrid[:300, :400]
+	inside = ((rows - 150) / 120) ** 2 + ((columns - 200) / 170) ** 2 <= 1
+	assert numpy.mean(profile.tissue(reference.astype(numpy.float32)) == inside) > 0.95
+
+	good = qualitycontrol.measure_quality(reference, query, matrix, tile_size = 64)
+	shifted = matrix.copy()
+	shifted[:2, 2] += 60
+	bad = qualitycontrol.measure_quality(reference, query, shifted, tile_size = 64)
+	assert good.metrics['dice'] > 0.95
+	assert bad.metrics['dice'] < good.metrics['dice'] - 0.1
+	assert good.to_record()['profiles']['reference']['polarity'] == 'dark'
+
+
+def test_mutual_information_of_identical_images(reference):
+	report = qualitycontrol.measure_quality(reference, reference, numpy.eye(3), tile_size = 128, tissue_only = False)
+	assert report.metrics['ncc'] == pytest.approx(1.0)
+	assert report.metrics['normalized_mutual_information'] == pytest.approx(2.0)
+	assert report.metrics['coverage'] == 1.0
+
+
+def test_measure_table(tmp_path, reference, matrix):
+	query = warping.warp_array(reference, numpy.linalg.inv(matrix), reference.shape)
+	tifffile.imwrite(tmp_path / 'A.tiff', reference, tile = (64, 64))
+	tifffile.imwrite(tmp_path / 'B.tiff', query, tile = (64, 64))
+	tifffile.imwrite(tmp_path / 'C.tiff', query, tile = (64, 64))
+	pandas.DataFrame({
+		'id:group': [1, 1, 1], 'barcode': ['A', 'B', 'C'], 'path': [str(tmp_path / f"{name}.tiff") for name in 'ABC']
+	}).to_csv(tmp_path / 'pairs.tsv', sep = "\t", index = False)
+	exports = tmp_path / 'exports'
+	exports.mkdir()
+	(exports / f"A-B{affinetransform.EXPORT_SUFFIX}").write_text(json.dumps({'matrix': matrix.tolist()}))
+
+	jobs = qualitycontrol.get_jobs(tmp_path / 'pairs.tsv', exports, tmp_path, tile_size = 64)
+	summary = qualitycontrol.measure_qualities(jobs, processes = 1)
+
+	assert [(job.barcode_reference, job.barcode_query) for job in jobs] == [('A', 'B')]
+	assert summary['ncc'].iloc[0] > 0.95
+	record = json.loads((tmp_path / 'A-B.qc.json').read_text())
+	assert record['barcode:query'] == 'B'
+	assert tifffile.imread(tmp_path / 'A-B.qc.heatmap.tiff').shape == (5, 7)
+	assert len(pandas.read_csv(tmp_path / 'A-B.qc.tiles.tsv', sep = "\t")) == 35
+
+
+def test_measure_table_channel_by_name(tmp_path, reference, matrix):
+	query = warping.warp_array(reference, numpy.linalg.inv(matrix), reference.shape)
+	noise = numpy.zeros_like(reference)
+	metadata = {'axes': 'CYX', 'Channel': {'Name': ['DAPI', 'Brightfield (RGB)']}}
+	for name, image in (('A', reference), ('B', query)):
+		tifffile.imwrite(tmp_path / f"{name}.ome.tiff", numpy.stack((noise, image)), tile = (64, 64), ome = True, metadata = metadata)
+	pandas.DataFrame({
+		'id:group': [1, 1], 'barcode': ['A', 'B'], 'path': [str(tmp_path / f"{name}.ome.tiff") for name in 'AB']
+	}).to_csv(tmp_path / 'pairs.tsv', sep = "\t", index = False)
+	exports = tmp_path / 'exports'
+	exports.mkdir()
+	(exports / f"A-B{affinetransform.EXPORT_SUFFIX}").write_text(json.dumps({'matrix': matrix.tolist()}))
+
+	qualitycontrol.main([
+		'--table', str(tmp_path / 'pairs.tsv'), '--transforms', str(exports), '--output-folder', str(tmp_path / 'qc'),
+		'--channel', 'Brightfield', '--tile-size', '64', '--processes', '1'
+	])
+	summary = pandas.read_csv(tmp_path / 'qc' / 'quality-control.tsv', sep = "\t")
+	assert summary['ncc'].iloc[0] > 0.95
+
+	jobs = qualitycontrol.get_jobs(tmp_path / 'pairs.tsv', exports, tmp_path, channel = 'CD8', tile_size = 64)
+	with pytest.raises(ValueError, match = "CD8"):
+		qualitycontrol.measure_qualities(jobs, processes = 1)
@@ -0,0 +1,53 @@
+import numpy
+import pytest
+
+from coregistration import robustestimation
+
+
+@pytest.fixture
+def correspondences():
+	generator = numpy.random.default_rng(0)
+	matrix = numpy.array([[0.98, 0.05, 30], [-0.04, 1.02, -12], [0, 0, 1]])
+	points = generator.uniform(0, 1000, size = (200, 2))
+	points_transformed = points @ matrix[:2, :2].T + matrix[:2, 2]
+	outliers = numpy.zeros(len(points), dtype = bool)
+	outliers[::4] = True
+	points_transformed[outliers] = generator.uniform(0, 1000, size = (outliers.sum(), 2))
+	return points, points_transformed, matrix, outliers
+
+
+@pytest.mark.parametrize("scoring", ['ransac', 'msac'])
+def test_ransac_affine_rejects_outliers(correspondences, scoring):
+	points, points_transformed, matrix, outliers = correspondences
+
+	result = robustestimation.ransac_affine(points, points_transformed, threshold = 1.0, scoring = scoring, seed = 0)
+
+	assert numpy.allclose(result.matrix, matrix, atol = 1E-6)
+	assert result.inliers.tolist() == (~outliers).tolist()
+
+
+def test_ransac_affine_is_reproducible(correspondences):
+	points, points_transformed, _, _ = correspondences
+	first = robustestimation.ransac_affine(points, points_transformed, local_optimization = 0, seed = 12)
+	second = robustestimation.ransac_affine(points, points_transformed, local_optimization = 0, seed = 12)
+	assert numpy.array_equal(first.matrix, second.matrix)
+
+
+def test_ransac_affine_requires_three_points():
+	with pytest.raises(ValueError):
+		robustestimation.ransac_affine([(0, 0), (1, 1)], [(0, 0), (1, 1)])
+
+
+def test_ransac_affine_counts_only_evaluated_samples(monkeypatch):
+	# With 5 points about half of the random triples repeat an index and are dropped before evaluation.
+	generator = numpy.random.default_rng(3)
+	left = generator.uniform(0, 100, size = (5, 2))
+	right = left + [4, -2]
+	right[:2] += generator.uniform(20, 40, size = (2, 2))
+	evaluated = list()
+	solve = robustestimation.solve_minimal_affine
+	monkeypatch.setattr(robustestimation, 'solve_minimal_affine', lambda *args: evaluated.append(len(args[2])) or solve(*args))
+
+	result = robustestimation.ransac_affine(left, right, confidence = 1 - 1E-12, max_iterations = 40, local_optimization = 0, seed = 0)
+
+	assert result.iterations == sum(evaluated) == 40
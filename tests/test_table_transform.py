@@ -0,0 +1,58 @@
+import json
+
+import numpy
+import pandas
+import pytest
+
+from coregistration import affinetransform, tabletransform
+
+MATRIX = [[0.9, 0.1, 20], [-0.05, 1.1, -7], [0, 0, 1]]
+
+
+def test_read_transform_inverts_exported_matrix(tmp_path):
+	path = tmp_path / "A-B.transform.calculated.json"
+	path.write_text(json.dumps({'matrix': MATRIX}))
+
+	assert numpy.allclose(affinetransform.read_transform(path), MATRIX)
+	assert numpy.allclose(affinetransform.read_transform(path, invert = True) @ MATRIX, numpy.eye(3))
+
+
+def test_transform_table_streams_batches(tmp_path):
+	table = pandas.DataFrame({'cell': range(250), 'x': numpy.arange(250.0), 'y': numpy.arange(250.0) * 2, 'area': 3.5})
+	path_input = tmp_path / "cells.csv"
+	path_output = tmp_path / "cells.reference.csv"
+	table.to_csv(path_input, index = False)
+
+	rows = tabletransform.transform_table(path_input, path_output, numpy.array(MATRIX), suffix = ':reference', batch_size = 40)
+
+	result = pandas.read_csv(path_output)
+	expected = affinetransform.apply_transform(numpy.array(MATRIX), table[['x', 'y']].values)
+	assert rows == 250
+	assert list(result.columns) == ['cell', 'x', 'y', 'area', 'x:reference', 'y:reference']
+	assert numpy.allclose(result[['x:reference', 'y:reference']].values, expected)
+
+
+def test_transform_table_casts_drifting_chunk_dtypes(tmp_path):
+	pytest.importorskip('pyarrow')
+	path_input = tmp_path / "cells.csv"
+	# 'n' is read as int in the first chunk and as float (with a gap) in the second; 'x' the other way round.
+	path_input.write_text("x,y,n\n1.5,2,1\n2.5,3,2\n3,4,\n4,5,7\n")
+	path_output = tmp_path / "cells.reference.parquet"
+
+	rows = tabletransform.transform_table(path_input, path_output, numpy.eye(3), batch_size = 2)
+
+	result = pandas.read_parquet(path_output)
+	assert rows == 4
+	assert result['x'].tolist() == [1.5, 2.5, 3.0, 4.0]
+	assert result['n'].iloc[:2].tolist() == [1, 2] and result['n'].isna().tolist() == [False, False, True, False]
+
+
+def test_transform_table_rejects_incompatible_chunks(tmp_path):
+	pytest.importorskip('pyarrow')
+	path_input = tmp_path / "cells.csv"
+	path_input.write_text("x,y,label\n1,2,\n2,3,\n3,4,tumor\n")
+	path_output = tmp_path / "cells.reference.parquet"
+
+	with pytest.raises(ValueError, match = "column types"):
+		tabletransform.transform_table(path_input, path_output, numpy.eye(3), batch_size = 2)
+	assert not path_output.exists()
@@ -0,0 +1,66 @@
+import numpy
+import pytest
+
+from coregistration import thinplatespline, transformmodels, warping
+
+
+def _deform(points: numpy.ndarray) -> numpy.ndarray:
+	return points @ numpy.array([[1.01, 0.02], [-0.02, 0.99]]).T + 6 * numpy.sin(points[:, ::-1] / 90) + [10, -5]
+
+
+@pytest.fixture
+def points() -> numpy.ndarray:
+	return numpy.random.default_rng(0).uniform(0, 400, size = (40, 2))
+
+
+def test_interpolates_control_points(points):
+	spline = thinplatespline.ThinPlateSplineTransform.fit(points, _deform(points))
+	assert numpy.abs(spline.apply(points, dtype = numpy.float64) - _deform(points)).max() < 1E-8
+	assert numpy.abs(spline.apply(points) - _deform(points)).max() < 1E-2
+
+
+def test_recovers_affine_exactly(points):
+	matrix = numpy.array([[0.9, 0.1, 20], [-0.05, 1.1, -7], [0, 0, 1]])
+	spline = thinplatespline.ThinPlateSplineTransform.fit(points, transformmodels.AffineTransform(matrix).apply(points))
+	assert numpy.allclose(spline.to_matrix(), matrix)
+	assert numpy.abs(spline.kernel_weights).max() < 1E-8
+
+
+def test_regularization_approaches_affine(points):
+	targets = _deform(points)
+	residuals = [
+		numpy.abs(thinplatespline.ThinPlateSplineTransform.fit(points, targets, regularization = value).apply(points) - targets).max()
+		for value in (0, 1E-2, 1E4)
+	]
+	affine = transformmodels.AffineTransform.fit(points, targets)
+	assert residuals[0] < residuals[1] < residuals[2]
+	assert residuals[2] == pytest.approx(numpy.abs(affine.apply(points) - targets).max(), rel = 1E-2)
+
+
+def test_chunked_evaluation_matches(points):
+	spline = thinplatespline.ThinPlateSplineTransform.fit(points, _deform(points))
+	queries = numpy.random.default_rng(1).uniform(-50, 450, size = (1000, 2))
+	numpy.testing.assert_allclose(spline.apply(queries, chunk_size = 7), spline.apply(queries), atol = 1E-4)
+
+
+def test_grid_approximation(points):
+	spline = thinplatespline.ThinPlateSplineTransform.fit(points, _deform(points))
+	grid = spline.to_grid((400, 400), spacing = 8)
+	queries = numpy.random.default_rng(2).uniform(0, 400, size = (5000, 2))
+	assert numpy.abs(grid.apply(queries) - spline.apply(queries)).max() < 0.05
+	outside = numpy.array([[-100.0, 50.0], [900.0, 900.0]])
+	assert numpy.allclose(grid.apply(outside), transformmodels.AffineTransform(spline.to_matrix()).apply(outside))
+
+	affine = transformmodels.AffineTransform(numpy.array([[1.02, 0.05, -3], [-0.01, 0.98, 7], [0, 0, 1]]))
+	assert numpy.allclose(grid.compose(affine).apply(queries), affine.apply(grid.apply(queries)))
+	assert numpy.allclose(spline.compose(affine).apply(queries), affine.apply(spline.apply(queries)), atol = 1E-2)
+
+
+def test_warp_with_grid(points):
+	spline = thinplatespline.ThinPlateSplineTransform.fit(points, _deform(points))
+	source = numpy.random.default_rng(3).uniform(0, 1, size = (420, 420)).astype(numpy.float32)
+	exact = warping.warp_array(source, spline, (300, 300))
+	approximate = warping.warp_array(source, spline.to_grid((300, 300), spacing = 4), (300, 300))
+	assert numpy.abs(exact - approximate).mean() < 1E-2
+	# A region warp precedes the spline with the region's offset, which is kept as a chain.
+	numpy.testing.assert_allclose(warping.warp_region(source, spline, (50, 150, 100, 250)), exact[50:150, 100:250], atol = 1E-5)
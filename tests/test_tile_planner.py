@@ -0,0 +1,78 @@
+import numpy
+import pytest
+import tifffile
+
+from coregistration import tileplanner, warping
+
+
+@pytest.fixture
+def stack() -> numpy.ndarray:
+	generator = numpy.random.default_rng(7)
+	return generator.integers(0, 60000, size = (3, 300, 400), dtype = numpy.uint16)
+
+
+@pytest.fixture
+def tiled_path(tmp_path, stack):
+	path = tmp_path / "stack.ome.tiff"
+	tifffile.imwrite(path, stack, tile = (64, 64), photometric = 'minisblack', metadata = {'axes': 'CYX'})
+	return path
+
+
+@pytest.mark.parametrize("planar", [False, True])
+def test_reader_matches_slicing(tmp_path, stack, tiled_path, planar):
+	path = tiled_path
+	if planar:
+		path = tmp_path / "planar.tiff"
+		tifffile.imwrite(path, stack, rowsperstrip = 37, photometric = 'minisblack', planarconfig = 'separate')
+
+	with tileplanner.TiffRegionReader(path) as reader:
+		assert reader.shape == stack.shape
+		assert numpy.array_equal(reader[:, 50:130, 70:333], stack[:, 50:130, 70:333])
+		assert numpy.array_equal(reader[1, 290:, :5], stack[1, 290:, :5])
+		assert numpy.array_equal(reader.select_channels(2)[10:20, 390:], stack[2, 10:20, 390:])
+
+
+def test_channel_names(tmp_path, stack, tiled_path):
+	path = tmp_path / "named.ome.tiff"
+	tifffile.imwrite(path, stack, tile = (64, 64), ome = True, metadata = {'axes': 'CYX', 'Channel': {'Name': ['DAPI', 'Brightfield (RGB)', 'CD8']}})
+	with tileplanner.TiffRegionReader(path) as reader:
+		assert reader.channel_names == ['DAPI', 'Brightfield (RGB)', 'CD8']
+		assert reader.get_channel_index('Brightfield') == 1
+		assert numpy.array_equal(reader.select_channels('CD8')[:20, :30], stack[2, :20, :30])
+		assert reader.select_channels(['CD8', 0]).channel_names == ['CD8', 'DAPI']
+		with pytest.raises(ValueError):
+			reader.get_channel_index('CD4')
+	with tileplanner.TiffRegionReader(tiled_path) as reader:
+		assert reader.channel_names == [None, None, None]
+
+
+def test_plan_skips_tiles_outside_rotated_footprint():
+	layout = tileplanner.TileLayout(image_shape = (1024, 1024), tile_shape = (64, 64))
+	angle = numpy.radians(45)
+	matrix = numpy.array([[numpy.cos(angle), -numpy.sin(angle), 512], [numpy.sin(angle), numpy.cos(angle), 0], [0, 0, 1]])
+	box = (0, 512, 0, 512)
+
+	tiles = tileplanner.plan_source_tiles(matrix, box, layout)
+	window = tileplanner.footprint_window(matrix, box, layout.image_shape)
+	bounding_tiles = (-(-window[1] // 64) - window[0] // 64) * (-(-window[3] // 64) - window[2] // 64)
+
+	assert len(tiles) < 0.75 * bounding_tiles
+	# Every sample point of the box lies in a planned tile.
+	source_x, source_y = warping.map_tile_coordinates(matrix, box)
+	inside = (source_x >= 0) & (source_x < 1024) & (source_y >= 0) & (source_y < 1024)
+	needed = numpy.unique(numpy.stack((source_y[inside] // 64, source_x[inside] // 64), axis = -1).astype(int), axis = 0)
+	planned = {tuple(tile) for tile in tiles}
+	assert all(tuple(tile) in planned for tile in needed)
+
+
+def test_warp_region_from_reader(stack, tiled_path):
+	angle = numpy.radians(20)
+	matrix = numpy.array([[numpy.cos(angle), -numpy.sin(angle), 150], [numpy.sin(angle), numpy.cos(angle), -20], [0, 0, 1]])
+	box = (40, 140, 60, 200)
+	expected = warping.warp_channels(stack, matrix, (300, 400), threads = 1)[:, box[0]:box[1], box[2]:box[3]]
+
+	with tileplanner.TiffRegionReader(tiled_path) as reader:
+		result = warping.warp_region(reader, matrix, box, threads = 1)
+		assert reader.bytes_read < stack.nbytes / 2
+
+	assert numpy.array_equal(result, expected)
@@ -0,0 +1,87 @@
+import json
+
+import numpy
+import pytest
+
+from coregistration import affinetransform, piecewiseaffine, transformgraph, transformmodels
+
+
+def _affine(angle: float, scale: float, offset: tuple) -> numpy.ndarray:
+	return numpy.array([
+		[scale * numpy.cos(angle), -scale * numpy.sin(angle), offset[0]],
+		[scale * numpy.sin(angle), scale * numpy.cos(angle), offset[1]],
+		[0, 0, 1]
+	])
+
+
+MATRICES = {
+	('A', 'B'): _affine(0.1, 1.02, (10, -4)),
+	('A', 'C'): _affine(-0.2, 0.97, (-30, 12)),
+	('C', 'D'): _affine(0.05, 1.0, (3, 8))
+}
+
+
+@pytest.fixture
+def graph() -> transformgraph.TransformGraph:
+	return transformgraph.TransformGraph((source, target, matrix) for (source, target), matrix in MATRICES.items())
+
+
+@pytest.fixture
+def points() -> numpy.ndarray:
+	return numpy.random.default_rng(0).uniform(0, 1000, size = (50, 2))
+
+
+def test_multi_hop_matrix(graph, points):
+	assert graph.path('B', 'D') == ['B', 'A', 'C', 'D']
+	expected = MATRICES[('C', 'D')] @ MATRICES[('A', 'C')] @ numpy.linalg.inv(MATRICES[('A', 'B')])
+	assert numpy.allclose(graph.get_matrix('B', 'D'), expected)
+	assert numpy.allclose(graph.apply('D', 'B', graph.apply('B', 'D', points)), points)
+	assert graph.get('B', 'D') is graph.get('B', 'D')
+
+
+def test_add_invalidates_cache(graph):
+	before = graph.get_matrix('B', 'C')
+	graph.add('B', 'C', numpy.eye(3))
+	assert graph.path('B', 'C') == ['B', 'C']
+	assert not numpy.allclose(graph.get_matrix('B', 'C'), before)
+
+
+def test_disconnected_and_unknown_barcodes(graph):
+	graph.add('E', 'F', numpy.eye(3))
+	assert sorted(map(sorted, graph.components())) == [['A', 'B', 'C', 'D'], ['E', 'F']]
+	with pytest.raises(ValueError):
+		graph.get('A', 'E')
+	with pytest.raises(ValueError):
+		graph.get('A', 'Z')
+
+
+def test_non_matrix_edges_form_chains(graph, points):
+	control = numpy.random.default_rng(1).uniform(0, 1000, size = (30, 2))
+	first = piecewiseaffine.PiecewiseAffineTransform.fit(control, control + 5 * numpy.sin(control / 200))
+	second = piecewiseaffine.PiecewiseAffineTransform.fit(control, control - 3 * numpy.cos(control / 150))
+	graph.add('D', 'E', first)
+	graph.add('E', 'F', second)
+
+	transform = graph.get('B', 'F')
+	assert isinstance(transform, transformmodels.TransformChain)
+	# The matrices before D are merged into the first piecewise-affine transform.
+	assert len(transform.transforms) == 2
+	expected = second.apply(first.apply(transformmodels.AffineTransform(graph.get_matrix('B', 'D')).apply(points)))
+	assert numpy.allclose(graph.apply('B', 'F', points), expected)
+	with pytest.raises(ValueError):
+		graph.get_matrix('B', 'F')
+
+
+def test_from_exports(tmp_path):
+	for (reference, query), matrix in MATRICES.items():
+		data = {'barcode:reference': reference, 'barcode:query': query, 'matrix': matrix.tolist()}
+		(tmp_path / f"{reference}-{query}{affinetransform.EXPORT_SUFFIX}").write_text(json.dumps(data))
+	table = tmp_path / "pairs.tsv"
+	table.write_text("id:group\tbarcode\tpath\n1\tA\ta.tif\n1\tB\tb.tif\n1\tC\tc.tif\n1\tG\tg.tif\n")
+
+	graph = transformgraph.TransformGraph.from_folder(tmp_path)
+	assert sorted(graph.barcodes) == ['A', 'B', 'C', 'D']
+	assert numpy.allclose(graph.get_matrix('C', 'A'), numpy.linalg.inv(MATRICES[('A', 'C')]))
+
+	graph = transformgraph.TransformGraph.from_table(table, tmp_path)
+	assert sorted(graph.barcodes) == ['A', 'B', 'C']
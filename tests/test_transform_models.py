@@ -0,0 +1,89 @@
+import numpy
+import pytest
+
+from coregistration import affinetransform, transformmodels
+
+
+def _rotation(angle: float, scale: float = 1.0) -> numpy.ndarray:
+	return scale * numpy.array([[numpy.cos(angle), -numpy.sin(angle)], [numpy.sin(angle), numpy.cos(angle)]])
+
+
+MATRICES = {
+	'translation': numpy.array([[1, 0, 12.5], [0, 1, -3], [0, 0, 1]]),
+	'rigid':       numpy.vstack((numpy.hstack((_rotation(0.3), [[4], [5]])), [0, 0, 1])),
+	'similarity':  numpy.vstack((numpy.hstack((_rotation(-0.2, 1.7), [[4], [5]])), [0, 0, 1])),
+	'affine':      numpy.array([[0.9, 0.1, 20], [-0.05, 1.1, -7], [0, 0, 1]]),
+	'projective':  numpy.array([[0.9, 0.1, 20], [-0.05, 1.1, -7], [1E-4, -2E-4, 1]])
+}
+
+
+@pytest.fixture
+def points() -> numpy.ndarray:
+	return numpy.random.default_rng(0).uniform(0, 500, size = (20, 2))
+
+
+@pytest.mark.parametrize("name", list(MATRICES))
+def test_fit_recovers_matrix(name, points):
+	model = transformmodels.get_model(name)
+	points_transformed = transformmodels.ProjectiveTransform(MATRICES[name]).apply(points)
+
+	fitted = model.fit(points, points_transformed)
+
+	assert numpy.allclose(fitted.to_matrix(), MATRICES[name], atol = 1E-8)
+	assert numpy.allclose(fitted.residuals(points, points_transformed), 0, atol = 1E-6)
+
+
+@pytest.mark.parametrize("name", list(MATRICES))
+def test_inverse_round_trip(name, points):
+	model = transformmodels.get_model(name).from_matrix(MATRICES[name])
+	assert numpy.allclose(model.inverse().apply(model.apply(points)), points)
+
+
+def test_compose_promotes_to_more_general_model(points):
+	rigid = transformmodels.RigidTransform(MATRICES['rigid'])
+	translation = transformmodels.TranslationTransform(MATRICES['translation'])
+
+	composed = translation.compose(rigid)
+
+	assert isinstance(composed, transformmodels.RigidTransform)
+	assert numpy.allclose(composed.apply(points), rigid.apply(translation.apply(points)))
+
+
+def test_similarity_parameters():
+	model = transformmodels.SimilarityTransform(MATRICES['similarity'])
+	parameters = model.to_parameters()
+	assert parameters['scale'] == pytest.approx(1.7)
+	assert parameters['angle'] == pytest.approx(-0.2)
+
+
+def test_fit_requires_minimum_points():
+	with pytest.raises(ValueError):
+		transformmodels.ProjectiveTransform.fit([(0, 0), (1, 0), (0, 1)], [(0, 0), (1, 0), (0, 1)])
+
+
+def test_base_models_are_abstract():
+	with pytest.raises(TypeError):
+		transformmodels.TransformModel()
+	with pytest.raises(TypeError):
+		transformmodels.MatrixTransform()
+
+
+def test_translation_rejects_linear_parts():
+	with pytest.raises(ValueError):
+		transformmodels.TranslationTransform([[0, -1, 3], [1, 0, 4], [0, 0, 1]])
+	translation = transformmodels.TranslationTransform([[1, 0, 3], [0, 1, 4], [0, 0, 1]])
+	points = numpy.array([[1.0, 2.0]])
+	assert numpy.allclose(translation.apply(points), affinetransform.apply_transform(translation.to_matrix(), points))
+	assert numpy.allclose(translation.inverse().apply(translation.apply(points)), points)
+
+
+def test_compose_transforms_merges_only_composable_neighbours(points):
+	affine = transformmodels.AffineTransform(MATRICES['affine'])
+	projective = transformmodels.ProjectiveTransform(MATRICES['projective'])
+	assert affine.can_compose(projective) and projective.can_compose(affine)
+
+	chain = transformmodels.TransformChain([affine])
+	assert not chain.can_compose(affine)
+	composed = transformmodels.compose_transforms([chain, projective, affine])
+	assert isinstance(composed, transformmodels.ProjectiveTransform)
+	assert numpy.allclose(composed.apply(points), affine.apply(projective.apply(affine.apply(points))))
@@ -0,0 +1,163 @@
+from types import SimpleNamespace
+
+import numpy
+import pytest
+import tifffile
+
+from coregistration import tileplanner, warping
+
+MATRIX = numpy.array([[0.95, 0.1, 12.3], [-0.08, 1.05, 7.7], [0, 0, 1]])
+
+
+@pytest.fixture
+def ramp() -> numpy.ndarray:
+	""" A linear ramp, which bilinear and bicubic interpolation both reproduce exactly."""
+	rows, columns = numpy.mgrid[0:120, 0:160]
+	return 0.5 * columns + 0.25 * rows
+
+
+def _expected_ramp(matrix: numpy.ndarray, shape):
+	rows, columns = numpy.mgrid[0:shape[0], 0:shape[1]]
+	source_x = matrix[0, 0] * columns + matrix[0, 1] * rows + matrix[0, 2]
+	source_y = matrix[1, 0] * columns + matrix[1, 1] * rows + matrix[1, 2]
+	return 0.5 * source_x + 0.25 * source_y, source_x, source_y
+
+
+@pytest.mark.parametrize("method", ['bilinear', 'bicubic'])
+def test_warp_array_reproduces_linear_ramp(ramp, method):
+	result = warping.warp_array(ramp, MATRIX, (100, 140), method = method, tile_size = 32, threads = 2)
+
+	expected, source_x, source_y = _expected_ramp(MATRIX, (100, 140))
+	interior = (source_x >= 2) & (source_x <= 157) & (source_y >= 2) & (source_y <= 117)
+	assert numpy.allclose(result[interior], expected[interior])
+
+
+def test_warp_array_fills_outside_source(ramp):
+	matrix = numpy.array([[1, 0, 100], [0, 1, 0], [0, 0, 1]])
+	result = warping.warp_array(ramp.astype(numpy.uint16), matrix, (120, 160), method = 'nearest', fill_value = 9, tile_size = 50)
+
+	assert result.dtype == numpy.uint16
+	assert numpy.array_equal(result[:, :60], ramp[:, 100:].astype(numpy.uint16))
+	assert (result[:, 60:] == 9).all()
+
+
+def test_warp_array_into_memmap(ramp, tmp_path):
+	out = warping.allocate_output((100, 140), numpy.float32, path = tmp_path / "warped.npy")
+	warping.warp_array(ramp, MATRIX, (100, 140), out = out, tile_size = 64)
+	out.flush()
+
+	expected = warping.warp_array(ramp.astype(numpy.float32), MATRIX, (100, 140), tile_size = 1024)
+	assert numpy.allclose(numpy.load(tmp_path / "warped.npy"), expected)
+
+
+@pytest.mark.parametrize("linear, expected_path", [
+	([[1, 0], [0, 1]], 'translation'),
+	([[0, -1], [1, 0]], 'orthogonal'),
+	([[-1, 0], [0, 1]], 'orthogonal'),
+	([[1.5, 0], [0, 0.75]], 'axis-aligned')
+])
+@pytest.mark.parametrize("method", ['nearest', 'bicubic'])
+def test_fast_paths_match_general_path(ramp, linear, expected_path, method):
+	matrix = numpy.eye(3)
+	matrix[:2, :2] = linear
+	matrix[:2, 2] = [40, 30]
+
+	assert warping.classify_matrix(matrix, (100, 140)) == expected_path
+	fast = warping.warp_array(ramp, matrix, (100, 140), method = method, fill_value = -1, tile_size = 32)
+	general = warping.warp_array(ramp, matrix, (100, 140), method = method, fill_value = -1, tile_size = 32, fast_paths = False)
+	assert numpy.allclose(fast, general)
+
+
+@pytest.mark.parametrize("linear", [[[1, 0], [0, 1]], [[0, 1], [-1, 0]]])
+def test_fast_paths_round_and_clip_integer_output(linear):
+	source = numpy.array([[0.6, 1.4, -3, 300.7]] * 4, dtype = numpy.float32)
+	matrix = numpy.eye(3)
+	matrix[:2, :2] = linear
+	matrix[:2, 2] = [0, 3] if linear[0][1] else [0, 0]
+
+	fast = warping.warp_array(source, matrix, (4, 4), method = 'nearest', dtype = numpy.uint8)
+	general = warping.warp_array(source, matrix, (4, 4), method = 'nearest', dtype = numpy.uint8, fast_paths = False)
+	assert numpy.array_equal(fast, general)
+	if not linear[0][1]:
+		assert fast[0].tolist() == [1, 1, 0, 255]
+
+
+def test_sampling_plan_indices_of_large_windows():
+	# Two samples at opposite corners of a slide make a window of 3.6E9 pixels, beyond the int32 range.
+	coordinates = numpy.array([[0.0, 59_999.0]])
+	plan = warping.build_sampling_plan(coordinates, coordinates, (60_000, 60_000), method = 'nearest')
+
+	assert plan.indices()[0][0].tolist() == [[0, 59_999 * 60_000 + 59_999]]
+
+
+def test_classify_matrix_tolerance():
+	matrix = numpy.array([[1, 0, 10.0004], [0, 1, -3], [0, 0, 1]])
+	assert warping.classify_matrix(matrix, (1000, 1000)) == 'translation'
+	assert warping.classify_matrix(matrix, (1000, 1000), tolerance = 1E-4) == 'axis-aligned'
+
+
+@pytest.mark.parametrize("gather", ['channels-last', 'channels-first'])
+@pytest.mark.parametrize("method", ['nearest', 'bilinear', 'bicubic'])
+def test_warp_channels_matches_per_channel_warp(gather, method):
+	stack = numpy.random.default_rng(0).integers(0, 255, size = (4, 90, 120), dtype = numpy.uint8)
+
+	result = warping.warp_channels(stack, MATRIX, (80, 100), channels = [2, 0, 3], method = method, gather = gather, tile_size = 32)
+
+	expected = [warping.warp_array(stack[index], MATRIX, (80, 100), method = method) for index in (2, 0, 3)]
+	assert result.shape == (3, 80, 100)
+	assert numpy.array_equal(result, numpy.stack(expected))
+
+
+@pytest.mark.parametrize("mode", ['memmap', 'normalized', 'loaded'])
+def test_warp_image_reads_unloaded_tiff_images_by_region(tmp_path, monkeypatch, mode):
+	stack = numpy.random.default_rng(1).integers(0, 255, size = (3, 90, 120), dtype = numpy.uint8)
+	path = tmp_path / "query.tiff"
+	tifffile.imwrite(path, stack, photometric = 'minisblack')
+	if mode == 'loaded':
+		# An image read into memory and then edited: the edit must be warped, not the file.
+		data = tifffile.imread(path)
+		data[0] = 255 - data[0]
+	else:
+		data = tifffile.memmap(path)
+	image = SimpleNamespace(
+		data = data, filename = path, is_norm = mode == 'normalized', is_clip = False, barcode = 'query', shape = data.shape,
+		channel_count = 3, channels = {'DAPI': {}, 'CD8': {}, 'CD4': {}}, channel_name_map = {'DAPI': 0, 'CD8': 1, 'CD4': 2}
+	)
+	reads = list()
+	read_window = tileplanner.TiffRegionReader.read_window
+	monkeypatch.setattr(tileplanner.TiffRegionReader, 'read_window', lambda self, *args: reads.append(args) or read_window(self, *args))
+
+	result = warping.warp_image(image, MATRIX, (80, 100), channels = ['CD4', 0], tile_size = 32, threads = 1)
+	channel = warping.warp_image_channel(image, 'CD8', MATRIX, (80, 100), tile_size = 32, threads = 1)
+
+	expected = numpy.array(data)
+	assert numpy.array_equal(result, warping.warp_channels(expected, MATRIX, (80, 100), channels = [2, 0]))
+	assert numpy.array_equal(channel, warping.warp_array(expected[1], MATRIX, (80, 100)))
+	assert bool(reads) == (mode == 'memmap')
+
+
+@pytest.mark.parametrize("method", ['bilinear', 'bicubic'])
+# Sources more than half a pixel outside the image are filled, so the shifts stay within that border.
+@pytest.mark.parametrize("shift", [(-0.3, 0.0), (0.0, -0.45), (-0.4, -0.2), (0.25, 0.5)])
+def test_border_taps_match_scipy(method, shift):
+	ndimage = pytest.importorskip('scipy.ndimage')
+	image = numpy.random.default_rng(2).random((40, 50))
+	matrix = numpy.array([[1, 0, shift[0]], [0, 1, shift[1]], [0, 0, 1]])
+	rows, columns = numpy.mgrid[0:6, 0:8].astype(float)
+	x, y = columns + shift[0], rows + shift[1]
+
+	if method == 'bilinear':
+		expected = ndimage.map_coordinates(image, [y, x], order = 1, mode = 'nearest')
+	else:
+		# scipy's cubic is a B-spline, so the Keys taps are fetched from it with nearest-neighbour edge clamping.
+		expected = numpy.zeros_like(x)
+		weights_x = warping._cubic_weights(x - numpy.floor(x))
+		weights_y = warping._cubic_weights(y - numpy.floor(y))
+		for offset_y, weight_y in zip((-1, 0, 1, 2), weights_y):
+			for offset_x, weight_x in zip((-1, 0, 1, 2), weights_x):
+				taps = ndimage.map_coordinates(image, [numpy.floor(y) + offset_y, numpy.floor(x) + offset_x], order = 0, mode = 'nearest')
+				expected += weight_y * weight_x * taps
+
+	for fast_paths in (True, False):
+		result = warping.warp_array(image, matrix, (6, 8), method = method, fast_paths = fast_paths)
+		numpy.testing.assert_allclose(result, expected, atol = 1E-9)